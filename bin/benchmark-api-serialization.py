@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""
+Measure how many objects per second the API serializer (inbox.api.kellogs)
+turns into JSON.
+
+Threads, messages and events are built in memory, so no database or account
+is needed, and serialized repeatedly through the same APIEncoder calls that
+the API and the delta stream make. Only the public APIEncoder interface is
+used, so the script can be run against different revisions to compare them.
+
+"""
+from __future__ import division, print_function
+
+import datetime
+import time
+import uuid
+
+import click
+
+from inbox.api.kellogs import API_JSON_BACKEND, APIEncoder
+from inbox.models import Calendar, Event, Message, Namespace, Thread
+from inbox.models.backends.generic import GenericAccount
+from inbox.sqlalchemy_ext.util import generate_public_id
+
+START = datetime.datetime(2020, 1, 1)
+
+
+def _message(namespace, i):
+    m = Message()
+    m.public_id = generate_public_id()
+    m.namespace = namespace
+    m.subject = "Benchmark message {}".format(i)
+    m.from_addr = [("Alice", "alice@example.com")]
+    m.to_addr = [("Bob", "bob@example.com"), ("Carol", "carol@example.com")]
+    m.cc_addr = [("Dave", "dave@example.com")]
+    m.bcc_addr = []
+    m.reply_to = []
+    m.received_date = START + datetime.timedelta(minutes=i)
+    m.snippet = "Hello World! " * 10
+    m.body = "<p>{}</p>".format("Hello World! " * 100)
+    m.message_id_header = "<{}@example.com>".format(i)
+    m.references = []
+    m.is_read = i % 2 == 0
+    m.is_starred = i % 5 == 0
+    m.is_draft = False
+    m.size = 0
+    return m
+
+
+def _fixtures(count, thread_length):
+    account = GenericAccount(email_address="alice@example.com", provider="custom")
+    namespace = Namespace(public_id=generate_public_id())
+    account.namespace = namespace
+
+    threads = []
+    for i in range(count):
+        thread = Thread(
+            public_id=generate_public_id(),
+            namespace=namespace,
+            subject="Benchmark thread {}".format(i),
+            subjectdate=START,
+            recentdate=START,
+            snippet="Hello World!",
+            version=0,
+        )
+        for j in range(thread_length):
+            thread.messages.append(_message(namespace, i * thread_length + j))
+        threads.append(thread)
+
+    messages = [_message(namespace, i) for i in range(count)]
+
+    calendar = Calendar(
+        public_id=generate_public_id(),
+        namespace=namespace,
+        name="Calendar",
+        uid="benchmark",
+        read_only=False,
+    )
+    events = []
+    for i in range(count):
+        event = Event.create(
+            public_id=generate_public_id(),
+            calendar=calendar,
+            title="Benchmark event {} with bob@example.com".format(i),
+            description="Hello World!",
+            location="Here",
+            busy=True,
+            read_only=False,
+            owner="Alice <alice@example.com>",
+            participants=[
+                {"name": "Bob", "email": "bob@example.com", "status": "yes"},
+                {"name": "Carol", "email": "carol@example.com", "status": "noreply"},
+            ],
+            # A quarter of the events are recurring.
+            recurrence=["RRULE:FREQ=WEEKLY"] if i % 4 == 0 else None,
+            start=START + datetime.timedelta(hours=i),
+            end=START + datetime.timedelta(hours=i + 1),
+            all_day=False,
+            raw_data="{}",
+            uid=str(uuid.uuid4()),
+        )
+        events.append(event)
+
+    return (
+        namespace,
+        [("threads", threads), ("messages", messages), ("events", events)],
+    )
+
+
+def _objects_per_second(encoder, objects, iterations):
+    # Serialize once first so that one-off work doesn't count towards the time.
+    encoder.cereal(objects)
+    start = time.time()
+    for _ in range(iterations):
+        encoder.cereal(objects)
+    elapsed = time.time() - start
+    return len(objects) * iterations / elapsed
+
+
+@click.command()
+@click.option("--count", type=int, default=100, help="Objects of each kind.")
+@click.option("--thread-length", type=int, default=5, help="Messages per thread.")
+@click.option("--iterations", type=int, default=20)
+def main(count, thread_length, iterations):
+    namespace, fixtures = _fixtures(count, thread_length)
+    print("JSON backend: {}".format(API_JSON_BACKEND))
+    for name, objects in fixtures:
+        for expand in (False, True):
+            encoder = APIEncoder(namespace.public_id, expand=expand)
+            rate = _objects_per_second(encoder, objects, iterations)
+            print(
+                "{:<10} expand={:<5} {:>10.0f} objects/sec".format(
+                    name, str(expand), rate
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
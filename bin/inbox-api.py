@@ -98,7 +98,7 @@ def start(port, start_syncback, enable_tracer, enable_profiler):
 
         syncback = SyncbackService(0, 0, 1)
         profiling_frontend = SyncbackHTTPFrontend(
-            int(port) + 1, enable_tracer, enable_profiler_api
+            syncback, int(port) + 1, enable_tracer, enable_profiler_api
         )
         profiling_frontend.start()
         syncback.start()
@@ -18,7 +18,8 @@ from inbox.config import config
 from inbox.error_handling import maybe_enable_rollbar
 from inbox.logging import configure_logging
 from inbox.models import Account
-from inbox.models.session import session_scope
+from inbox.models.session import global_session_scope, session_scope
+from inbox.util.sharding import generate_open_shard_key
 from inbox.util.startup import preflight
 from inbox.util.url import provider_from_address
 
@@ -33,7 +34,10 @@ configure_logging(config.get("LOGLEVEL"))
     help="Re-authenticate an account even if it already exists",
 )
 @click.option(
-    "--target", type=int, default=0, help="Database shard id to target for the account"
+    "--target",
+    type=int,
+    default=None,
+    help="Database shard id to target for the account (default: a random open shard)",
 )
 @click.option(
     "--provider",
@@ -46,9 +50,20 @@ def main(email_address, reauth, target, provider):
 
     maybe_enable_rollbar()
 
-    shard_id = target << 48
+    # An existing account may be on any shard.
+    with global_session_scope() as db_session:
+        existing = (
+            db_session.query(Account.id).filter_by(email_address=email_address).first()
+        )
+
+    if existing is not None:
+        shard_key = existing[0]
+    elif target is None:
+        shard_key = generate_open_shard_key()
+    else:
+        shard_key = target << 48
 
-    with session_scope(shard_id) as db_session:
+    with session_scope(shard_key) as db_session:
         account = (
             db_session.query(Account).filter_by(email_address=email_address).first()
         )
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+"""
+Recompute the materialized thread counters and fix any that drifted, e.g.
+because of writes that bypassed the ORM's flush hooks.
+
+"""
+from __future__ import print_function
+
+import click
+
+from inbox.error_handling import maybe_enable_rollbar
+from inbox.ignition import engine_manager
+from inbox.models import Namespace
+from inbox.models.session import session_scope, session_scope_by_shard_id
+from inbox.models.thread_counter import reconcile_thread_counters
+
+
+@click.command()
+@click.option("--namespace-id", type=int)
+@click.option("--shard-id", type=int)
+def main(namespace_id, shard_id):
+    maybe_enable_rollbar()
+
+    if namespace_id is not None:
+        namespace_ids = [namespace_id]
+    else:
+        shard_ids = [shard_id] if shard_id is not None else engine_manager.engines
+        namespace_ids = []
+        for key in shard_ids:
+            with session_scope_by_shard_id(key) as db_session:
+                namespace_ids.extend(
+                    id_
+                    for id_, in db_session.query(Namespace.id).order_by(Namespace.id)
+                )
+
+    for id_ in namespace_ids:
+        with session_scope(id_) as db_session:
+            fixed = reconcile_thread_counters(db_session, id_)
+        print("Namespace {}: fixed {} counters".format(id_, fixed))
+
+
+if __name__ == "__main__":
+    main()
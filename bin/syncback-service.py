@@ -82,7 +82,9 @@ def main(prod, config, process_num, syncback_id, enable_tracer, enable_profiler)
 
         port = 16384 + process_num
         enable_profiler_api = inbox_config.get("DEBUG_PROFILING_ON")
-        frontend = SyncbackHTTPFrontend(port, enable_tracer, enable_profiler_api)
+        frontend = SyncbackHTTPFrontend(
+            syncback, port, enable_tracer, enable_profiler_api
+        )
         frontend.start()
 
         syncback.start()
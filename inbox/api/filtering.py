@@ -1,8 +1,18 @@
+import heapq
+import itertools
+from datetime import datetime
+
+import arrow
 from sqlalchemy import and_, asc, bindparam, desc, func, or_
 from sqlalchemy.orm import contains_eager, subqueryload
 
 from inbox.api.err import InputError
-from inbox.api.validation import valid_public_id
+from inbox.api.validation import encode_page_token, valid_public_id
+from inbox.events.recurring import (
+    count_occurrences,
+    iter_occurrences,
+    prefetch_overrides,
+)
 from inbox.ignition import engine_manager
 from inbox.models import (
     Block,
@@ -17,9 +27,85 @@ from inbox.models import (
     Metadata,
     Part,
     Thread,
+    thread_counter,
 )
 from inbox.models.event import RecurringEvent
-from inbox.models.session import session_scope_by_shard_id
+from inbox.models.session import query_shards
+
+
+class Page(list):
+    """
+    A page of results. If the page is full, `next_page_token` continues the
+    listing right after its last row, so that paging through a whole
+    namespace never has to skip over an ever-growing offset.
+
+    """
+
+    def __init__(self, results, next_page_token=None):
+        super(Page, self).__init__(results)
+        self.next_page_token = next_page_token
+
+
+def _page_after(page_token, *types):
+    # Check that a decoded page token holds the sort key values we expect.
+    if page_token is None:
+        return None
+    if len(page_token) != len(types) or not all(
+        isinstance(value, type_) for value, type_ in zip(page_token, types)
+    ):
+        raise InputError("Invalid page_token.")
+    return page_token
+
+
+def _page(rows, limit, view, *sort_keys):
+    next_page_token = None
+    if limit and len(rows) == limit:
+        last = rows[-1]
+        next_page_token = encode_page_token(
+            [getattr(last, sort_key) for sort_key in sort_keys]
+        )
+    if view == "ids":
+        rows = [row[0] for row in rows]
+    return Page(rows, next_page_token)
+
+
+def _count_from_counters(db_session, namespace_id, in_, unread, starred, kind):
+    # Answer a count from the materialized ThreadCounters if they cover the
+    # filters. Returns None if they don't.
+    if not thread_counter.THREAD_COUNTERS_ENABLED:
+        return None
+    if unread not in (None, True) or starred not in (None, True):
+        return None
+    if unread and starred:
+        return None
+
+    category_id = thread_counter.ALL_CATEGORIES
+    if in_ is not None:
+        category_filters = [Category.name == in_, Category.display_name == in_]
+        try:
+            valid_public_id(in_)
+            category_filters.append(Category.public_id == in_)
+        except InputError:
+            pass
+        category_ids = (
+            db_session.query(Category.id)
+            .filter(Category.namespace_id == namespace_id, or_(*category_filters))
+            .limit(2)
+            .all()
+        )
+        if len(category_ids) != 1:
+            return None
+        category_id = category_ids[0][0]
+
+    if unread:
+        column = "unread_" + kind
+    elif starred:
+        column = "starred_" + kind
+    else:
+        column = kind
+    return thread_counter.get_thread_count(
+        db_session, namespace_id, category_id, column
+    )
 
 
 def contact_subquery(db_session, namespace_id, email_address, field):
@@ -58,12 +144,37 @@ def threads(
     offset,
     view,
     db_session,
+    page_token=None,
 ):
 
+    if view == "count" and all(
+        v is None
+        for v in [
+            subject,
+            from_addr,
+            to_addr,
+            cc_addr,
+            bcc_addr,
+            any_email,
+            message_id_header,
+            thread_public_id,
+            started_before,
+            started_after,
+            last_message_before,
+            last_message_after,
+            filename,
+        ]
+    ):
+        count = _count_from_counters(
+            db_session, namespace_id, in_, unread, starred, "threads"
+        )
+        if count is not None:
+            return {"count": count}
+
     if view == "count":
         query = db_session.query(func.count(Thread.id))
     elif view == "ids":
-        query = db_session.query(Thread.public_id)
+        query = db_session.query(Thread.public_id, Thread.recentdate, Thread.id)
     else:
         query = db_session.query(Thread)
 
@@ -176,15 +287,22 @@ def threads(
         expand = view == "expanded"
         query = query.options(*Thread.api_loading_options(expand))
 
-    query = query.order_by(desc(Thread.recentdate)).limit(limit)
+    after = _page_after(page_token, datetime, int)
+    if after is not None:
+        recentdate, thread_id = after
+        query = query.filter(
+            or_(
+                Thread.recentdate < recentdate,
+                and_(Thread.recentdate == recentdate, Thread.id < thread_id),
+            )
+        )
+
+    query = query.order_by(desc(Thread.recentdate), desc(Thread.id)).limit(limit)
 
     if offset:
         query = query.offset(offset)
 
-    if view == "ids":
-        return [x[0] for x in query.all()]
-
-    return query.all()
+    return _page(query.all(), limit, view, "recentdate", "id")
 
 
 def messages_or_drafts(
@@ -211,6 +329,7 @@ def messages_or_drafts(
     offset,
     view,
     db_session,
+    page_token=None,
 ):
     # Warning: complexities ahead. This function sets up the query that gets
     # results for the /messages API. It loads from several tables, supports a
@@ -248,10 +367,39 @@ def messages_or_drafts(
         "offset": offset,
     }
 
+    if (
+        view == "count"
+        and not drafts
+        and all(
+            v is None
+            for v in [
+                subject,
+                from_addr,
+                to_addr,
+                cc_addr,
+                bcc_addr,
+                any_email,
+                thread_public_id,
+                started_before,
+                started_after,
+                last_message_before,
+                last_message_after,
+                received_before,
+                received_after,
+                filename,
+            ]
+        )
+    ):
+        count = _count_from_counters(
+            db_session, namespace_id, in_, unread, starred, "messages"
+        )
+        if count is not None:
+            return {"count": count}
+
     if view == "count":
         query = db_session.query(func.count(Message.id))
     elif view == "ids":
-        query = db_session.query(Message.public_id)
+        query = db_session.query(Message.public_id, Message.received_date, Message.id)
     else:
         query = db_session.query(Message)
 
@@ -438,14 +586,27 @@ def messages_or_drafts(
         res = query.params(**param_dict).one()[0]
         return {"count": res}
 
-    query = query.order_by(desc(Message.received_date))
+    after = _page_after(page_token, datetime, int)
+    if after is not None:
+        param_dict["page_received_date"], param_dict["page_id"] = after
+        query = query.filter(
+            or_(
+                Message.received_date < bindparam("page_received_date"),
+                and_(
+                    Message.received_date == bindparam("page_received_date"),
+                    Message.id < bindparam("page_id"),
+                ),
+            )
+        )
+
+    query = query.order_by(desc(Message.received_date), desc(Message.id))
     query = query.limit(bindparam("limit"))
     if offset:
         query = query.offset(bindparam("offset"))
 
     if view == "ids":
         res = query.params(**param_dict).all()
-        return [x[0] for x in res]
+        return _page(res, limit, view, "received_date", "id")
 
     # Eager-load related attributes to make constructing API representations
     # faster. Note that we don't use the options defined by
@@ -459,7 +620,7 @@ def messages_or_drafts(
     )
 
     prepared = query.params(**param_dict)
-    return prepared.all()
+    return _page(prepared.all(), limit, view, "received_date", "id")
 
 
 def files(
@@ -471,12 +632,13 @@ def files(
     offset,
     view,
     db_session,
+    page_token=None,
 ):
 
     if view == "count":
         query = db_session.query(func.count(Block.id))
     elif view == "ids":
-        query = db_session.query(Block.public_id)
+        query = db_session.query(Block.public_id, Block.id)
     else:
         query = db_session.query(Block)
 
@@ -505,15 +667,16 @@ def files(
     if view == "count":
         return {"count": query.one()[0]}
 
+    after = _page_after(page_token, int)
+    if after is not None:
+        query = query.filter(Block.id > after[0])
+
     query = query.order_by(asc(Block.id)).distinct().limit(limit)
 
     if offset:
         query = query.offset(offset)
 
-    if view == "ids":
-        return [x[0] for x in query.all()]
-    else:
-        return query.all()
+    return _page(query.all(), limit, view, "id")
 
 
 def filter_event_query(
@@ -558,7 +721,7 @@ def filter_event_query(
     return query
 
 
-def recurring_events(
+def recurring_event_windows(
     filters,
     starts_before,
     starts_after,
@@ -567,7 +730,8 @@ def recurring_events(
     db_session,
     show_cancelled=False,
 ):
-    # Expands individual recurring events into full instances.
+    # Returns the recurring events to expand, along with the window (start,
+    # end) to expand each of them in.
     # If neither starts_before or ends_before is given, the recurring range
     # defaults to now + 1 year (see events/recurring.py)
 
@@ -596,18 +760,17 @@ def recurring_events(
 
     recur_query = recur_query.filter(and_(*after_criteria))
 
-    recur_instances = []
-
+    windows = []
     for r in recur_query:
         # the occurrences check only checks starting timestamps
+        start, end = starts_after, starts_before
         if ends_before and not starts_before:
-            starts_before = ends_before - r.length
+            end = ends_before - r.length
         if ends_after and not starts_after:
-            starts_after = ends_after - r.length
-        instances = r.all_events(start=starts_after, end=starts_before)
-        recur_instances.extend(instances)
+            start = ends_after - r.length
+        windows.append((r, start, end))
 
-    return recur_instances
+    return windows
 
 
 def events(
@@ -633,15 +796,21 @@ def events(
     expand_recurring,
     show_cancelled,
     db_session,
+    page_token=None,
 ):
 
+    if expand_recurring and page_token is not None:
+        # Recurring events are expanded in memory, so there's nothing to
+        # seek on.
+        raise InputError("page_token can't be used with expand_recurring.")
+
     query = db_session.query(Event)
 
     if not expand_recurring:
         if view == "count":
             query = db_session.query(func.count(Event.id))
         elif view == "ids":
-            query = db_session.query(Event.public_id)
+            query = db_session.query(Event.public_id, Event.start, Event.id)
 
     filters = [
         namespace_id,
@@ -752,7 +921,7 @@ def events(
     query = query.filter(event_predicate)
 
     if expand_recurring:
-        expanded = recurring_events(
+        windows = recurring_event_windows(
             filters,
             starts_before,
             starts_after,
@@ -761,34 +930,57 @@ def events(
             db_session,
             show_cancelled=show_cancelled,
         )
-
-        # Combine non-recurring events with expanded recurring ones
-        all_events = query.filter(Event.discriminator == "event").all() + expanded
+        overrides = prefetch_overrides(db_session, [r for r, _, _ in windows])
+        single_events = query.filter(Event.discriminator == "event")
 
         if view == "count":
-            return {"count": len(all_events)}
-
-        all_events = sorted(all_events, key=lambda e: e.start)
+            count = single_events.count()
+            for r, start, end in windows:
+                count += count_occurrences(r, overrides[r.id], start, end)
+            return {"count": count}
+
+        # Combine non-recurring events with expanded recurring ones. Every
+        # stream is ordered by start time, so they can be merged lazily and
+        # expansion stops once `limit` events were found.
+        offset = offset or 0
+        single_events = single_events.order_by(asc(Event.start), asc(Event.id))
+        if limit:
+            single_events = single_events.limit(offset + limit)
+        streams = [single_events] + [
+            iter_occurrences(r, overrides[r.id], start, end)
+            for r, start, end in windows
+        ]
+        all_events = heapq.merge(*streams, key=lambda e: e.start)
         if limit:
-            offset = offset or 0
-            all_events = all_events[offset : offset + limit]
+            all_events = itertools.islice(all_events, offset, offset + limit)
+        all_events = list(all_events)
     else:
         if view == "count":
             return {"count": query.one()[0]}
-        query = query.order_by(asc(Event.start)).limit(limit)
+        after = _page_after(page_token, datetime, int)
+        if after is not None:
+            # Page tokens hold naive UTC datetimes, like the column.
+            start, event_id = after
+            start = arrow.get(start).to("utc").naive
+            query = query.filter(
+                or_(
+                    Event.start > start, and_(Event.start == start, Event.id > event_id)
+                )
+            )
+        query = query.order_by(asc(Event.start), asc(Event.id)).limit(limit)
         if offset:
             query = query.offset(offset)
-        # Eager-load some objects in order to make constructing API
-        # representations faster.
-        all_events = query.all()
+        return _page(query.all(), limit, view, "start", "id")
 
     if view == "ids":
-        return [x[0] for x in all_events]
+        return [e.public_id for e in all_events]
     else:
         return all_events
 
 
-def messages_for_contact_scores(db_session, namespace_id, starts_after=None):
+def messages_for_contact_scores(
+    db_session, namespace_id, starts_after=None, after_id=None
+):
     query = (
         db_session.query(
             Message.to_addr,
@@ -808,6 +1000,9 @@ def messages_for_contact_scores(db_session, namespace_id, starts_after=None):
     if starts_after:
         query = query.filter(Message.received_date > starts_after)
 
+    if after_id is not None:
+        query = query.filter(Message.id > after_id).order_by(Message.id)
+
     return query.all()
 
 
@@ -864,42 +1059,56 @@ def page_over_shards(Model, cursor, limit, get_results=lambda q: q.all()):
     # TODO revisit passing lambda, and cursor format
     cursor = int(cursor)
     start_shard_id = engine_manager.shard_key_for_id(cursor)
+    start_engine = engine_manager.engines.get(start_shard_id)
+    shard_ids = [
+        shard_id
+        for shard_id in sorted(engine_manager.engines)
+        if shard_id >= start_shard_id
+    ]
+
+    def query_shard(mailsync_session, limit):
+        query = mailsync_session.query(Model)
+        if cursor and mailsync_session.bind is start_engine:
+            query = query.filter(Model.id > cursor)
+        return get_results(query.order_by(asc(Model.id)).limit(limit))
+
+    def query_shards_for(shard_ids, limit):
+        return list(
+            zip(
+                shard_ids,
+                query_shards(lambda session: query_shard(session, limit), shard_ids),
+            )
+        )
+
+    # The start shard usually fills the page on its own, so it's queried
+    # first. If it doesn't, the later shards are queried at once, each for
+    # what's left of the page. Ids increase with the shard id, so the results
+    # of the shards are in id order when taken shard by shard.
+    shard_results = query_shards_for(shard_ids[:1], limit)
+    found = sum(len(latest_results) for _, latest_results in shard_results)
+    if found < limit and len(shard_ids) > 1:
+        shard_results += query_shards_for(shard_ids[1:], limit - found)
+
     results = []
-    remaining_limit = limit
     next_cursor = None
-    for shard_id in sorted(engine_manager.engines):
-        if shard_id < start_shard_id:
+    for shard_id, latest_results in shard_results:
+        latest_results = latest_results[: limit - len(results)]
+        if not latest_results:
             continue
 
-        if len(results) >= limit:
-            break
-
-        with session_scope_by_shard_id(shard_id) as mailsync_session:
-            latest_cursor = cursor if shard_id == start_shard_id else None
-            query = mailsync_session.query(Model)
-            if latest_cursor:
-                query = query.filter(Model.id > latest_cursor)
-            query = query.order_by(asc(Model.id)).limit(remaining_limit)
-            latest_results = get_results(query)
-
-            if latest_results:
-                results.extend(latest_results)
-                last = latest_results[-1]
-                if hasattr(last, "id"):
-                    next_cursor = last.id
-                elif "id" in last:
-                    next_cursor = last["id"]
-                else:
-                    raise ValueError(
-                        "Results returned from get_query must" "have an id"
-                    )
-
-                # Handle invalid ids
-                cursor_implied_shard = next_cursor >> 48
-                if shard_id != 0 and cursor_implied_shard == 0:
-                    next_cursor += shard_id << 48
-
-                remaining_limit -= len(latest_results)
+        results.extend(latest_results)
+        last = latest_results[-1]
+        if hasattr(last, "id"):
+            next_cursor = last.id
+        elif "id" in last:
+            next_cursor = last["id"]
+        else:
+            raise ValueError("Results returned from get_query must" "have an id")
+
+        # Handle invalid ids
+        cursor_implied_shard = next_cursor >> 48
+        if shard_id != 0 and cursor_implied_shard == 0:
+            next_cursor += shard_id << 48
     return results, str(next_cursor)
 
 
@@ -6,6 +6,7 @@ import arrow
 from flask import Response
 from future.utils import iteritems
 
+from inbox.config import config
 from inbox.events.timezones import timezones_table
 from inbox.logging import get_logger
 from inbox.models import (
@@ -25,6 +26,20 @@ from inbox.models.event import InflatedEvent, RecurringEvent, RecurringEventOver
 
 log = get_logger()
 
+# The library that API responses are serialized with: "json" (the standard library)
+# or "orjson", which is considerably faster but has to be installed
+# separately. orjson's output is equivalent but not byte-identical: it's
+# compact, UTF-8 rather than ASCII-escaped, and pretty-printed with 2-space
+# indentation.
+API_JSON_BACKEND = config.get("API_JSON_BACKEND", "json")
+try:
+    import orjson
+except ImportError:
+    orjson = None
+if API_JSON_BACKEND == "orjson" and orjson is None:
+    log.warning("orjson isn't installed, falling back to json")
+    API_JSON_BACKEND = "json"
+
 
 def format_address_list(addresses):
     if addresses is None:
@@ -94,6 +109,63 @@ def _convert_timezone_to_iana_tz(original_tz):
         return original_tz
 
 
+# Serializer factories by the model (or other) type they handle. See
+# `serializer`.
+_serializers = {}
+# Serializers compiled for a concrete type and set of options, so that
+# dispatch is a single dict lookup rather than a chain of isinstance checks,
+# and branches on the type and options are taken once rather than per object.
+_compiled_serializers = {}
+
+
+def serializer(*types):
+    """
+    Register the decorated function as the serializer factory for objects of
+    the given types and their subclasses.
+
+    It's called once per concrete type and set of options, as
+    f(type_, expand, is_n1), and returns the function that serializes those
+    objects, which is called as serialize(obj, namespace_public_id).
+
+    """
+
+    def register(f):
+        for type_ in types:
+            _serializers[type_] = f
+        _compiled_serializers.clear()
+        return f
+
+    return register
+
+
+def plain_serializer(*types):
+    """
+    Like `serializer`, for serializers that don't depend on the type or the
+    options: register the decorated f(obj, namespace_public_id) itself.
+
+    """
+
+    def register(f):
+        serializer(*types)(lambda type_, expand, is_n1: f)
+        return f
+
+    return register
+
+
+def _serializer_for(type_, expand=False, is_n1=False):
+    key = (type_, bool(expand), bool(is_n1))
+    try:
+        return _compiled_serializers[key]
+    except KeyError:
+        compiled = None
+        for base in type_.__mro__:
+            if base in _serializers:
+                compiled = _serializers[base](*key)
+                break
+        _compiled_serializers[key] = compiled
+        return compiled
+
+
 def _encode(obj, namespace_public_id=None, expand=False, is_n1=False):
     """
     Returns a dictionary representation of a Nylas model object obj, or
@@ -113,35 +185,47 @@ def _encode(obj, namespace_public_id=None, expand=False, is_n1=False):
     dictionary or None
 
     """
+    serialize = _serializer_for(type(obj), expand, is_n1)
+    if serialize is None:
+        return None
+    return serialize(obj, namespace_public_id)
+
+
+def _get_namespace_public_id(obj, namespace_public_id):
+    return namespace_public_id or obj.namespace.public_id
+
+
+def _format_participant_data(participant):
+    """Event.participants is a JSON blob which may contain internal data.
+    This function returns a dict with only the data we want to make
+    public."""
+    dct = {}
+    for attribute in ["name", "status", "email", "comment"]:
+        dct[attribute] = participant.get(attribute)
+
+    return dct
 
-    def _get_namespace_public_id(obj):
-        return namespace_public_id or obj.namespace.public_id
 
-    def _format_participant_data(participant):
-        """Event.participants is a JSON blob which may contain internal data.
-        This function returns a dict with only the data we want to make
-        public."""
-        dct = {}
-        for attribute in ["name", "status", "email", "comment"]:
-            dct[attribute] = participant.get(attribute)
+# Flask's jsonify() doesn't handle datetimes or json arrays as primary
+# objects.
+@plain_serializer(datetime.datetime)
+def _encode_datetime(obj, namespace_public_id):
+    return calendar.timegm(obj.utctimetuple())
 
-        return dct
 
-    def _get_lowercase_class_name(obj):
-        return type(obj).__name__.lower()
+@plain_serializer(datetime.date)
+def _encode_date(obj, namespace_public_id):
+    return obj.isoformat()
 
-    # Flask's jsonify() doesn't handle datetimes or json arrays as primary
-    # objects.
-    if isinstance(obj, datetime.datetime):
-        return calendar.timegm(obj.utctimetuple())
 
-    if isinstance(obj, datetime.date):
-        return obj.isoformat()
+@plain_serializer(arrow.arrow.Arrow)
+def _encode_arrow(obj, namespace_public_id):
+    return encode(obj.datetime)
 
-    if isinstance(obj, arrow.arrow.Arrow):
-        return encode(obj.datetime)
 
-    if isinstance(obj, Namespace):  # These are now "accounts"
+@serializer(Namespace)  # These are now "accounts"
+def _namespace_serializer(type_, expand, is_n1):
+    def serialize(obj, namespace_public_id):
         acc_state = obj.account.sync_state
         if acc_state is None:
             acc_state = "running"
@@ -165,18 +249,42 @@ def _encode(obj, namespace_public_id=None, expand=False, is_n1=False):
             resp["server_settings"] = obj.account.server_settings
         return resp
 
-    elif isinstance(obj, Account):
-        raise Exception("Should never be serializing accounts")
+    return serialize
+
+
+@plain_serializer(Account)
+def _encode_account(obj, namespace_public_id):
+    raise Exception("Should never be serializing accounts")
+
+
+def _format_draft(resp, msg):
+    # If the message is a draft (Nylas-created or otherwise):
+    resp["object"] = "draft"
+    resp["version"] = msg.version
+    if msg.reply_to_message is not None:
+        resp["reply_to_message_id"] = msg.reply_to_message.public_id
+    else:
+        resp["reply_to_message_id"] = None
+
 
-    elif isinstance(obj, Message):
+def _format_headers(msg):
+    return {
+        "Message-Id": msg.message_id_header,
+        "In-Reply-To": msg.in_reply_to,
+        "References": msg.references,
+    }
+
+
+@serializer(Message)
+def _message_serializer(type_, expand, is_n1):
+    def serialize(obj, namespace_public_id):
         thread_public_id = None
         if obj.thread:
             thread_public_id = obj.thread.public_id
-
         resp = {
             "id": obj.public_id,
             "object": "message",
-            "account_id": _get_namespace_public_id(obj),
+            "account_id": _get_namespace_public_id(obj, namespace_public_id),
             "subject": obj.subject,
             "from": format_address_list(obj.from_addr),
             "reply_to": format_address_list(obj.reply_to),
@@ -199,115 +307,121 @@ def _encode(obj, namespace_public_id=None, expand=False, is_n1=False):
         else:
             resp["labels"] = categories
 
-        # If the message is a draft (Nylas-created or otherwise):
         if obj.is_draft:
-            resp["object"] = "draft"
-            resp["version"] = obj.version
-            if obj.reply_to_message is not None:
-                resp["reply_to_message_id"] = obj.reply_to_message.public_id
-            else:
-                resp["reply_to_message_id"] = None
+            _format_draft(resp, obj)
 
         if expand:
-            resp["headers"] = {
-                "Message-Id": obj.message_id_header,
-                "In-Reply-To": obj.in_reply_to,
-                "References": obj.references,
-            }
+            resp["headers"] = _format_headers(obj)
 
         return resp
 
-    elif isinstance(obj, Thread):
-        base = {
-            "id": obj.public_id,
-            "object": "thread",
-            "account_id": _get_namespace_public_id(obj),
-            "subject": obj.subject,
-            "participants": format_address_list(obj.participants),
-            "last_message_timestamp": obj.recentdate,
-            "last_message_received_timestamp": obj.most_recent_received_date,
-            "last_message_sent_timestamp": obj.most_recent_sent_date,
-            "first_message_timestamp": obj.subjectdate,
-            "snippet": obj.snippet,
-            "unread": obj.unread,
-            "starred": obj.starred,
-            "has_attachments": obj.has_attachments,
-            "version": obj.version,
+    return serialize
+
+
+def _format_thread(obj, namespace_public_id):
+    base = {
+        "id": obj.public_id,
+        "object": "thread",
+        "account_id": _get_namespace_public_id(obj, namespace_public_id),
+        "subject": obj.subject,
+        "participants": format_address_list(obj.participants),
+        "last_message_timestamp": obj.recentdate,
+        "last_message_received_timestamp": obj.most_recent_received_date,
+        "last_message_sent_timestamp": obj.most_recent_sent_date,
+        "first_message_timestamp": obj.subjectdate,
+        "snippet": obj.snippet,
+        "unread": obj.unread,
+        "starred": obj.starred,
+        "has_attachments": obj.has_attachments,
+        "version": obj.version,
+    }
+
+    categories = format_categories(obj.categories)
+    is_folder = obj.namespace.account.category_type == "folder"
+    if is_folder:
+        base["folders"] = categories
+    else:
+        base["labels"] = categories
+    return base, is_folder
+
+
+def _encode_thread(obj, namespace_public_id):
+    base, _ = _format_thread(obj, namespace_public_id)
+    base["message_ids"] = [m.public_id for m in obj.messages if not m.is_draft]
+    base["draft_ids"] = [m.public_id for m in obj.drafts]
+    return base
+
+
+def _encode_expanded_thread(obj, namespace_public_id):
+    base, is_folder = _format_thread(obj, namespace_public_id)
+
+    # Expand messages within threads
+    all_expanded_messages = []
+    all_expanded_drafts = []
+    for msg in obj.messages:
+        resp = {
+            "id": msg.public_id,
+            "object": "message",
+            "account_id": _get_namespace_public_id(msg, namespace_public_id),
+            "subject": msg.subject,
+            "from": format_address_list(msg.from_addr),
+            "reply_to": format_address_list(msg.reply_to),
+            "to": format_address_list(msg.to_addr),
+            "cc": format_address_list(msg.cc_addr),
+            "bcc": format_address_list(msg.bcc_addr),
+            "date": msg.received_date,
+            "thread_id": obj.public_id,
+            "snippet": msg.snippet,
+            "unread": not msg.is_read,
+            "starred": msg.is_starred,
+            "files": msg.api_attachment_metadata,
         }
+        resp["headers"] = _format_headers(msg)
+        categories = format_messagecategories(msg.messagecategories)
+        if is_folder:
+            resp["folder"] = categories[0] if categories else None
+        else:
+            resp["labels"] = categories
 
-        categories = format_categories(obj.categories)
-        if obj.namespace.account.category_type == "folder":
-            base["folders"] = categories
+        if msg.is_draft:
+            _format_draft(resp, msg)
+            all_expanded_drafts.append(resp)
         else:
-            base["labels"] = categories
-
-        if not expand:
-            base["message_ids"] = [m.public_id for m in obj.messages if not m.is_draft]
-            base["draft_ids"] = [m.public_id for m in obj.drafts]
-            return base
-
-        # Expand messages within threads
-        all_expanded_messages = []
-        all_expanded_drafts = []
-        for msg in obj.messages:
-            resp = {
-                "id": msg.public_id,
-                "object": "message",
-                "account_id": _get_namespace_public_id(msg),
-                "subject": msg.subject,
-                "from": format_address_list(msg.from_addr),
-                "reply_to": format_address_list(msg.reply_to),
-                "to": format_address_list(msg.to_addr),
-                "cc": format_address_list(msg.cc_addr),
-                "bcc": format_address_list(msg.bcc_addr),
-                "date": msg.received_date,
-                "thread_id": obj.public_id,
-                "snippet": msg.snippet,
-                "unread": not msg.is_read,
-                "starred": msg.is_starred,
-                "files": msg.api_attachment_metadata,
-            }
-            resp["headers"] = {
-                "Message-Id": msg.message_id_header,
-                "In-Reply-To": msg.in_reply_to,
-                "References": msg.references,
-            }
-            categories = format_messagecategories(msg.messagecategories)
-            if obj.namespace.account.category_type == "folder":
-                resp["folder"] = categories[0] if categories else None
-            else:
-                resp["labels"] = categories
-
-            if msg.is_draft:
-                resp["object"] = "draft"
-                resp["version"] = msg.version
-                if msg.reply_to_message is not None:
-                    resp["reply_to_message_id"] = msg.reply_to_message.public_id
-                else:
-                    resp["reply_to_message_id"] = None
-                all_expanded_drafts.append(resp)
-            else:
-                all_expanded_messages.append(resp)
-
-        base["messages"] = all_expanded_messages
-        base["drafts"] = all_expanded_drafts
-        return base
-
-    elif isinstance(obj, Contact):
-        return {
-            "id": obj.public_id,
-            "object": "contact",
-            "account_id": _get_namespace_public_id(obj),
-            "name": obj.name,
-            "email": obj.email_address,
-            "phone_numbers": format_phone_numbers(obj.phone_numbers),
-        }
+            all_expanded_messages.append(resp)
+
+    base["messages"] = all_expanded_messages
+    base["drafts"] = all_expanded_drafts
+    return base
+
+
+@serializer(Thread)
+def _thread_serializer(type_, expand, is_n1):
+    return _encode_expanded_thread if expand else _encode_thread
+
+
+@plain_serializer(Contact)
+def _encode_contact(obj, namespace_public_id):
+    return {
+        "id": obj.public_id,
+        "object": "contact",
+        "account_id": _get_namespace_public_id(obj, namespace_public_id),
+        "name": obj.name,
+        "email": obj.email_address,
+        "phone_numbers": format_phone_numbers(obj.phone_numbers),
+    }
 
-    elif isinstance(obj, Event):
+
+@serializer(Event)
+def _event_serializer(type_, expand, is_n1):
+    is_recurring = issubclass(type_, RecurringEvent)
+    is_override = issubclass(type_, RecurringEventOverride)
+    is_inflated = issubclass(type_, InflatedEvent)
+
+    def serialize(obj, namespace_public_id):
         resp = {
             "id": obj.public_id,
             "object": "event",
-            "account_id": _get_namespace_public_id(obj),
+            "account_id": _get_namespace_public_id(obj, namespace_public_id),
             "calendar_id": obj.calendar.public_id if obj.calendar else None,
             "message_id": obj.message.public_id if obj.message else None,
             "title": obj.title,
@@ -329,17 +443,17 @@ def _encode(obj, namespace_public_id=None, expand=False, is_n1=False):
             "uid": obj.uid,
             "calendar_event_link": obj.calendar_event_link,
         }
-        if isinstance(obj, RecurringEvent):
+        if is_recurring:
             resp["recurrence"] = {
                 "rrule": obj.recurring,
                 "timezone": _convert_timezone_to_iana_tz(obj.start_timezone),
             }
-        if isinstance(obj, RecurringEventOverride):
+        if is_override:
             resp["original_start_time"] = encode(obj.original_start_time)
             resp["master_event_uid"] = obj.master_event_uid
             if obj.master:
                 resp["master_event_id"] = obj.master.public_id
-        if isinstance(obj, InflatedEvent):
+        if is_inflated:
             del resp["message_id"]
             if obj.master:
                 resp["master_event_id"] = obj.master.public_id
@@ -348,71 +462,109 @@ def _encode(obj, namespace_public_id=None, expand=False, is_n1=False):
                     resp["calendar_id"] = obj.master.calendar.public_id
         return resp
 
-    elif isinstance(obj, Calendar):
-        return {
-            "id": obj.public_id,
-            "object": "calendar",
-            "account_id": _get_namespace_public_id(obj),
-            "name": obj.name,
-            "description": obj.description,
-            "read_only": obj.read_only,
-            "uid": obj.uid,
-        }
-
-    elif isinstance(obj, When):
-        # Get time dictionary e.g. 'start_time': x, 'end_time': y or 'date': z
-        times = obj.get_time_dict()
-        resp = {k: encode(v) for k, v in iteritems(times)}
-        resp["object"] = _get_lowercase_class_name(obj)
-        return resp
+    return serialize
 
-    elif isinstance(obj, Block):  # ie: Attachments/Files
-        resp = {
-            "id": obj.public_id,
-            "object": "file",
-            "account_id": _get_namespace_public_id(obj),
-            "content_type": obj.content_type,
-            "size": obj.size,
-            "filename": obj.filename,
-        }
-        if len(obj.parts):
-            # if obj is actually a message attachment (and not merely an
-            # uploaded file), set additional properties
-            resp.update({"message_ids": [p.message.public_id for p in obj.parts]})
 
-            content_ids = list(
-                {p.content_id for p in obj.parts if p.content_id is not None}
-            )
-            content_id = None
-            if len(content_ids) > 0:
-                content_id = content_ids[0]
+@plain_serializer(Calendar)
+def _encode_calendar(obj, namespace_public_id):
+    return {
+        "id": obj.public_id,
+        "object": "calendar",
+        "account_id": _get_namespace_public_id(obj, namespace_public_id),
+        "name": obj.name,
+        "description": obj.description,
+        "read_only": obj.read_only,
+        "uid": obj.uid,
+    }
 
-            resp.update({"content_id": content_id})
 
-        return resp
+@serializer(When)
+def _when_serializer(type_, expand, is_n1):
+    object_name = type_.__name__.lower()
 
-    elif isinstance(obj, Category):
-        # 'object' is set to 'folder' or 'label'
-        resp = {
-            "id": obj.public_id,
-            "object": obj.type,
-            "account_id": _get_namespace_public_id(obj),
-            "name": obj.name or None,
-            "display_name": obj.api_display_name,
-        }
+    def serialize(obj, namespace_public_id):
+        # Get time dictionary e.g. 'start_time': x, 'end_time': y or 'date': z
+        times = obj.get_time_dict()
+        resp = {k: encode(v) for k, v in iteritems(times)}
+        resp["object"] = object_name
         return resp
 
-    elif isinstance(obj, Metadata):
-        resp = {
-            "id": obj.public_id,
-            "account_id": _get_namespace_public_id(obj),
-            "application_id": obj.app_client_id,
-            "object_type": obj.object_type,
-            "object_id": obj.object_public_id,
-            "version": obj.version,
-            "value": obj.value,
-        }
-        return resp
+    return serialize
+
+
+@plain_serializer(Block)  # ie: Attachments/Files
+def _encode_block(obj, namespace_public_id):
+    resp = {
+        "id": obj.public_id,
+        "object": "file",
+        "account_id": _get_namespace_public_id(obj, namespace_public_id),
+        "content_type": obj.content_type,
+        "size": obj.size,
+        "filename": obj.filename,
+    }
+    if len(obj.parts):
+        # if obj is actually a message attachment (and not merely an
+        # uploaded file), set additional properties
+        resp.update({"message_ids": [p.message.public_id for p in obj.parts]})
+
+        content_ids = list(
+            {p.content_id for p in obj.parts if p.content_id is not None}
+        )
+        content_id = None
+        if len(content_ids) > 0:
+            content_id = content_ids[0]
+
+        resp.update({"content_id": content_id})
+
+    return resp
+
+
+@plain_serializer(Category)
+def _encode_category(obj, namespace_public_id):
+    # 'object' is set to 'folder' or 'label'
+    resp = {
+        "id": obj.public_id,
+        "object": obj.type,
+        "account_id": _get_namespace_public_id(obj, namespace_public_id),
+        "name": obj.name or None,
+        "display_name": obj.api_display_name,
+    }
+    return resp
+
+
+@plain_serializer(Metadata)
+def _encode_metadata(obj, namespace_public_id):
+    resp = {
+        "id": obj.public_id,
+        "account_id": _get_namespace_public_id(obj, namespace_public_id),
+        "application_id": obj.app_client_id,
+        "object_type": obj.object_type,
+        "object_id": obj.object_public_id,
+        "version": obj.version,
+        "value": obj.value,
+    }
+    return resp
+
+
+class _APIJSONEncoder(JSONEncoder):
+    # A single JSONEncoder subclass shared by all APIEncoders, which pass
+    # themselves in rather than closing over their options in a class of
+    # their own.
+    def __init__(self, api_encoder, **kwargs):
+        super(_APIJSONEncoder, self).__init__(**kwargs)
+        self.api_encoder = api_encoder
+
+    def default(self, obj):
+        custom_representation = encode(
+            obj,
+            self.api_encoder.namespace_public_id,
+            expand=self.api_encoder.expand,
+            is_n1=self.api_encoder.is_n1,
+        )
+        if custom_representation is not None:
+            return custom_representation
+        # Let the base class default method raise the TypeError
+        return JSONEncoder.default(self, obj)
 
 
 class APIEncoder(object):
@@ -432,22 +584,24 @@ class APIEncoder(object):
     """
 
     def __init__(self, namespace_public_id=None, expand=False, is_n1=False):
-        self.encoder_class = self._encoder_factory(
-            namespace_public_id, expand, is_n1=is_n1
+        self.namespace_public_id = namespace_public_id
+        self.expand = expand
+        self.is_n1 = is_n1
+        self.encoder_class = _APIJSONEncoder
+
+    def _default(self, obj):
+        # orjson only serializes exact tuples as arrays; the standard library
+        # serializes subclasses (e.g. namedtuples) as arrays too.
+        if isinstance(obj, tuple):
+            return list(obj)
+        custom_representation = encode(
+            obj, self.namespace_public_id, expand=self.expand, is_n1=self.is_n1
+        )
+        if custom_representation is not None:
+            return custom_representation
+        raise TypeError(
+            "Object of type {} is not JSON serializable".format(type(obj).__name__)
         )
-
-    def _encoder_factory(self, namespace_public_id, expand, is_n1=False):
-        class InternalEncoder(JSONEncoder):
-            def default(self, obj):
-                custom_representation = encode(
-                    obj, namespace_public_id, expand=expand, is_n1=is_n1
-                )
-                if custom_representation is not None:
-                    return custom_representation
-                # Let the base class default method raise the TypeError
-                return JSONEncoder.default(self, obj)
-
-        return InternalEncoder
 
     def cereal(self, obj, pretty=False):
         """
@@ -465,6 +619,13 @@ class APIEncoder(object):
             If obj is not serializable.
 
         """
+        if API_JSON_BACKEND == "orjson":
+            option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+            if pretty:
+                # orjson only indents by 2 spaces.
+                option |= orjson.OPT_SORT_KEYS | orjson.OPT_INDENT_2
+            return orjson.dumps(obj, default=self._default, option=option).decode()
+
         if pretty:
             return dumps(
                 obj,
@@ -472,8 +633,9 @@ class APIEncoder(object):
                 indent=4,
                 separators=(",", ": "),
                 cls=self.encoder_class,
+                api_encoder=self,
             )
-        return dumps(obj, cls=self.encoder_class)
+        return dumps(obj, cls=self.encoder_class, api_encoder=self)
 
     def jsonify(self, obj):
         """
@@ -57,6 +57,7 @@ from inbox.api.validation import (
     limit,
     noop_event_update,
     offset,
+    page_token,
     strict_bool,
     strict_parse_args,
     timestamp,
@@ -77,6 +78,7 @@ from inbox.contacts.algorithms import (
     calculate_group_scores,
     is_stale,
 )
+from inbox.contacts.rankings import CONTACT_RANKINGS_ENGINE_ENABLED, ContactAggregates
 from inbox.contacts.search import ContactSearchClient
 from inbox.crispin import writable_connection_pool
 from inbox.events.ical import generate_rsvp, send_rsvp
@@ -120,6 +122,11 @@ from inbox.sendmail.base import (
     update_draft,
 )
 from inbox.transactions import delta_sync
+from inbox.transactions.watcher import (
+    DELTA_NOTIFICATIONS_ENABLED,
+    DELTA_NOTIFICATIONS_FALLBACK_INTERVAL,
+    get_transaction_watcher,
+)
 from inbox.util import blockstore
 from inbox.util.misc import imap_folder_path
 from inbox.util.stats import statsd_client
@@ -136,6 +143,8 @@ from inbox.logging import get_logger
 log = get_logger()
 
 DEFAULT_LIMIT = 100
+# Response header carrying the token for the next page of a listing.
+NEXT_PAGE_TOKEN_HEADER = "X-Next-Page-Token"
 LONG_POLL_REQUEST_TIMEOUT = 120
 LONG_POLL_POLL_INTERVAL = 1
 SEND_TIMEOUT = 60
@@ -214,6 +223,14 @@ def start():
     g.parser.add_argument("offset", default=0, type=offset, location="args")
 
 
+def paged_response(response, page):
+    """Add the token for the next page of a listing, if any, to the response."""
+    next_page_token = getattr(page, "next_page_token", None)
+    if next_page_token is not None:
+        response.headers[NEXT_PAGE_TOKEN_HEADER] = next_page_token
+    return response
+
+
 @app.before_request
 def before_remote_request():
     """
@@ -361,6 +378,7 @@ def thread_query_api():
     g.parser.add_argument("unread", type=strict_bool, location="args")
     g.parser.add_argument("starred", type=strict_bool, location="args")
     g.parser.add_argument("view", type=view, location="args")
+    g.parser.add_argument("page_token", type=page_token, location="args")
 
     args = strict_parse_args(g.parser, request.args)
 
@@ -386,11 +404,12 @@ def thread_query_api():
         offset=args["offset"],
         view=args["view"],
         db_session=g.db_session,
+        page_token=args["page_token"],
     )
 
     # Use a new encoder object with the expand parameter set.
     encoder = APIEncoder(g.namespace.public_id, args["view"] == "expanded")
-    return encoder.jsonify(threads)
+    return paged_response(encoder.jsonify(threads), threads)
 
 
 @app.route("/threads/search", methods=["GET"])
@@ -527,6 +546,7 @@ def message_query_api():
     g.parser.add_argument("unread", type=strict_bool, location="args")
     g.parser.add_argument("starred", type=strict_bool, location="args")
     g.parser.add_argument("view", type=view, location="args")
+    g.parser.add_argument("page_token", type=page_token, location="args")
 
     args = strict_parse_args(g.parser, request.args)
 
@@ -554,11 +574,12 @@ def message_query_api():
         offset=args["offset"],
         view=args["view"],
         db_session=g.db_session,
+        page_token=args["page_token"],
     )
 
     # Use a new encoder object with the expand parameter set.
     encoder = APIEncoder(g.namespace.public_id, args["view"] == "expanded")
-    return encoder.jsonify(messages)
+    return paged_response(encoder.jsonify(messages), messages)
 
 
 @app.route("/messages/search", methods=["GET"])
@@ -614,6 +635,73 @@ def message_streaming_search_api():
         return err(store_status.http_code, store_status.meaning, **kwargs)
 
 
+def _blockstore_response(data_sha256, mimetype, headers=None):
+    """
+    Stream a blob out of the blockstore, honoring conditional (ETag is the
+    blob's sha256) and single-range requests.
+
+    Returns None if the blob isn't in the blockstore, or is small and doesn't
+    match its sha256, so that callers can fall back to fetching it some other
+    way. Larger blobs are verified as they are streamed and the response is
+    cut short if they don't match.
+    """
+    if not data_sha256:
+        return None
+
+    if request.if_none_match.contains_weak(data_sha256):
+        response = Response(status=304, headers=headers)
+        response.set_etag(data_sha256)
+        return response
+
+    reader = blockstore.open_blockstore_stream(data_sha256)
+    if reader is None:
+        return None
+
+    start, stop, status = 0, reader.size, 200
+    byte_range = request.range
+    if_range = request.if_range
+    if (
+        byte_range is not None
+        and len(byte_range.ranges) == 1
+        and (
+            (if_range.etag is None and if_range.date is None)
+            or if_range.etag == data_sha256
+        )
+    ):
+        requested = byte_range.range_for_length(reader.size)
+        if requested is None:
+            reader.close()
+            response = Response(status=416, headers=headers)
+            response.headers["Content-Range"] = "bytes */{}".format(reader.size)
+            return response
+        start, stop = requested
+        status = 206
+
+    if reader.size <= blockstore.STREAM_VERIFY_MAX_SIZE:
+        # Small enough to verify before any of it is sent. If it doesn't
+        # match, fall back like we do for missing blobs.
+        try:
+            body = [reader.read()[start:stop]]
+        except blockstore.BlockstoreHashMismatch:
+            return None
+    else:
+        body = reader.iter_chunks(start, stop)
+
+    response = Response(
+        body, status=status, mimetype=mimetype, headers=headers, direct_passthrough=True
+    )
+    # The body may never be iterated, e.g. for HEAD requests.
+    response.call_on_close(reader.close)
+    response.set_etag(data_sha256)
+    response.headers["Accept-Ranges"] = "bytes"
+    response.headers["Content-Length"] = str(stop - start)
+    if status == 206:
+        response.headers["Content-Range"] = "bytes {}-{}/{}".format(
+            start, stop - 1, reader.size
+        )
+    return response
+
+
 @app.route("/messages/<public_id>", methods=["GET"])
 def message_read_api(public_id):
     g.parser.add_argument("view", type=view, location="args")
@@ -627,9 +715,9 @@ def message_read_api(public_id):
         raise NotFoundError("Couldn't find message {0}".format(public_id))
 
     if request.headers.get("Accept", None) == "message/rfc822":
-        raw_message = blockstore.get_from_blockstore(message.data_sha256)
-        if raw_message is not None:
-            return Response(raw_message, mimetype="message/rfc822")
+        response = _blockstore_response(message.data_sha256, "message/rfc822")
+        if response is not None:
+            return response
         else:
             # Try getting the message from the email provider.
             account = g.namespace.account
@@ -1047,6 +1135,7 @@ def event_api():
     g.parser.add_argument("owner_email", type=bounded_str, location="args")
     g.parser.add_argument("participant_email", type=bounded_str, location="args")
     g.parser.add_argument("any_email", type=bounded_str, location="args")
+    g.parser.add_argument("page_token", type=page_token, location="args")
 
     args = strict_parse_args(g.parser, request.args)
 
@@ -1073,9 +1162,10 @@ def event_api():
         expand_recurring=args["expand_recurring"],
         show_cancelled=args["show_cancelled"],
         db_session=g.db_session,
+        page_token=args["page_token"],
     )
 
-    return g.encoder.jsonify(results)
+    return paged_response(g.encoder.jsonify(results), results)
 
 
 @app.route("/events/", methods=["POST"])
@@ -1406,6 +1496,7 @@ def files_api():
     g.parser.add_argument("message_id", type=valid_public_id, location="args")
     g.parser.add_argument("content_type", type=bounded_str, location="args")
     g.parser.add_argument("view", type=view, location="args")
+    g.parser.add_argument("page_token", type=page_token, location="args")
 
     args = strict_parse_args(g.parser, request.args)
 
@@ -1418,9 +1509,10 @@ def files_api():
         offset=args["offset"],
         view=args["view"],
         db_session=g.db_session,
+        page_token=args["page_token"],
     )
 
-    return g.encoder.jsonify(files)
+    return paged_response(g.encoder.jsonify(files), files)
 
 
 @app.route("/files/<public_id>", methods=["GET"])
@@ -1527,8 +1619,13 @@ def file_download_api(public_id):
             # HACK just append the major part of the content type
             name = "attachment.{0}".format(ct.split("/")[0])
 
-    # TODO the part.data object should really behave like a stream we can read
-    # & write to
+    # Stream the file straight out of the blockstore if it's there; only fall
+    # back to loading it into memory (and possibly refetching the message from
+    # the provider) if it isn't.
+    response = _blockstore_response(f.data_sha256, "application/octet-stream")
+    if response is not None:
+        return _attachment_response(response, name)
+
     try:
         account = g.namespace.account
         statsd_string = "api.direct_fetching.{}.{}".format(account.provider, account.id)
@@ -1572,6 +1669,10 @@ def file_download_api(public_id):
 
         return err(404, "Couldn't find data on email server.")
 
+    return _attachment_response(response, name)
+
+
+def _attachment_response(response, name):
     response.headers["Content-Type"] = "application/octet-stream"  # ct
     # Werkzeug will try to encode non-ascii header values as latin-1. Try that
     # first; if it fails, use RFC2047/MIME encoding. See
@@ -1660,6 +1761,7 @@ def draft_query_api():
     g.parser.add_argument("unread", type=strict_bool, location="args")
     g.parser.add_argument("starred", type=strict_bool, location="args")
     g.parser.add_argument("view", type=view, location="args")
+    g.parser.add_argument("page_token", type=page_token, location="args")
 
     args = strict_parse_args(g.parser, request.args)
 
@@ -1687,9 +1789,10 @@ def draft_query_api():
         offset=args["offset"],
         view=args["view"],
         db_session=g.db_session,
+        page_token=args["page_token"],
     )
 
-    return g.encoder.jsonify(drafts)
+    return paged_response(g.encoder.jsonify(drafts), drafts)
 
 
 @app.route("/drafts/<public_id>", methods=["GET"])
@@ -2017,6 +2120,7 @@ def sync_deltas():
     g.db_session.expunge(g.namespace)
     g.db_session.close()  # hack to close the flask session
     poll_interval = LONG_POLL_POLL_INTERVAL
+    last_seen_txnid = start_pointer
 
     start_time = time.time()
     while time.time() - start_time < timeout:
@@ -2046,7 +2150,18 @@ def sync_deltas():
 
         # No changes. perhaps wait
         elif "/delta/longpoll" in request.url_rule.rule:
-            gevent.sleep(poll_interval)
+            if DELTA_NOTIFICATIONS_ENABLED:
+                wait_time = min(
+                    DELTA_NOTIFICATIONS_FALLBACK_INTERVAL,
+                    start_time + timeout - time.time(),
+                )
+                txnid = get_transaction_watcher().wait(
+                    g.namespace.public_id, last_seen_txnid, max(0, wait_time)
+                )
+                if txnid is not None:
+                    last_seen_txnid = txnid
+            else:
+                gevent.sleep(poll_interval)
         else:  # Return immediately
             response["cursor_end"] = cursor
             response["timestamp"] = datetime.utcnow()
@@ -2191,6 +2306,28 @@ def stream_changes():
 ##
 
 
+def _update_contact_aggregates(dpcache, force_recalculate):
+    # Catch the namespace's ContactAggregates up with the sent messages synced
+    # since they were last updated. They're rebuilt from scratch once stale, so
+    # that messages that were deleted (or unmarked as sent) drop out of them.
+    rebuild = force_recalculate or is_stale(dpcache.contact_aggregates_rebuilt_at)
+    aggregates = None if rebuild else dpcache.contact_aggregates
+    if aggregates is None:
+        rebuild = True
+        aggregates = ContactAggregates()
+
+    messages = filtering.messages_for_contact_scores(
+        g.db_session, g.namespace.id, after_id=aggregates.last_message_id
+    )
+    if aggregates.add_messages(messages) or rebuild:
+        if rebuild:
+            dpcache.contact_aggregates_rebuilt_at = datetime.now()
+        dpcache.contact_aggregates = aggregates
+        g.db_session.add(dpcache)
+        g.db_session.commit()
+    return aggregates
+
+
 @app.route("/groups/intrinsic")
 def groups_intrinsic():
     g.parser.add_argument("force_recalculate", type=strict_bool, location="args")
@@ -2204,6 +2341,12 @@ def groups_intrinsic():
     except NoResultFound:
         dpcache = DataProcessingCache(namespace_id=g.namespace.id)
 
+    if CONTACT_RANKINGS_ENGINE_ENABLED:
+        aggregates = _update_contact_aggregates(dpcache, args["force_recalculate"])
+        result = aggregates.group_scores(g.namespace.email_address)
+        result = sorted(result.items(), key=lambda x: x[1], reverse=True)
+        return g.encoder.jsonify(result)
+
     last_updated = dpcache.contact_groups_last_updated
     cached_data = dpcache.contact_groups
 
@@ -2252,6 +2395,13 @@ def contact_rankings():
     except NoResultFound:
         dpcache = DataProcessingCache(namespace_id=g.namespace.id)
 
+    if CONTACT_RANKINGS_ENGINE_ENABLED:
+        aggregates = _update_contact_aggregates(dpcache, args["force_recalculate"])
+        result = sorted(
+            aggregates.contact_scores().items(), key=lambda x: x[1], reverse=True
+        )
+        return g.encoder.jsonify(result)
+
     last_updated = dpcache.contact_rankings_last_updated
     cached_data = dpcache.contact_rankings
 
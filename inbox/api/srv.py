@@ -23,8 +23,10 @@ from inbox.models.backends.generic import GenericAccount
 from inbox.models.backends.gmail import GOOGLE_EMAIL_SCOPE, GmailAccount
 from inbox.models.backends.outlook import OutlookAccount
 from inbox.models.secret import SecretType
-from inbox.models.session import global_session_scope
+from inbox.models.session import global_session_scope, session_scope
+from inbox.util.auth_cache import get_namespace_auth
 from inbox.util.logging_helper import reconfigure_logging
+from inbox.util.sharding import generate_open_shard_key
 from inbox.webhooks.gpush_notifications import app as webhooks_api
 
 from .metrics_api import app as metrics_api
@@ -93,24 +95,18 @@ def auth():
     else:
         namespace_public_id = request.authorization.username
 
-    with global_session_scope() as db_session:
-        try:
-            valid_public_id(namespace_public_id)
-            namespace = (
-                db_session.query(Namespace)
-                .filter(Namespace.public_id == namespace_public_id)
-                .one()
-            )
-            g.namespace_id = namespace.id
-            g.account_id = namespace.account.id
-        except NoResultFound:
-            return make_response(
-                (
-                    "Could not verify access credential.",
-                    401,
-                    {"WWW-Authenticate": 'Basic realm="API ' 'Access Token Required"'},
-                )
+    valid_public_id(namespace_public_id)
+    namespace_auth = get_namespace_auth(namespace_public_id)
+    if namespace_auth.deleted:
+        return make_response(
+            (
+                "Could not verify access credential.",
+                401,
+                {"WWW-Authenticate": 'Basic realm="API ' 'Access Token Required"'},
             )
+        )
+    g.namespace_id = namespace_auth.namespace_id
+    g.account_id = namespace_auth.account_id
 
 
 @app.after_request
@@ -123,6 +119,7 @@ def finish(response):
             "Access-Control-Allow-Methods"
         ] = "GET,PUT,POST,DELETE,OPTIONS,PATCH"
         response.headers["Access-Control-Allow-Credentials"] = "true"
+        response.headers["Access-Control-Expose-Headers"] = "X-Next-Page-Token"
     return response
 
 
@@ -254,7 +251,8 @@ def create_account():
     else:
         raise ValueError("Account type not supported.")
 
-    with global_session_scope() as db_session:
+    # New accounts are placed on a random open shard.
+    with session_scope(generate_open_shard_key()) as db_session:
         account = auth_handler.create_account(account_data)
         db_session.add(account)
         db_session.commit()
@@ -274,11 +272,16 @@ def modify_account(namespace_public_id):
     data = request.get_json(force=True)
 
     with global_session_scope() as db_session:
-        namespace = (
-            db_session.query(Namespace)
+        namespace_id = (
+            db_session.query(Namespace.id)
             .filter(Namespace.public_id == namespace_public_id)
-            .one()
+            .one()[0]
         )
+
+    # Updating the account may create objects (e.g. a new secret), which
+    # needs a session of the account's shard.
+    with session_scope(namespace_id) as db_session:
+        namespace = db_session.query(Namespace).get(namespace_id)
         account = namespace.account
 
         if isinstance(account, GenericAccount):
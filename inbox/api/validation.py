@@ -1,5 +1,8 @@
 """Utilities for validating user input to the API."""
+import base64
+import json
 from builtins import str
+from datetime import datetime
 
 import arrow
 from arrow.parser import ParserError
@@ -98,6 +101,39 @@ def offset(value):
     return value
 
 
+# Page tokens are the sort key values of the last row of a page, e.g.
+# (recentdate, id) for threads, as base64-encoded JSON.
+_PAGE_TOKEN_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+def encode_page_token(values):
+    # FlexibleDateTime columns (e.g. Event.start) load as Arrow objects;
+    # tokens hold naive UTC datetimes.
+    values = [v.to("utc").naive if isinstance(v, arrow.Arrow) else v for v in values]
+    encoded = [
+        {"dt": v.strftime(_PAGE_TOKEN_DATETIME_FORMAT)}
+        if isinstance(v, datetime)
+        else v
+        for v in values
+    ]
+    token = base64.urlsafe_b64encode(json.dumps(encoded).encode("utf-8"))
+    return token.decode("ascii").rstrip("=")
+
+
+def page_token(value):
+    try:
+        padded = value + "=" * (-len(value) % 4)
+        decoded = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        return tuple(
+            datetime.strptime(v["dt"], _PAGE_TOKEN_DATETIME_FORMAT)
+            if isinstance(v, dict)
+            else v
+            for v in decoded
+        )
+    except (TypeError, ValueError, KeyError, UnicodeError):
+        raise ValueError("Invalid page_token.")
+
+
 def valid_public_id(value):
     if "_" in value:
         raise InputError(u"Invalid id: {}".format(value))
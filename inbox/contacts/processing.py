@@ -1,8 +1,20 @@
 import uuid
+from collections import OrderedDict
 
+from inbox.config import config
 from inbox.contacts.crud import INBOX_PROVIDER_NAME
 from inbox.models import Contact, EventContactAssociation, MessageContactAssociation
 from inbox.util.addr import canonicalize_address as canonicalize, valid_email
+from inbox.util.itert import chunk
+from inbox.util.stats import statsd_client
+
+# Number of (namespace, address) -> contact entries cached per process.
+CONTACT_CACHE_SIZE = config.get("CONTACT_CACHE_SIZE", 100000)
+CONTACT_LOOKUP_CHUNK_SIZE = 1000
+MESSAGE_ADDRESS_FIELDS = ("from_addr", "to_addr", "cc_addr", "bcc_addr", "reply_to")
+# Session.info key of the contact cache entries to set once the session
+# commits.
+PENDING_CACHE_ENTRIES_KEY = "contact_cache_pending_entries"
 
 
 def _get_contact_map(db_session, namespace_id, all_addresses):
@@ -84,7 +96,7 @@ def update_contacts_from_message(db_session, message, namespace_id):
         contact_map = _get_contact_map(db_session, namespace_id, all_addresses)
 
         # Now associate each contact to the message.
-        for field_name in ("from_addr", "to_addr", "cc_addr", "bcc_addr", "reply_to"):
+        for field_name in MESSAGE_ADDRESS_FIELDS:
             field = getattr(message, field_name)
             if field is None:
                 continue
@@ -98,31 +110,242 @@ def update_contacts_from_message(db_session, message, namespace_id):
                 )
 
 
+class ContactCache(object):
+    """
+    A size-bounded LRU map of (namespace_id, canonicalized address) to the id
+    and name of the contact with that address.
+
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def get(self, namespace_id, canonicalized_address):
+        key = (namespace_id, canonicalized_address)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def set(self, namespace_id, canonicalized_address, contact_id, name):
+        key = (namespace_id, canonicalized_address)
+        self._entries[key] = (contact_id, name)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def discard(self, namespace_id, canonicalized_address):
+        self._entries.pop((namespace_id, canonicalized_address), None)
+
+
+_contact_cache = None
+
+
+def get_contact_cache():
+    """Return the per-process ContactCache."""
+    global _contact_cache
+    if _contact_cache is None:
+        _contact_cache = ContactCache(CONTACT_CACHE_SIZE)
+    return _contact_cache
+
+
+def cache_committed_contacts(session):
+    """
+    Called from the post-commit hook: the contacts that ContactResolvers
+    found or created in the session are committed now, so they can be cached.
+    """
+    entries = session.info.pop(PENDING_CACHE_ENTRIES_KEY, ())
+    for cache, namespace_id, canonicalized_address, contact_id, name in entries:
+        cache.set(namespace_id, canonicalized_address, contact_id, name)
+
+
+def discard_uncommitted_contacts(session):
+    """Called from the post-rollback hook."""
+    session.info.pop(PENDING_CACHE_ENTRIES_KEY, None)
+
+
+class ContactResolver(object):
+    """
+    Does what `update_contacts_from_message` does, but for a batch of
+    messages at once: contacts that aren't cached are looked up with one query,
+    missing ones are created with one flush and the MessageContactAssociations
+    are bulk-inserted.
+
+    Use like this:
+
+        resolver = ContactResolver(namespace_id)
+        for ...:
+            resolver.add(message)
+        db_session.flush()  # The messages need ids.
+        resolver.resolve(db_session)
+        db_session.commit()  # The contacts are cached once committed.
+
+    Parameters
+    ----------
+    namespace_id : int
+        The namespace of the messages.
+    cache : ContactCache, optional
+        Defaults to the per-process cache.
+    """
+
+    def __init__(self, namespace_id, cache=None):
+        self.namespace_id = namespace_id
+        self.cache = cache or get_contact_cache()
+        self._messages = []
+
+    def add(self, message):
+        self._messages.append(message)
+
+    def resolve(self, db_session):
+        """Create the contacts and associations of the added messages."""
+        messages, self._messages = self._messages, []
+
+        # (message, field name, name, canonicalized address) for every valid
+        # address, and the first (name, address) seen for each contact.
+        entries = []
+        first_seen = OrderedDict()
+        for message in messages:
+            for field_name in MESSAGE_ADDRESS_FIELDS:
+                field = getattr(message, field_name)
+                if field is None:
+                    continue
+                for name, email_address in field:
+                    if not valid_email(email_address):
+                        continue
+                    canonicalized_address = canonicalize(email_address)
+                    entries.append((message, field_name, name, canonicalized_address))
+                    first_seen.setdefault(canonicalized_address, (name, email_address))
+        if not entries:
+            return
+
+        # canonicalized address -> [contact id or Contact, name]
+        contacts = {}
+        for canonicalized_address in first_seen:
+            entry = self.cache.get(self.namespace_id, canonicalized_address)
+            if entry is not None:
+                contacts[canonicalized_address] = list(entry)
+        statsd_client.incr("contacts.resolver.cache_hits", len(contacts))
+
+        missing = [a for a in first_seen if a not in contacts]
+        for addresses in chunk(missing, CONTACT_LOOKUP_CHUNK_SIZE):
+            for contact_id, canonicalized_address, name in db_session.query(
+                Contact.id, Contact._canonicalized_address, Contact.name
+            ).filter(
+                Contact._canonicalized_address.in_(addresses),
+                Contact.namespace_id == self.namespace_id,
+            ):
+                contacts[canonicalized_address] = [contact_id, name]
+
+        new_contacts = []
+        for canonicalized_address in missing:
+            if canonicalized_address in contacts:
+                continue
+            name, email_address = first_seen[canonicalized_address]
+            if isinstance(name, list):
+                name = name[0].strip()
+            contact = Contact(
+                name=name,
+                email_address=email_address,
+                namespace_id=self.namespace_id,
+                provider_name=INBOX_PROVIDER_NAME,
+                uid=uuid.uuid4().hex,
+            )
+            new_contacts.append(contact)
+            contacts[canonicalized_address] = [contact, name]
+        statsd_client.incr("contacts.resolver.created", len(new_contacts))
+
+        # See _get_contact_from_map.
+        noreply_ids = set()
+        for _, _, name, canonicalized_address in entries:
+            contact = contacts[canonicalized_address]
+            if contact[1] != name and "noreply" in canonicalized_address:
+                if contact[1] is not None:
+                    if isinstance(contact[0], Contact):
+                        contact[0].name = None
+                    else:
+                        noreply_ids.add(contact[0])
+                contact[1] = None
+        if noreply_ids:
+            for contact in db_session.query(Contact).filter(
+                Contact.id.in_(noreply_ids)
+            ):
+                contact.name = None
+
+        db_session.add_all(new_contacts)
+        db_session.flush()
+        # Only cache the contacts once they're committed; until then they
+        # (and the names we changed) may still be rolled back.
+        pending = db_session.info.setdefault(PENDING_CACHE_ENTRIES_KEY, [])
+        for canonicalized_address, (contact, name) in contacts.items():
+            if isinstance(contact, Contact):
+                contact = contact.id
+                contacts[canonicalized_address][0] = contact
+            pending.append(
+                (self.cache, self.namespace_id, canonicalized_address, contact, name)
+            )
+
+        db_session.execute(
+            MessageContactAssociation.__table__.insert(),
+            [
+                {
+                    "contact_id": contacts[canonicalized_address][0],
+                    "message_id": message.id,
+                    "field": field_name,
+                }
+                for message, field_name, _, canonicalized_address in entries
+            ],
+        )
+
+
+def _event_addresses(event):
+    # The (field name, [(name, address)]) pairs of an event, the ones that
+    # come with a name first.
+    title_emails = set(event.emails_from_title)
+    title_addrs = [("", email) for email in title_emails]
+
+    description_emails = set(event.emails_from_description)
+    description_addrs = [("", email) for email in description_emails]
+
+    owner = (event.organizer_name or "", event.organizer_email)
+    owner_addrs = [owner] if owner[1] else []
+
+    participant_addrs = [
+        (participant["name"], participant["email"])
+        for participant in event.participants
+    ]
+
+    return [
+        ("participant", participant_addrs),
+        ("owner", owner_addrs),
+        ("title", title_addrs),
+        ("description", description_addrs),
+    ]
+
+
+def _associate_event_contacts(event, event_addresses, contact_map):
+    for field_name, addrs in event_addresses:
+        for name, email in addrs:
+            contact = _get_contact_from_map(contact_map, name, email)
+            if not contact:
+                continue
+
+            event.contacts.append(
+                EventContactAssociation(contact=contact, field=field_name)
+            )
+
+
 def update_contacts_from_event(db_session, event, namespace_id):
     with db_session.no_autoflush:
         # First create Contact objects for any email addresses that we haven't
         # seen yet. We want to dedupe by canonicalized address, so this part is
         # a bit finicky.
-        title_emails = set(event.emails_from_title)
-        title_addrs = [("", email) for email in title_emails]
-
-        description_emails = set(event.emails_from_description)
-        description_addrs = [("", email) for email in description_emails]
-
-        owner = (event.organizer_name or "", event.organizer_email)
-        owner_addrs = [owner] if owner[1] else []
-
-        participant_addrs = [
-            (participant["name"], participant["email"])
-            for participant in event.participants
-        ]
+        event_addresses = _event_addresses(event)
 
         # Note that title & description emails are purposefully at the end here
         # since they have no name, and we want _get_contact_map to create a
         # contact with a name if possible.
-        all_addresses = (
-            participant_addrs + owner_addrs + title_addrs + description_addrs
-        )
+        all_addresses = [addr for _, addrs in event_addresses for addr in addrs]
 
         if not all_addresses:
             return
@@ -130,17 +353,37 @@ def update_contacts_from_event(db_session, event, namespace_id):
         contact_map = _get_contact_map(db_session, namespace_id, all_addresses)
 
         # Now associate each contact to the event.
-        for field_name, addrs in (
-            ("title", title_addrs),
-            ("description", description_addrs),
-            ("owner", owner_addrs),
-            ("participant", participant_addrs),
-        ):
-            for name, email in addrs:
-                contact = _get_contact_from_map(contact_map, name, email)
-                if not contact:
-                    continue
+        _associate_event_contacts(event, event_addresses, contact_map)
 
-                event.contacts.append(
-                    EventContactAssociation(contact=contact, field=field_name)
-                )
+
+def update_contacts_from_events(db_session, events, namespace_id):
+    """
+    Does what `update_contacts_from_event` does for each of the given events,
+    but looks up the contacts of all of them at once, with one query per
+    CONTACT_LOOKUP_CHUNK_SIZE distinct addresses.
+    """
+    with db_session.no_autoflush:
+        addresses_by_event = [(event, _event_addresses(event)) for event in events]
+
+        # As in update_contacts_from_event, addresses with a name come first
+        # so that new contacts get a name if possible. Only the first pair of
+        # each address is kept, so that a contact isn't created twice when its
+        # address is in several lookup chunks.
+        named_addresses = []
+        unnamed_addresses = []
+        for _, event_addresses in addresses_by_event:
+            for field_name, addrs in event_addresses:
+                if field_name in ("participant", "owner"):
+                    named_addresses.extend(addrs)
+                else:
+                    unnamed_addresses.extend(addrs)
+        first_seen = OrderedDict()
+        for name, email_address in named_addresses + unnamed_addresses:
+            first_seen.setdefault(canonicalize(email_address), (name, email_address))
+
+        contact_map = {}
+        for addresses in chunk(list(first_seen.values()), CONTACT_LOOKUP_CHUNK_SIZE):
+            contact_map.update(_get_contact_map(db_session, namespace_id, addresses))
+
+        for event, event_addresses in addresses_by_event:
+            _associate_event_contacts(event, event_addresses, contact_map)
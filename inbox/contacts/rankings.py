@@ -0,0 +1,282 @@
+"""
+An incremental engine for the contacts/rankings and groups/intrinsic
+endpoints.
+
+Rather than loading every sent message of a namespace on each request, the
+recipients of its sent messages are kept in `ContactAggregates`: a sparse
+message x participant matrix, in CSR form, along with the date of every
+message. The aggregates are persisted in the namespace's DataProcessingCache,
+and only the sent messages synced since they were last updated are added to
+them. Scores are computed from them with NumPy, with the same message weights
+and group heuristics as inbox.contacts.algorithms.
+
+"""
+import datetime
+import io
+
+import numpy as np
+
+from inbox.config import config
+from inbox.contacts.algorithms import (
+    LOOKBACK_TIME,
+    MIN_GROUP_SIZE,
+    MIN_MESSAGE_COUNT,
+    MIN_MESSAGE_WEIGHT,
+    SELF_IDENTITY_THRESHOLD,
+    SOCIAL_MOLECULE_EXPANSION_LIMIT,
+    SOCIAL_MOLECULE_LIMIT,
+    _combine_similar_molecules,
+)
+
+CONTACT_RANKINGS_ENGINE_ENABLED = config.get("CONTACT_RANKINGS_ENGINE_ENABLED", False)
+# Groups are computed from at most this many distinct sets of recipients, the
+# ones with the most weight. calculate_group_scores gives up instead.
+MOLECULE_LIMIT = config.get("CONTACT_GROUPS_MOLECULE_LIMIT", SOCIAL_MOLECULE_LIMIT)
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _timestamp(dt):
+    return (dt - EPOCH).total_seconds()
+
+
+class ContactAggregates(object):
+    """
+    The recipients of the sent messages of a namespace.
+
+    Row i of the message x participant matrix holds the recipients (to, cc
+    and bcc) of the message with id ``message_ids[i]``, sent at ``dates[i]``:
+    ``indices[indptr[i]:indptr[i + 1]]`` are their indices in
+    ``participants``.
+
+    """
+
+    def __init__(
+        self, participants=(), message_ids=(), dates=(), indptr=(0,), indices=()
+    ):
+        self.participants = list(participants)
+        self._participant_index = {p: i for i, p in enumerate(self.participants)}
+        self.message_ids = np.asarray(message_ids, dtype=np.int64)
+        self.dates = np.asarray(dates, dtype=np.float64)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+
+    @property
+    def last_message_id(self):
+        return int(self.message_ids.max()) if len(self.message_ids) else 0
+
+    def add_messages(self, messages):
+        """
+        Add sent messages, as returned by
+        inbox.api.filtering.messages_for_contact_scores. Returns how many were
+        added.
+
+        """
+        message_ids, dates, counts, indices = [], [], [], []
+        for message in messages:
+            recipients = (
+                (message.to_addr or [])
+                + (message.cc_addr or [])
+                + (message.bcc_addr or [])
+            )
+            message_ids.append(message.id)
+            dates.append(_timestamp(message.date))
+            counts.append(len(recipients))
+            indices.extend(self._participant_id(email) for _, email in recipients)
+
+        if not message_ids:
+            return 0
+        self.message_ids = np.concatenate(
+            [self.message_ids, np.asarray(message_ids, dtype=np.int64)]
+        )
+        self.dates = np.concatenate([self.dates, np.asarray(dates, dtype=np.float64)])
+        self.indptr = np.concatenate(
+            [self.indptr, self.indptr[-1] + np.cumsum(counts, dtype=np.int64)]
+        )
+        self.indices = np.concatenate(
+            [self.indices, np.asarray(indices, dtype=np.int64)]
+        )
+        return len(message_ids)
+
+    def _participant_id(self, email):
+        index = self._participant_index.get(email)
+        if index is None:
+            index = self._participant_index[email] = len(self.participants)
+            self.participants.append(email)
+        return index
+
+    def message_weights(self, now=None, time_dependent=True):
+        """The weight of every message; see algorithms._get_message_weight."""
+        if not time_dependent:
+            return np.ones(len(self.dates))
+        now = _timestamp(now or datetime.datetime.now())
+        return np.maximum(1 - (now - self.dates) / LOOKBACK_TIME, MIN_MESSAGE_WEIGHT)
+
+    def contact_scores(self, now=None, time_dependent=True):
+        """Like algorithms.calculate_contact_scores, for all messages."""
+        weights = np.repeat(
+            self.message_weights(now, time_dependent), np.diff(self.indptr)
+        )
+        scores = np.bincount(
+            self.indices, weights=weights, minlength=len(self.participants)
+        )
+        return {email: float(score) for email, score in zip(self.participants, scores)}
+
+    def group_scores(self, user_email, now=None):
+        """Like algorithms.calculate_group_scores, for all messages."""
+        weights = self.message_weights(now)
+        emails, molecules, molecule_of_message = self._molecules(user_email)
+        if not len(molecules):
+            return {}
+
+        # The weight of a molecule is the weight of its messages.
+        has_molecule = molecule_of_message >= 0
+        molecule_weights = np.bincount(
+            molecule_of_message[has_molecule],
+            weights=weights[has_molecule],
+            minlength=len(molecules),
+        )
+
+        if len(molecules) > MOLECULE_LIMIT:
+            keep = np.sort(
+                np.argsort(-molecule_weights, kind="stable")[:MOLECULE_LIMIT]
+            )
+            molecules = molecules[keep]
+            molecule_weights = molecule_weights[keep]
+
+        # Groups are sets of emails, along with the set of molecules (i.e. of
+        # messages) they stand for.
+        groups, members = _expand_molecules(molecules)
+        group_weights = np.array([molecule_weights[list(m)].sum() for m in members])
+
+        # Filter out infrequent groups
+        frequent = np.nonzero(group_weights >= MIN_MESSAGE_COUNT)[0]
+        groups = groups[frequent]
+        group_weights = group_weights[frequent]
+        members = [members[i] for i in frequent]
+
+        # Subsets get absorbed by supersets (if minimal info lost)
+        kept = _subsume_groups(groups, group_weights)
+
+        groups_list = [
+            ({emails[k] for k in np.nonzero(groups[i])[0]}, members[i]) for i in kept
+        ]
+        groups_list = _combine_similar_molecules(groups_list)
+        return {
+            ", ".join(sorted(g)): float(molecule_weights[list(m)].sum())
+            for (g, m) in groups_list
+        }
+
+    def _molecules(self, user_email):
+        # Returns the participants as groups see them, a boolean
+        # molecule x participant matrix of the distinct sets of (at least
+        # MIN_GROUP_SIZE) recipients of messages, and the molecule of every
+        # message (-1 if none). Like algorithms._get_participants, emails are
+        # lowercased and the user is left out.
+        emails = sorted({p.lower() for p in self.participants})
+        email_index = {e: i for i, e in enumerate(emails)}
+        to_email = np.array(
+            [email_index[p.lower()] for p in self.participants], dtype=np.int64
+        )
+        excluded = np.array([p == user_email for p in self.participants], dtype=bool)
+
+        n_messages = len(self.message_ids)
+        rows = np.repeat(np.arange(n_messages), np.diff(self.indptr))
+        keep = ~excluded[self.indices]
+        # The distinct (message, email) pairs, by message and then email.
+        pairs = np.unique(rows[keep] * len(emails) + to_email[self.indices[keep]])
+        rows, cols = np.divmod(pairs, max(len(emails), 1))
+        bounds = np.searchsorted(rows, np.arange(n_messages + 1))
+
+        molecule_index = {}
+        molecule_of_message = np.full(n_messages, -1, dtype=np.int64)
+        for message in np.nonzero(np.diff(bounds) >= MIN_GROUP_SIZE)[0]:
+            key = cols[bounds[message] : bounds[message + 1]].tobytes()
+            molecule_of_message[message] = molecule_index.setdefault(
+                key, len(molecule_index)
+            )
+
+        molecules = np.zeros((len(molecule_index), len(emails)), dtype=bool)
+        for key, index in molecule_index.items():
+            molecules[index, np.frombuffer(key, dtype=np.int64)] = True
+        return emails, molecules, molecule_of_message
+
+    def to_bytes(self):
+        buf = io.BytesIO()
+        np.savez_compressed(
+            buf,
+            participants=np.array(self.participants, dtype=str),
+            message_ids=self.message_ids,
+            dates=self.dates,
+            indptr=self.indptr,
+            indices=self.indices,
+        )
+        return buf.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        with np.load(io.BytesIO(data)) as arrays:
+            return cls(
+                participants=arrays["participants"].tolist(),
+                message_ids=arrays["message_ids"],
+                dates=arrays["dates"],
+                indptr=arrays["indptr"],
+                indices=arrays["indices"],
+            )
+
+
+def _expand_molecules(molecules):
+    # Expand the pool of molecules by taking pairwise intersections, like
+    # algorithms._expand_molecule_pool. Returns a boolean group x participant
+    # matrix and the set of molecules each group stands for.
+    groups = list(molecules)
+    members = [{i} for i in range(len(molecules))]
+    if len(molecules) >= SOCIAL_MOLECULE_EXPANSION_LIMIT:
+        return molecules, members
+
+    group_index = {group.tobytes(): i for i, group in enumerate(groups)}
+    as_int = molecules.astype(np.int32)
+    intersection_sizes = as_int @ as_int.T
+    for i in range(len(molecules)):
+        others = np.nonzero(intersection_sizes[i, i:] >= MIN_GROUP_SIZE)[0] + i
+        intersections = molecules[i] & molecules[others]
+        # Distinct intersections, in the order they were found.
+        unique, first, inverse = np.unique(
+            intersections, axis=0, return_index=True, return_inverse=True
+        )
+        inverse = inverse.reshape(-1)
+        for u in np.argsort(first, kind="stable"):
+            group = unique[u]
+            index = group_index.get(group.tobytes())
+            if index is None:
+                index = group_index[group.tobytes()] = len(groups)
+                groups.append(group)
+                members.append(set())
+            members[index].add(i)
+            members[index].update(others[inverse == u].tolist())
+    return np.array(groups), members
+
+
+def _subsume_groups(groups, group_weights):
+    # Like algorithms._subsume_molecules; returns the indices of the groups
+    # that aren't absorbed by a superset, largest groups first.
+    sizes = groups.sum(axis=1)
+    order = np.argsort(-sizes, kind="stable")
+    sizes = sizes[order]
+    weights = group_weights[order]
+    as_int = groups[order].astype(np.int32)
+
+    subsumed = np.zeros(len(order), dtype=bool)
+    for i in range(1, len(order)):
+        # The bigger groups that aren't absorbed and are supersets of this one.
+        supersets = ~subsumed[:i] & (as_int[:i] @ as_int[i] == sizes[i])
+        if not supersets.any():
+            continue
+        bigger_sizes = sizes[:i][supersets]
+        sharing_error = (
+            (bigger_sizes - sizes[i])
+            * (weights[i] - weights[:i][supersets])
+            / (bigger_sizes * weights[i])
+        )
+        subsumed[i] = (sharing_error < SELF_IDENTITY_THRESHOLD).any()
+    return order[~subsumed]
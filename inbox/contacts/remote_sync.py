@@ -6,6 +6,7 @@ from sqlalchemy.orm.exc import NoResultFound
 
 from inbox.contacts.google import GoogleContactsProvider
 from inbox.contacts.icloud import ICloudContactsProvider
+from inbox.contacts.processing import get_contact_cache
 from inbox.logging import get_logger
 from inbox.models import Account, Contact
 from inbox.models.session import session_scope
@@ -113,6 +114,11 @@ class ContactSync(BaseSyncMonitor):
 
                     # If the remote item was deleted, purge the corresponding
                     # database entries.
+                    # Contacts from mail may be resolved to this one by
+                    # address, so don't let them be resolved from the cache.
+                    get_contact_cache().discard(
+                        account.namespace.id, existing_contact._canonicalized_address
+                    )
                     if new_contact.deleted:
                         db_session.delete(existing_contact)
                         change_counter["deleted"] += 1
@@ -5,7 +5,7 @@ import re
 import ssl
 import time
 from builtins import range
-from typing import Any, Callable, DefaultDict, Dict, List, Optional, Tuple
+from typing import Any, Callable, DefaultDict, Dict, List, Optional, Set, Tuple
 
 import imapclient
 import imapclient.exceptions
@@ -44,6 +44,7 @@ from gevent.queue import Queue
 from sqlalchemy.orm import joinedload
 
 from inbox.basicauth import GmailSettingError
+from inbox.config import config
 from inbox.folder_edge_cases import localized_folder_names
 from inbox.logging import get_logger
 from inbox.models import Account
@@ -55,6 +56,7 @@ from inbox.models.session import session_scope
 from inbox.util.concurrency import retry
 from inbox.util.itert import chunk
 from inbox.util.misc import or_none
+from inbox.util.stats import statsd_client
 
 log = get_logger()
 
@@ -94,6 +96,32 @@ RawFolder = namedtuple("RawFolder", "display_name role")
 # connection pools for a given account.
 _lock_map = defaultdict(threading.Lock)
 
+# Maximum number of UIDs to ask for in a single RFC822.SIZE FETCH.
+SIZES_FETCH_CHUNK_SIZE = 500
+
+# Use AdaptiveCrispinConnectionPool for read-only connection pools.
+IMAP_ADAPTIVE_POOL_ENABLED = config.get("IMAP_ADAPTIVE_POOL_ENABLED", False)
+# Connections per account (unless the account is throttled), by provider. This
+# is a static lookup: pools don't resize themselves with load.
+IMAP_POOL_SIZE = config.get("IMAP_POOL_SIZE", 3)
+IMAP_POOL_SIZE_BY_PROVIDER = config.get("IMAP_POOL_SIZE_BY_PROVIDER", {})
+# Connections open to an IMAP host across all the adaptive pools of a process.
+IMAP_MAX_CONNECTIONS_PER_HOST = config.get("IMAP_MAX_CONNECTIONS_PER_HOST", 500)
+# Connections opened when an adaptive pool is created.
+IMAP_POOL_PREWARM = config.get("IMAP_POOL_PREWARM", 1)
+# Idle connections are checked with a NOOP before they're handed out if they
+# have been idle for this many seconds, and logged out after IMAP_POOL_IDLE_TIMEOUT
+# seconds.
+IMAP_POOL_NOOP_INTERVAL = config.get("IMAP_POOL_NOOP_INTERVAL", 60)
+IMAP_POOL_IDLE_TIMEOUT = config.get("IMAP_POOL_IDLE_TIMEOUT", 15 * 60)
+# How many folders of an account are searched at once; see
+# search_connection_pool.
+IMAP_SEARCH_POOL_SIZE = config.get("IMAP_SEARCH_POOL_SIZE", 4)
+
+# Lazily-initialized map of IMAP hosts to the semaphores that cap the number
+# of connections open to them.
+_host_semaphores = {}
+
 # Exception classes which indicate the network connection to the IMAP
 # server is broken.
 CONN_NETWORK_EXC_CLASSES = (socket.error, ssl.SSLError)
@@ -126,7 +154,11 @@ class DraftDeletionException(Exception):
 def _get_connection_pool(account_id, pool_size, pool_map, readonly):
     with _lock_map[account_id]:
         if account_id not in pool_map:
-            pool_map[account_id] = CrispinConnectionPool(
+            if IMAP_ADAPTIVE_POOL_ENABLED and readonly:
+                pool_cls = AdaptiveCrispinConnectionPool
+            else:
+                pool_cls = CrispinConnectionPool
+            pool_map[account_id] = pool_cls(
                 account_id, num_connections=pool_size, readonly=readonly
             )
         return pool_map[account_id]
@@ -154,11 +186,37 @@ def connection_pool(account_id, pool_size=None):
             account = db_session.query(Account).get(account_id)
             if account.throttled:
                 pool_size = 1
+            elif IMAP_ADAPTIVE_POOL_ENABLED:
+                pool_size = IMAP_POOL_SIZE_BY_PROVIDER.get(
+                    account.provider, IMAP_POOL_SIZE
+                )
             else:
                 pool_size = 3
     return _get_connection_pool(account_id, pool_size, _pool_map, True)
 
 
+@contextlib.contextmanager
+def search_connection_pool(account_id, pool_size=IMAP_SEARCH_POOL_SIZE):
+    """ Crispin connection pool for a single search of an account, with
+    read-only connections. Searches get their own pool so that they don't
+    compete with sync for connections, and its size caps how many connections
+    the search opens to the account at once. The connections are logged out
+    when the search is done, rather than kept for every account ever searched.
+
+    Use like this:
+
+        with crispin.search_connection_pool(account_id, pool_size) as pool:
+            with pool.get() as crispin_client:
+                # your code here
+                pass
+    """
+    pool = CrispinConnectionPool(account_id, num_connections=pool_size, readonly=True)
+    try:
+        yield pool
+    finally:
+        pool.close()
+
+
 _writable_pool_map = {}
 
 
@@ -216,10 +274,13 @@ class CrispinConnectionPool(object):
             log.info("Error on IMAP logout", exc_info=True)
 
     @contextlib.contextmanager
-    def get(self):
+    def get(self, folder_name=None):
         """ Get a connection from the pool, or instantiate a new one if needed.
         If `num_connections` connections are already in use, block until one is
         available.
+
+        `folder_name` is the folder the caller is going to select, if it's
+        known. Only AdaptiveCrispinConnectionPool makes use of it.
         """
         # A gevent semaphore is granted in the order that greenlets tried to
         # acquire it, so we use a semaphore here to prevent potential
@@ -251,6 +312,16 @@ class CrispinConnectionPool(object):
             self._queue.put(client)
             self._sem.release()
 
+    def close(self):
+        """Log out the connections of the pool that aren't in use."""
+        clients = []
+        while not self._queue.empty():
+            clients.append(self._queue.get_nowait())
+        for client in clients:
+            if client is not None:
+                self._logout(client)
+            self._queue.put(None)
+
     def _set_account_info(self):
         with session_scope(self.account_id) as db_session:
             account = db_session.query(ImapAccount).get(self.account_id)
@@ -258,6 +329,7 @@ class CrispinConnectionPool(object):
             self.provider = account.provider
             self.provider_info = account.provider_info
             self.email_address = account.email_address
+            self.imap_host = account.imap_endpoint[0]
             self.auth_handler = account.auth_handler
             if account.provider == "gmail":
                 self.client_cls = GmailCrispinClient
@@ -297,6 +369,154 @@ class CrispinConnectionPool(object):
         )
 
 
+class AdaptiveCrispinConnectionPool(CrispinConnectionPool):
+    """
+    A CrispinConnectionPool for read-only connections that:
+
+    - hands out an idle connection that already has the folder passed to
+      `get` selected if there is one, and the most recently used one
+      otherwise. This only saves a SELECT for callers that use
+      `select_folder_if_necessary` (the initial sync and IDLE); callers that
+      need a fresh HIGHESTMODSEQ or UIDVALIDITY still SELECT the folder
+      again;
+    - opens IMAP_POOL_PREWARM connections when it's created, checks
+      connections that were idle for IMAP_POOL_NOOP_INTERVAL with a NOOP
+      before handing them out and logs out connections that were idle for
+      IMAP_POOL_IDLE_TIMEOUT;
+    - keeps the number of connections open to the account's IMAP host, across
+      all the adaptive pools of the process, below
+      IMAP_MAX_CONNECTIONS_PER_HOST.
+
+    How long callers wait for a connection, how often the requested folder
+    was already selected and how many connections are open and in use are
+    reported to statsd under mailsync.imap_pool.<provider>.
+
+    Despite the name, the size of the pool is fixed when it's created, from
+    IMAP_POOL_SIZE_BY_PROVIDER; see `connection_pool`.
+    """
+
+    def __init__(self, account_id, num_connections, readonly):
+        CrispinConnectionPool.__init__(self, account_id, num_connections, readonly)
+        # (client, time it was last used) pairs, least recently used first.
+        self._idle = []
+        if self.imap_host not in _host_semaphores:
+            _host_semaphores[self.imap_host] = BoundedSemaphore(
+                IMAP_MAX_CONNECTIONS_PER_HOST
+            )
+        self._host_sem = _host_semaphores[self.imap_host]
+        self._metric_prefix = ".".join(["mailsync", "imap_pool", self.provider])
+        self._greenlets = [
+            gevent.spawn(self._prewarm, min(IMAP_POOL_PREWARM, num_connections)),
+            gevent.spawn(self._reap_idle),
+        ]
+
+    @contextlib.contextmanager
+    def get(self, folder_name=None):
+        start = time.time()
+        self._sem.acquire()
+        statsd_client.timing(
+            self._metric_prefix + ".wait", (time.time() - start) * 1000
+        )
+        statsd_client.gauge(self._metric_prefix + ".in_use", 1, delta=True)
+        client = None
+        try:
+            client = self._checkout(folder_name)
+            if client is None:
+                client = self._open_connection()
+            yield client
+        except CONN_DISCARD_EXC_CLASSES as exc:
+            # See CrispinConnectionPool.get.
+            log.info("IMAP connection error; discarding connection", exc_info=True)
+            self._discard(client, logout=not isinstance(exc, CONN_UNUSABLE_EXC_CLASSES))
+            client = None
+            raise exc
+        finally:
+            if client is not None:
+                self._idle.append((client, time.time()))
+            statsd_client.gauge(self._metric_prefix + ".in_use", -1, delta=True)
+            self._sem.release()
+
+    def _checkout(self, folder_name):
+        # Returns an idle connection, or None if there's none left.
+        index = None
+        if folder_name is not None:
+            for i, (client, _) in enumerate(self._idle):
+                if client.selected_folder_name == folder_name:
+                    index = i
+                    break
+            statsd_client.incr(
+                self._metric_prefix
+                + (".folder_hit" if index is not None else ".folder_miss")
+            )
+        while self._idle:
+            client, last_used = self._idle.pop(-1 if index is None else index)
+            index = None
+            if time.time() - last_used < IMAP_POOL_NOOP_INTERVAL:
+                return client
+            try:
+                client.conn.noop()
+                return client
+            except CONN_DISCARD_EXC_CLASSES as exc:
+                log.info("Idle IMAP connection is broken; discarding it", exc_info=True)
+                self._discard(
+                    client, logout=not isinstance(exc, CONN_UNUSABLE_EXC_CLASSES)
+                )
+        return None
+
+    def _open_connection(self):
+        self._host_sem.acquire()
+        try:
+            client = self._new_connection()
+        except Exception:
+            self._host_sem.release()
+            raise
+        statsd_client.gauge(self._metric_prefix + ".open", 1, delta=True)
+        return client
+
+    def _discard(self, client, logout):
+        if client is None:
+            return
+        if logout:
+            self._logout(client)
+        self._host_sem.release()
+        statsd_client.gauge(self._metric_prefix + ".open", -1, delta=True)
+
+    def _prewarm(self, num_connections):
+        for _ in range(num_connections):
+            self._sem.acquire()
+            try:
+                self._idle.append((self._open_connection(), time.time()))
+            except Exception:
+                log.info(
+                    "Error opening IMAP connection ahead of time",
+                    account_id=self.account_id,
+                    exc_info=True,
+                )
+                return
+            finally:
+                self._sem.release()
+
+    def _reap_idle(self):
+        while True:
+            gevent.sleep(max(1, IMAP_POOL_IDLE_TIMEOUT / 4.0))
+            self._reap_expired()
+
+    def _reap_expired(self):
+        now = time.time()
+        expired = [
+            client
+            for client, last_used in self._idle
+            if now - last_used >= IMAP_POOL_IDLE_TIMEOUT
+        ]
+        self._idle = [
+            (client, last_used)
+            for client, last_used in self._idle
+            if now - last_used < IMAP_POOL_IDLE_TIMEOUT
+        ]
+        for client in expired:
+            self._discard(client, logout=True)
+
+
 def _exc_callback(exc):
     log.info(
         "Connection broken with error; retrying with new connection", exc_info=True
@@ -776,13 +996,77 @@ class CrispinClient(object):
         )
         return sorted([long(uid) for uid in fetch_result])
 
+    def sizes(self, uids):
+        # type: (List[int]) -> Dict[int, int]
+        """
+        RFC822.SIZE for the given uids, in bytes. Chunked because certain
+        providers fail with 'Command line too large' if you feed them too many
+        uids at once.
+
+        UIDs the server doesn't report a size for are left out of the result.
+
+        """
+        uid_set = set(uids)
+        sizes = {}  # type: Dict[int, int]
+        for uid_chunk in chunk(sorted(uid_set), SIZES_FETCH_CHUNK_SIZE):
+            data = self.conn.fetch(
+                uid_chunk, ["RFC822.SIZE"]
+            )  # type: Dict[int, Dict[bytes, Any]]
+            for uid, ret in data.items():
+                if uid in uid_set and b"RFC822.SIZE" in ret:
+                    sizes[uid] = ret[b"RFC822.SIZE"]
+        return sizes
+
+    def _fetch_uids_batch(self, uid_set):
+        # type: (Set[int]) -> Dict[int, Dict[bytes, Any]]
+        """
+        Fetch the bodies of several UIDs with a single FETCH command.
+
+        Only complete responses for the requested UIDs are returned; it's up
+        to the caller to fetch any missing UIDs individually.
+
+        """
+        try:
+            result = self.conn.fetch(
+                sorted(uid_set), ["BODY.PEEK[]", "INTERNALDATE", "FLAGS"]
+            )  # type: Dict[int, Dict[bytes, Any]]
+        except imaplib.IMAP4.abort:
+            raise
+        except imapclient.IMAPClient.Error as e:
+            log.info(
+                "Batched UID fetch failed; falling back to fetching one UID at a time",
+                uid_count=len(uid_set),
+                error=e,
+                logstash_tag="imap_download_exception",
+            )
+            return {}
+
+        return {
+            uid: ret
+            for uid, ret in result.items()
+            if uid in uid_set
+            and all(key in ret for key in (b"BODY[]", b"INTERNALDATE", b"FLAGS"))
+        }
+
     def uids(self, uids):
         # type: (List[int]) -> List[RawMessage]
+        """
+        Download the given UIDs from the selected folder.
+
+        When more than one UID is requested they are first fetched with a
+        single FETCH command. Any UID that doesn't come back complete (some
+        servers send partial or mangled responses for large UID sets) is
+        re-fetched on its own.
+
+        """
         uid_set = set(uids)
         imap_messages = {}  # type: Dict[int, Dict[bytes, Any]]
         raw_messages = []  # type: List[RawMessage]
 
-        for uid in uid_set:
+        if len(uid_set) > 1:
+            imap_messages.update(self._fetch_uids_batch(uid_set))
+
+        for uid in uid_set.difference(imap_messages):
             try:
                 # Microsoft IMAP server returns a bunch of crap which could
                 # corrupt other UID data. Also we don't always get a message
@@ -14,6 +14,7 @@ import uuid
 import arrow
 import gevent
 import requests
+from requests.adapters import HTTPAdapter
 
 from inbox.auth.oauth import OAuthRequestsWrapper
 from inbox.basicauth import AccessNotEnabledError
@@ -50,6 +51,11 @@ EVENTS_LIST_WEHOOK_URL = URL_PREFIX + "/w/calendar_update/{}"
 WATCH_CALENDARS_URL = CALENDARS_URL + "/watch"
 WATCH_EVENTS_URL = "https://www.googleapis.com/calendar/v3/calendars/{}/events/watch"
 
+# The number of connections to the Calendar API kept open per account. Pages
+# of several calendars of an account may be fetched concurrently (see
+# CALENDAR_SYNC_CONCURRENCY in inbox.events.remote_sync).
+GOOGLE_CALENDAR_POOL_SIZE = config.get("GOOGLE_CALENDAR_POOL_SIZE", 4)
+
 
 class GoogleEventsProvider(object):
     """
@@ -67,6 +73,13 @@ class GoogleEventsProvider(object):
         # by the Google Event API.
         self.calendars_table = {}
 
+        # Reuse connections across pages and calendars.
+        self.http_session = requests.Session()
+        self.http_session.mount(
+            "https://",
+            HTTPAdapter(pool_connections=1, pool_maxsize=GOOGLE_CALENDAR_POOL_SIZE),
+        )
+
     def sync_calendars(self):
         """ Fetches data for the user's calendars.
         Returns
@@ -117,6 +130,25 @@ class GoogleEventsProvider(object):
 
         return updates
 
+    def sync_event_pages(self, calendar_uid, sync_from_time=None):
+        """ Like `sync_events`, but yields the events a page of the API
+        response at a time, as they are fetched, so that they can be persisted
+        without holding all the events of a calendar in memory.
+
+        Yields
+        ------
+        Lists of uncommited Event instances.
+        """
+        read_only_calendar = self.calendars_table.get(calendar_uid, True)
+        for items in self._iter_raw_event_pages(calendar_uid, sync_from_time):
+            updates = []
+            for item in items:
+                try:
+                    updates.append(parse_event_response(item, read_only_calendar))
+                except (arrow.parser.ParserError, ValueError):
+                    log.warning("Skipping unparseable event", exc_info=True, raw=item)
+            yield updates
+
     def _get_raw_calendars(self):
         """Gets raw data for the user's calendars."""
         return self._get_resource_list(CALENDARS_URL)
@@ -136,6 +168,14 @@ class GoogleEventsProvider(object):
         -------
         list of dictionaries representing JSON.
         """
+        return [
+            item
+            for items in self._iter_raw_event_pages(calendar_uid, sync_from_time)
+            for item in items
+        ]
+
+    def _iter_raw_event_pages(self, calendar_uid, sync_from_time=None):
+        """Yields the raw event data of `_get_raw_events` a page at a time."""
         if sync_from_time is not None:
             # Note explicit offset is required by Google calendar API.
             sync_from_time = datetime.datetime.isoformat(sync_from_time) + "Z"
@@ -144,13 +184,16 @@ class GoogleEventsProvider(object):
             urllib.parse.quote(calendar_uid)
         )
         try:
-            return self._get_resource_list(url, updatedMin=sync_from_time)
+            for items in self._iter_resource_pages(url, updatedMin=sync_from_time):
+                yield items
         except requests.exceptions.HTTPError as exc:
             if exc.response.status_code == 410:
                 # The calendar API may return 410 if you pass a value for
                 # updatedMin that's too far in the past. In that case, refetch
-                # all events.
-                return self._get_resource_list(url)
+                # all events. (Pages that were already yielded are yielded
+                # again; persisting them is idempotent.)
+                for items in self._iter_resource_pages(url):
+                    yield items
             else:
                 raise
 
@@ -163,22 +206,26 @@ class GoogleEventsProvider(object):
 
     def _get_resource_list(self, url, **params):
         """Handles response pagination."""
+        return [
+            item for items in self._iter_resource_pages(url, **params) for item in items
+        ]
+
+    def _iter_resource_pages(self, url, **params):
+        """Yields the items of each page of the response, fetching the next
+        page only once the previous one has been consumed."""
         token = self._get_access_token()
-        items = []
         next_page_token = None
         params["showDeleted"] = True
         while True:
             if next_page_token is not None:
                 params["pageToken"] = next_page_token
             try:
-                r = requests.get(url, params=params, auth=OAuthRequestsWrapper(token))
+                r = self.http_session.get(
+                    url, params=params, auth=OAuthRequestsWrapper(token)
+                )
                 r.raise_for_status()
                 data = r.json()
-                items += data["items"]
                 next_page_token = data.get("nextPageToken")
-                if next_page_token is None:
-                    return items
-
             except requests.exceptions.SSLError:
                 self.log.warning(
                     "SSLError making Google Calendar API request, retrying.",
@@ -227,6 +274,12 @@ class GoogleEventsProvider(object):
                 # Unexpected error; raise.
                 raise
 
+            # Outside of the try block so that errors raised while the page
+            # is being consumed aren't handled as API errors.
+            yield data["items"]
+            if next_page_token is None:
+                return
+
     def _make_event_request(self, method, calendar_uid, event_uid=None, **kwargs):
         """ Makes a POST/PUT/DELETE request for a particular event. """
         event_uid = event_uid or ""
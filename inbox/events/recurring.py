@@ -1,12 +1,17 @@
 from __future__ import absolute_import
 
+import hashlib
+import heapq
+from collections import OrderedDict, defaultdict
+
 import arrow
 from dateutil.rrule import FR, MO, SA, SU, TH, TU, WE, rrule, rruleset, rrulestr
 from future.utils import iteritems
 
+from inbox.config import config
 from inbox.events.util import parse_rrule_datetime
 from inbox.logging import get_logger
-from inbox.models.event import RecurringEvent, RecurringEventOverride
+from inbox.models.event import InflatedEvent, RecurringEvent, RecurringEventOverride
 
 from .timezones import timezones_table
 
@@ -14,6 +19,8 @@ log = get_logger()
 
 # How far in the future to expand recurring events
 EXPAND_RECURRING_YEARS = 1
+# How many expanded (event, window) start time lists each process caches.
+OCCURRENCE_CACHE_SIZE = config.get("RECURRING_OCCURRENCE_CACHE_SIZE", 1000)
 
 
 def link_events(db_session, event):
@@ -109,6 +116,12 @@ def get_start_times(event, start=None, end=None):
     # otherwise defaults to the event start date and now + 1 year;
     # this can return a lot of instances if the event recurs more frequently
     # than weekly!
+    return list(iter_start_times(event, start, end))
+
+
+def iter_start_times(event, start=None, end=None):
+    # Like get_start_times, but expands the rrule lazily, in order, so that
+    # callers that only need the first few instances can stop early.
 
     if isinstance(event, RecurringEvent):
         # Localize first so that expansion covers DST
@@ -134,7 +147,8 @@ def get_start_times(event, start=None, end=None):
         rrules = parse_rrule(event)
         if not rrules:
             log.warn("Tried to expand a non-recurring event", event_id=event.id)
-            return [event.start]
+            yield event.start
+            return
 
         excl_dates = parse_exdate(event)
 
@@ -148,22 +162,188 @@ def get_start_times(event, start=None, end=None):
             for excl_date in excl_dates:
                 rrules.exdate(excl_date)
 
-        # Return all start times between start and end, including start and
+        # Yield all start times between start and end, including start and
         # end themselves if they obey the rule.
         if event.all_day:
             # compare naive times, since date handling in rrulestr is naive
             # when UNTIL takes the form YYYYMMDD
             start = start.to("utc").naive
             end = end.to("utc").naive
+        else:
+            start = start.datetime
+            end = end.datetime
+
+        for t in rrules:
+            if t < start:
+                continue
+            if t > end:
+                return
+            # Convert back to UTC, which covers daylight savings differences
+            yield arrow.get(t).to("utc")
+        return
+
+    yield event.start
+
+
+class OccurrenceCache(object):
+    """
+    An LRU cache of the expanded start times of recurring events, for windows
+    with both a start and an end.
+
+    Entries are keyed by the event id, a hash of everything the expansion
+    depends on (the rule, its exceptions, the start time and timezone, and
+    whether the event lasts all day) and the window. An event that changed
+    misses the cache of every process, so entries are never invalidated;
+    stale ones age out. Overrides aren't part of the expansion: they are
+    applied on top of the cached start times. `invalidate` only frees the
+    entries of an event in the current process.
+
+    """
+
+    def __init__(self, size=OCCURRENCE_CACHE_SIZE):
+        self.size = size
+        self._entries = OrderedDict()
+        self._keys_by_event = defaultdict(set)
+
+    def key(self, event, start, end):
+        rule = "|".join(
+            str(value)
+            for value in (
+                event.rrule,
+                event.exdate,
+                event.start.to("utc").isoformat(),
+                event.start_timezone,
+                event.all_day,
+            )
+        )
+        rule_hash = hashlib.sha1(rule.encode("utf-8")).hexdigest()
+        return (event.id, rule_hash, arrow.get(start), arrow.get(end))
 
-        start_times = rrules.between(start, end, inc=True)
+    def get(self, key):
+        start_times = self._entries.get(key)
+        if start_times is not None:
+            self._entries.move_to_end(key)
+        return start_times
 
-        # Convert back to UTC, which covers daylight savings differences
-        start_times = [arrow.get(t).to("utc") for t in start_times]
+    def set(self, key, start_times):
+        self._entries[key] = start_times
+        self._entries.move_to_end(key)
+        self._keys_by_event[key[0]].add(key)
+        while len(self._entries) > self.size:
+            old_key, _ = self._entries.popitem(last=False)
+            self._discard_key(old_key)
+
+    def invalidate(self, event_id):
+        for key in self._keys_by_event.pop(event_id, ()):
+            self._entries.pop(key, None)
+
+    def _discard_key(self, key):
+        keys = self._keys_by_event.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_event[key[0]]
+
+
+occurrence_cache = OccurrenceCache()
+
+
+def cached_start_times(event, start=None, end=None):
+    """
+    Iterate over the start times of a recurring event, in order, like
+    `iter_start_times`.
+
+    The start times of windows with a start and an end are taken from
+    `occurrence_cache`, and are added to it once they have been expanded
+    completely. Open-ended windows depend on the current time, so they
+    aren't cached.
+
+    """
+    if start is None or end is None or event.id is None:
+        return iter_start_times(event, start, end)
+
+    key = occurrence_cache.key(event, start, end)
+    start_times = occurrence_cache.get(key)
+    if start_times is not None:
+        return iter(start_times)
+    return _expand_and_cache(key, event, start, end)
+
+
+def _expand_and_cache(key, event, start, end):
+    start_times = []
+    for t in iter_start_times(event, start, end):
+        start_times.append(t)
+        yield t
+    # Only reached if the caller consumed every start time.
+    occurrence_cache.set(key, start_times)
+
+
+def prefetch_overrides(db_session, masters):
+    """
+    Load the overrides of several recurring events with a single query.
+
+    Returns
+    -------
+    dict
+        The overrides of each master, by master id.
+
+    """
+    overrides = defaultdict(list)
+    calendar_ids = {master.id: master.calendar_id for master in masters}
+    if not calendar_ids:
+        return overrides
+    query = db_session.query(RecurringEventOverride).filter(
+        RecurringEventOverride.master_event_id.in_(list(calendar_ids))
+    )
+    for override in query:
+        # Overrides of events shared across calendars may have the same
+        # master; see RecurringEvent.all_events.
+        if override.calendar_id == calendar_ids[override.master_event_id]:
+            overrides[override.master_event_id].append(override)
+    return overrides
+
+
+def _window_overrides(overrides, start, end):
+    # The overrides RecurringEvent.all_events would return for a window.
+    overrides = [
+        o
+        for o in overrides
+        if (start is None or o.start > start) and (end is None or o.end < end)
+    ]
+    overridden_starts = {o.original_start_time for o in overrides}
+    return [o for o in overrides if not o.cancelled], overridden_starts
+
+
+def iter_occurrences(master, overrides, start=None, end=None):
+    """
+    Iterate over the instances of a recurring event in a window, ordered by
+    start time, like `RecurringEvent.all_events` does; but with prefetched
+    overrides (see `prefetch_overrides`), and lazily.
+
+    """
+    overrides, overridden_starts = _window_overrides(overrides, start, end)
+    inflated = (
+        InflatedEvent(master, t)
+        for t in cached_start_times(master, start, end)
+        if t not in overridden_starts
+    )
+    return heapq.merge(sorted(overrides, key=_start), inflated, key=_start)
+
+
+def count_occurrences(master, overrides, start=None, end=None):
+    """
+    Return the number of instances `iter_occurrences` would return, without
+    creating them.
+
+    """
+    overrides, overridden_starts = _window_overrides(overrides, start, end)
+    return len(overrides) + sum(
+        1 for t in cached_start_times(master, start, end) if t not in overridden_starts
+    )
 
-        return start_times
 
-    return [event.start]
+def _start(event):
+    return event.start
 
 
 # rrule constant values
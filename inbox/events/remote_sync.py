@@ -1,10 +1,15 @@
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
+from gevent.pool import Pool
 from requests.exceptions import HTTPError
 
 from inbox.basicauth import AccessNotEnabledError, OAuthError
 from inbox.config import config
-from inbox.contacts.processing import update_contacts_from_event
+from inbox.contacts.processing import (
+    update_contacts_from_event,
+    update_contacts_from_events,
+)
 from inbox.events.google import URL_PREFIX, GoogleEventsProvider
 from inbox.events.recurring import link_events
 from inbox.logging import get_logger
@@ -14,6 +19,7 @@ from inbox.models.event import RecurringEvent, RecurringEventOverride
 from inbox.models.session import session_scope
 from inbox.sync.base_sync import BaseSyncMonitor
 from inbox.util.debug import bind_context
+from inbox.util.itert import chunk
 
 logger = get_logger()
 
@@ -31,6 +37,16 @@ PUSH_NOTIFICATION_POLL_FREQUENCY = 10
 # push notification.
 MAX_TIME_WITHOUT_SYNC = timedelta(seconds=3600)
 
+# Persist remote event updates a chunk at a time: look up the local events,
+# contacts, masters and overrides of a chunk with a few queries and commit
+# once per chunk.
+EVENT_SYNC_BATCH_ENABLED = config.get("EVENT_SYNC_BATCH_ENABLED", False)
+EVENT_SYNC_CHUNK_SIZE = config.get("EVENT_SYNC_CHUNK_SIZE", 500)
+
+# The number of calendars of an account whose events are synced at the same
+# time.
+CALENDAR_SYNC_CONCURRENCY = config.get("CALENDAR_SYNC_CONCURRENCY", 1)
+
 
 class EventSync(BaseSyncMonitor):
     """Per-account event sync engine."""
@@ -158,6 +174,11 @@ def handle_calendar_updates(namespace_id, calendars, log, db_session):
 
 def handle_event_updates(namespace_id, calendar_id, events, log, db_session):
     """Persists new or updated Event objects to the database."""
+    if EVENT_SYNC_BATCH_ENABLED:
+        return handle_event_updates_batched(
+            namespace_id, calendar_id, events, log, db_session
+        )
+
     added_count = 0
     updated_count = 0
     existing_event_query = (
@@ -228,6 +249,134 @@ def handle_event_updates(namespace_id, calendar_id, events, log, db_session):
     )
 
 
+def handle_event_updates_batched(
+    namespace_id, calendar_id, events, log, db_session, chunk_size=None
+):
+    """
+    Like `handle_event_updates`, but handles the events `chunk_size` at a
+    time (EVENT_SYNC_CHUNK_SIZE by default). For each chunk, the local events
+    are looked up with one query, the contacts of all the events are resolved
+    together, recurring events are linked to their masters and overrides with
+    one query each, and the chunk is committed.
+
+    """
+    added_count = 0
+    updated_count = 0
+    existing_event_query = (
+        db_session.query(Event)
+        .filter(Event.namespace_id == namespace_id, Event.calendar_id == calendar_id)
+        .exists()
+    )
+    events_exist = db_session.query(existing_event_query).scalar()
+    for events_chunk in chunk(events, chunk_size or EVENT_SYNC_CHUNK_SIZE):
+        uids = set()
+        for event in events_chunk:
+            assert event.uid is not None, "Got remote item with null uid"
+            uids.add(event.uid)
+
+        local_events_by_uid = {}
+        if events_exist:
+            local_events_by_uid = {
+                local_event.uid: local_event
+                for local_event in db_session.query(Event).filter(
+                    Event.namespace_id == namespace_id,
+                    Event.calendar_id == calendar_id,
+                    Event.uid.in_(uids),
+                )
+            }
+
+        # Events that appear twice in the chunk are only persisted once.
+        local_events = OrderedDict()
+        for event in events_chunk:
+            local_event = local_events_by_uid.get(event.uid)
+            if local_event is not None:
+                # See handle_event_updates.
+                if (
+                    isinstance(local_event, RecurringEvent)
+                    and event.status == "cancelled"
+                    and local_event.status != "cancelled"
+                ):
+                    for override in local_event.overrides:
+                        override.status = "cancelled"
+
+                local_event.update(event)
+                local_event.participants = event.participants
+
+                updated_count += 1
+            else:
+                local_event = event
+                local_event.namespace_id = namespace_id
+                local_event.calendar_id = calendar_id
+                db_session.add(local_event)
+                local_events_by_uid[event.uid] = local_event
+                added_count += 1
+            local_events[event.uid] = local_event
+
+        local_events = list(local_events.values())
+        db_session.flush()
+
+        for local_event in local_events:
+            local_event.contacts = []
+        update_contacts_from_events(db_session, local_events, namespace_id)
+
+        _link_events_batched(db_session, namespace_id, calendar_id, local_events)
+
+        # Commit per chunk to avoid long transactions that may lock calendar
+        # rows.
+        db_session.commit()
+
+    log.info(
+        "synced added and updated events",
+        calendar_id=calendar_id,
+        added=added_count,
+        updated=updated_count,
+    )
+
+
+def _link_events_batched(db_session, namespace_id, calendar_id, events):
+    # Does what inbox.events.recurring.link_events does for each of the
+    # events, with one query for all the masters and one for all the
+    # overrides.
+    new_masters = {
+        (event.uid, event.source): event
+        for event in events
+        if isinstance(event, RecurringEvent)
+    }
+    masters = dict(new_masters)
+    orphans = [
+        event
+        for event in events
+        if isinstance(event, RecurringEventOverride)
+        and not event.master
+        and event.master_event_uid
+    ]
+
+    if orphans:
+        for master in db_session.query(RecurringEvent).filter(
+            RecurringEvent.namespace_id == namespace_id,
+            RecurringEvent.calendar_id == calendar_id,
+            RecurringEvent.uid.in_({event.master_event_uid for event in orphans}),
+        ):
+            masters.setdefault((master.uid, master.source), master)
+        for event in orphans:
+            master = masters.get((event.master_event_uid, event.source))
+            if master is not None:
+                event.master = master
+
+    if new_masters:
+        overrides = db_session.query(RecurringEventOverride).filter(
+            RecurringEventOverride.namespace_id == namespace_id,
+            RecurringEventOverride.calendar_id == calendar_id,
+            RecurringEventOverride.master_event_uid.in_(
+                {uid for uid, _ in new_masters}
+            ),
+        )
+        for override in overrides:
+            master = new_masters.get((override.master_event_uid, override.source))
+            if master is not None and not override.master:
+                override.master = master
+
+
 class GoogleEventSync(EventSync):
     def __init__(self, *args, **kwargs):
         super(GoogleEventSync, self).__init__(*args, **kwargs)
@@ -345,26 +494,50 @@ class GoogleEventSync(EventSync):
                 stale_calendars, key=lambda cal: cal.uid != account_email
             )
 
-            for cal in stale_calendars_sorted:
-                try:
-                    self._sync_calendar(cal, db_session)
-                except HTTPError as exc:
-                    if exc.response.status_code == 404:
-                        self.log.warning(
-                            "Tried to sync a deleted calendar."
-                            "Deleting local calendar.",
-                            calendar_id=cal.id,
-                            calendar_uid=cal.uid,
-                        )
-                        _delete_calendar(db_session, cal)
-                    else:
-                        self.log.error(
-                            "Error while syncing calendar",
-                            cal_id=cal.id,
-                            calendar_uid=cal.uid,
-                            status_code=exc.response.status_code,
-                        )
-                        raise exc
+            if CALENDAR_SYNC_CONCURRENCY <= 1:
+                for cal in stale_calendars_sorted:
+                    self._sync_calendar_or_delete(cal, db_session)
+                return
+
+            calendar_ids = [cal.id for cal in stale_calendars_sorted]
+
+        # Each calendar is synced in its own greenlet and session, so that
+        # the total time tracks the largest calendar rather than the sum.
+        pool = Pool(CALENDAR_SYNC_CONCURRENCY)
+        greenlets = [
+            pool.spawn(self._sync_calendar_by_id, calendar_id)
+            for calendar_id in calendar_ids
+        ]
+        pool.join()
+        for greenlet in greenlets:
+            # Re-raises the first error, as the sequential sync would.
+            greenlet.get()
+
+    def _sync_calendar_by_id(self, calendar_id):
+        with session_scope(self.namespace_id) as db_session:
+            cal = db_session.query(Calendar).get(calendar_id)
+            if cal is not None:
+                self._sync_calendar_or_delete(cal, db_session)
+
+    def _sync_calendar_or_delete(self, cal, db_session):
+        try:
+            self._sync_calendar(cal, db_session)
+        except HTTPError as exc:
+            if exc.response.status_code == 404:
+                self.log.warning(
+                    "Tried to sync a deleted calendar." "Deleting local calendar.",
+                    calendar_id=cal.id,
+                    calendar_uid=cal.uid,
+                )
+                _delete_calendar(db_session, cal)
+            else:
+                self.log.error(
+                    "Error while syncing calendar",
+                    cal_id=cal.id,
+                    calendar_uid=cal.uid,
+                    status_code=exc.response.status_code,
+                )
+                raise exc
 
     def _sync_calendar_list(self, account, db_session):
         sync_timestamp = datetime.utcnow()
@@ -380,13 +553,14 @@ class GoogleEventSync(EventSync):
 
     def _sync_calendar(self, calendar, db_session):
         sync_timestamp = datetime.utcnow()
-        event_changes = self.provider.sync_events(
+        # Persist each page of events as soon as it's fetched, rather than
+        # holding all the events of the calendar in memory.
+        for event_changes in self.provider.sync_event_pages(
             calendar.uid, sync_from_time=calendar.last_synced
-        )
-
-        handle_event_updates(
-            self.namespace_id, calendar.id, event_changes, self.log, db_session
-        )
+        ):
+            handle_event_updates(
+                self.namespace_id, calendar.id, event_changes, self.log, db_session
+            )
         calendar.last_synced = sync_timestamp
         db_session.commit()
 
@@ -5,6 +5,9 @@ from inbox.config import config
 STATUS_DATABASE = 1
 
 ALIVE_EXPIRY = int(config.get("BASE_ALIVE_THRESHOLD", 480))
+# If set, heartbeats are written at most once per this many seconds per folder,
+# in one pipeline per Redis shard. 0 writes every heartbeat immediately.
+PUBLISH_INTERVAL = float(config.get("HEARTBEAT_PUBLISH_INTERVAL", 0))
 REDIS_SHARDS = config.get("REDIS_SHARDS")
 REDIS_PORT = int(config.get("REDIS_PORT"))
 
@@ -15,6 +18,9 @@ MAX_CONNECTIONS = 70
 WAIT_TIMEOUT = 15
 SOCKET_TIMEOUT = 60
 
+assert (
+    PUBLISH_INTERVAL < ALIVE_EXPIRY
+), "HEARTBEAT_PUBLISH_INTERVAL must be well below BASE_ALIVE_THRESHOLD"
 assert REDIS_SHARDS is not None, "REDIS_SHARDS is None. Did you set NYLAS_ENV?"
 connection_pool_map = {instance_name: None for instance_name in REDIS_SHARDS}
 
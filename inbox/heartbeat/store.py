@@ -1,5 +1,9 @@
 import itertools
 import time
+from collections import defaultdict
+from typing import Optional
+
+import gevent
 
 # We're doing this weird rename import to make it easier to monkeypatch
 # get_redis_client. That's the only way we have to test our very brittle
@@ -57,6 +61,127 @@ class HeartbeatStatusKey(object):
         return cls(account_id, folder_id)
 
 
+class HeartbeatAggregator(object):
+    """
+    Coalesces heartbeat writes for a process.
+
+    Publishing only records the folder's latest heartbeat timestamp in memory;
+    a background greenlet writes all the recorded timestamps every `interval`
+    seconds, with one ZADD per account and one pipeline per Redis shard. A
+    folder is therefore written at most once per interval, and its timestamp
+    in Redis lags by at most `interval` seconds, which is well within
+    ALIVE_EXPIRY.
+
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        # (account_id, folder_id) -> latest heartbeat timestamp.
+        self._pending = {}
+        self._greenlet = None
+        # Every flush takes the next generation. Discards are recorded with
+        # the generation at the time, (account_id, folder_id or None) ->
+        # generation, so that flushes can tell which of the heartbeats they
+        # took were cleared while they were writing them.
+        self._generation = 0
+        self._in_flight = set()
+        self._discarded = {}
+
+    def add(self, key, timestamp):
+        self._pending[(key.account_id, key.folder_id)] = timestamp
+        if self._greenlet is None or self._greenlet.dead:
+            self._greenlet = gevent.spawn(self._run)
+
+    def discard(self, account_id, folder_id=None):
+        # Make sure that a flush doesn't bring cleared heartbeats back.
+        for pending_key in list(self._pending):
+            if pending_key[0] == account_id and folder_id in (None, pending_key[1]):
+                del self._pending[pending_key]
+        if self._in_flight:
+            self._discarded[(account_id, folder_id)] = self._generation
+
+    def _discarded_since(self, generation, account_id, folder_id):
+        return (
+            self._discarded.get((account_id, folder_id), -1) > generation
+            or self._discarded.get((account_id, None), -1) > generation
+        )
+
+    def flush(self):
+        pending, self._pending = self._pending, {}
+        generation = self._generation
+        self._generation += 1
+        self._in_flight.add(generation)
+        try:
+            self._write(generation, pending)
+        finally:
+            self._in_flight.discard(generation)
+            # Discards from before the oldest flush still writing are moot.
+            oldest = min(self._in_flight, default=self._generation)
+            self._discarded = {
+                key: discarded_at
+                for key, discarded_at in self._discarded.items()
+                if discarded_at > oldest
+            }
+
+    def _write(self, generation, pending):
+        by_shard = defaultdict(lambda: defaultdict(list))
+        for (account_id, folder_id), timestamp in pending.items():
+            shard_num = heartbeat_config.account_redis_shard_number(account_id)
+            by_shard[shard_num][account_id].extend((timestamp, folder_id))
+
+        for accounts in by_shard.values():
+            client = heartbeat_config.get_redis_client(next(iter(accounts)))
+            pipeline = client.pipeline(transaction=False)
+            for account_id, score_member_pairs in accounts.items():
+                pipeline.zadd(account_id, *score_member_pairs)
+            try:
+                pipeline.execute()
+            except Exception:
+                # Retry with the next flush, unless the folder has published
+                # a newer heartbeat or been cleared since.
+                for (account_id, folder_id), timestamp in pending.items():
+                    if account_id in accounts and not self._discarded_since(
+                        generation, account_id, folder_id
+                    ):
+                        self._pending.setdefault((account_id, folder_id), timestamp)
+                raise
+
+            # Heartbeats cleared while the pipeline was running may have been
+            # removed before it wrote them, so remove them again.
+            cleared = [
+                (account_id, folder_id)
+                for (account_id, folder_id) in pending
+                if account_id in accounts
+                and self._discarded_since(generation, account_id, folder_id)
+            ]
+            if cleared:
+                pipeline = client.pipeline(transaction=False)
+                for account_id, folder_id in cleared:
+                    pipeline.zrem(account_id, folder_id)
+                pipeline.execute()
+
+    def _run(self):
+        while True:
+            gevent.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                log.error("Error flushing heartbeats", exc_info=True)
+
+
+_aggregator = None
+
+
+def get_heartbeat_aggregator():
+    # type: () -> Optional[HeartbeatAggregator]
+    global _aggregator
+    if not heartbeat_config.PUBLISH_INTERVAL:
+        return None
+    if _aggregator is None:
+        _aggregator = HeartbeatAggregator(heartbeat_config.PUBLISH_INTERVAL)
+    return _aggregator
+
+
 class HeartbeatStatusProxy(object):
     def __init__(
         self,
@@ -112,6 +237,10 @@ class HeartbeatStore(object):
 
     @safe_failure
     def publish(self, key, timestamp):
+        aggregator = get_heartbeat_aggregator()
+        if aggregator is not None:
+            aggregator.add(key, float(timestamp))
+            return
         # Update indexes
         self.update_folder_index(key, float(timestamp))
 
@@ -124,6 +253,7 @@ class HeartbeatStore(object):
             # If that was the only entry, also remove from folder index.
             devices = client.hkeys(key)
             if devices in [[str(device_id)], []]:
+                self._discard_pending(key)
                 self.remove_from_folder_index(key, client)
         else:
             client.delete(key)
@@ -132,6 +262,9 @@ class HeartbeatStore(object):
     @safe_failure
     def remove_folders(self, account_id, folder_id=None, device_id=None):
         # Remove heartbeats for the given account, folder and/or device.
+        if not device_id:
+            self._discard_pending(HeartbeatStatusKey(account_id, folder_id))
+
         if folder_id:
             key = HeartbeatStatusKey(account_id, folder_id)
             self.remove(key, device_id)
@@ -154,6 +287,17 @@ class HeartbeatStore(object):
             pipeline.reset()
             return n
 
+    def _discard_pending(self, key):
+        # Make sure that a flush doesn't bring cleared heartbeats back. Only
+        # for folders that are taken out of the index: clearing one of the
+        # devices of a folder leaves its heartbeat alone.
+        aggregator = get_heartbeat_aggregator()
+        if aggregator is None:
+            return
+        if isinstance(key, str):
+            key = HeartbeatStatusKey.from_string(key)
+        aggregator.discard(key.account_id, key.folder_id)
+
     def update_folder_index(self, key, timestamp):
         assert isinstance(timestamp, float)
         # Update the folder timestamp index for this specific account, too
@@ -171,7 +171,13 @@ class EngineManager(object):
                 self._engine_zones[key] = zone
 
     def shard_key_for_id(self, id_):
-        return 0
+        """
+        Return the key of the shard an object lives on. The auto_increment of
+        every table of a shard starts at ``key << 48`` (see `init_db`), so the
+        key is in the top 16 bits of the id.
+
+        """
+        return int(id_) >> 48
 
     def get_for_id(self, id_):
         return self.engines[self.shard_key_for_id(id_)]
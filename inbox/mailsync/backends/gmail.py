@@ -30,6 +30,7 @@ from gevent.lock import Semaphore
 from past.builtins import long
 from sqlalchemy.orm import joinedload, load_only
 
+from inbox.contacts.processing import ContactResolver
 from inbox.logging import get_logger
 from inbox.mailsync.backends.base import THROTTLE_COUNT, THROTTLE_WAIT
 from inbox.mailsync.backends.imap import common
@@ -306,7 +307,7 @@ class GmailFolderSyncEngine(FolderSyncEngine):
                 .filter_by(account_id=self.account_id, folder_id=self.folder_id)
                 .one()
             )
-            with self.conn_pool.get() as crispin_client:
+            with self.conn_pool.get(self.folder_name) as crispin_client:
                 crispin_client.select_folder(self.folder_name, lambda *args: True)
                 uidvalidity = crispin_client.selected_uidvalidity
                 if uidvalidity <= imap_folder_info_entry.uidvalidity:
@@ -450,12 +451,17 @@ class GmailFolderSyncEngine(FolderSyncEngine):
             if not raw_messages:
                 return 0
 
+            contact_resolver = ContactResolver(self.namespace_id)
             for msg in raw_messages:
-                uid = self.create_message(db_session, account, folder, msg)
+                uid = self.create_message(
+                    db_session, account, folder, msg, contact_resolver=contact_resolver
+                )
                 if uid is not None:
                     db_session.add(uid)
-                    db_session.commit()
+                    db_session.flush()
                     new_uids.add(uid)
+            contact_resolver.resolve(db_session)
+            db_session.commit()
 
         log.debug("Committed new UIDs", new_committed_message_count=len(new_uids))
         # If we downloaded uids, record message velocity (#uid / latency)
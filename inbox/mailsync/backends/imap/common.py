@@ -14,21 +14,29 @@ accounts.
 from future import standard_library
 
 standard_library.install_aliases()
+import time
 from datetime import datetime
 
 from sqlalchemy import bindparam, desc
+from sqlalchemy.orm import joinedload, subqueryload
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.sql.expression import func
 
+from inbox.config import config
 from inbox.contacts.processing import update_contacts_from_message
 from inbox.logging import get_logger
 from inbox.models import Account, ActionLog, Folder, Message, MessageCategory
 from inbox.models.backends.imap import ImapFolderInfo, ImapUid
 from inbox.models.session import session_scope
 from inbox.models.util import reconcile_message
+from inbox.util.itert import chunk
+from inbox.util.stats import statsd_client
 
 log = get_logger()
 
+# Number of expunged UIDs removed per database transaction.
+REMOVE_DELETED_UIDS_CHUNK_SIZE = config.get("REMOVE_DELETED_UIDS_CHUNK_SIZE", 100)
+
 
 def local_uids(account_id, session, folder_id, limit=None):
     q = session.query(ImapUid.msg_uid)
@@ -150,68 +158,96 @@ def update_metadata(account_id, folder_id, folder_role, new_flags, session):
     log.info("Updated UID metadata", changed=change_count, out_of=len(new_flags))
 
 
-def remove_deleted_uids(account_id, folder_id, uids):
+def remove_deleted_uids(account_id, folder_id, uids, chunk_size=None):
     """
     Make sure you're holding a db write lock on the account. (We don't try
     to grab the lock in here in case the caller needs to put higher-level
     functionality in the lock.)
 
+    UIDs are removed `chunk_size` at a time, with one transaction per chunk.
+
     """
     if not uids:
         return
+    if chunk_size is None:
+        chunk_size = REMOVE_DELETED_UIDS_CHUNK_SIZE
+    start = time.time()
     deleted_uid_count = 0
-    for uid in uids:
-        # We do this one-uid-at-a-time because issuing many deletes within a
-        # single database transaction is problematic. But loading many
-        # objects into a session and then frequently calling commit() is also
-        # bad, because expiring objects and checking for revisions is O(number
-        # of objects in session), resulting in quadratic runtimes.
-        # Performance could perhaps be additionally improved by choosing a
-        # sane balance, e.g., operating on 10 or 100 uids or something at once.
+    # Issuing many deletes within a single database transaction is
+    # problematic, and so is loading many objects into a session and then
+    # frequently calling commit(), because expiring objects and checking for
+    # revisions is O(number of objects in session). Bounded chunks strike a
+    # balance between the two.
+    for uid_chunk in chunk(sorted(uids), chunk_size):
         with session_scope(account_id) as db_session:
-            imapuid = (
-                db_session.query(ImapUid)
-                .filter(
-                    ImapUid.account_id == account_id,
-                    ImapUid.folder_id == folder_id,
-                    ImapUid.msg_uid == uid,
-                )
-                .first()
+            deleted_uid_count += _remove_deleted_uid_chunk(
+                db_session, account_id, folder_id, uid_chunk
             )
-            if imapuid is None:
-                continue
-            deleted_uid_count += 1
-            message = imapuid.message
-
-            db_session.delete(imapuid)
-
-            if message is not None:
-                if not message.imapuids and message.is_draft:
-                    # Synchronously delete drafts.
-                    thread = message.thread
-                    if thread is not None:
-                        thread.messages.remove(message)
-                        # Thread.messages relationship is versioned i.e. extra
-                        # logic gets executed on remove call.
-                        # This early flush is needed so the configure_versioning logic
-                        # in inbox.model.sessions can work reliably on newer versions of
-                        # SQLAlchemy.
-                        db_session.flush()
-                    db_session.delete(message)
-                    if thread is not None and not thread.messages:
-                        db_session.delete(thread)
-                else:
-                    account = Account.get(account_id, db_session)
-                    update_message_metadata(
-                        db_session, account, message, message.is_draft
-                    )
-                    if not message.imapuids:
-                        # But don't outright delete messages. Just mark them as
-                        # 'deleted' and wait for the asynchronous
-                        # dangling-message-collector to delete them.
-                        message.mark_for_deletion()
             db_session.commit()
-    log.info("Deleted expunged UIDs", count=deleted_uid_count)
+
+    elapsed = time.time() - start
+    log.info("Deleted expunged UIDs", count=deleted_uid_count, elapsed=elapsed)
+    statsd_client.incr("mailsync.remove_deleted_uids.count", deleted_uid_count)
+    if deleted_uid_count and elapsed > 0:
+        statsd_client.gauge(
+            "mailsync.remove_deleted_uids.rows_per_sec", deleted_uid_count / elapsed
+        )
+
+
+def _remove_deleted_uid_chunk(db_session, account_id, folder_id, uids):
+    imapuids = (
+        db_session.query(ImapUid)
+        .filter(
+            ImapUid.account_id == account_id,
+            ImapUid.folder_id == folder_id,
+            ImapUid.msg_uid.in_(uids),
+        )
+        .all()
+    )
+    if not imapuids:
+        return 0
+
+    message_ids = {imapuid.message_id for imapuid in imapuids}
+    for imapuid in imapuids:
+        db_session.delete(imapuid)
+    # Flush before loading the messages so that their remaining imapuids
+    # don't include the ones we just deleted.
+    db_session.flush()
+
+    account = Account.get(account_id, db_session)
+    messages = (
+        db_session.query(Message)
+        .filter(Message.id.in_(message_ids))
+        .options(
+            subqueryload(Message.imapuids),
+            subqueryload(Message.messagecategories).joinedload("category"),
+            joinedload("thread"),
+        )
+        .all()
+    )
+    for message in messages:
+        if not message.imapuids and message.is_draft:
+            # Synchronously delete drafts.
+            thread = message.thread
+            if thread is not None:
+                thread.messages.remove(message)
+                # Thread.messages relationship is versioned i.e. extra
+                # logic gets executed on remove call.
+                # This early flush is needed so the configure_versioning logic
+                # in inbox.model.sessions can work reliably on newer versions of
+                # SQLAlchemy.
+                db_session.flush()
+            db_session.delete(message)
+            if thread is not None and not thread.messages:
+                db_session.delete(thread)
+        else:
+            update_message_metadata(db_session, account, message, message.is_draft)
+            if not message.imapuids:
+                # But don't outright delete messages. Just mark them as
+                # 'deleted' and wait for the asynchronous
+                # dangling-message-collector to delete them.
+                message.mark_for_deletion()
+    return len(imapuids)
 
 
 def get_folder_info(account_id, session, folder_name):
@@ -227,10 +263,18 @@ def get_folder_info(account_id, session, folder_name):
         return None
 
 
-def create_imap_message(db_session, account, folder, msg):
+def create_imap_message(
+    db_session, account, folder, msg, new_message=None, contact_resolver=None
+):
     """
     IMAP-specific message creation logic.
 
+    If `new_message` is given, it must be the uncommitted Message created from
+    `msg` with `Message.create_from_synced`; otherwise it's created here.
+
+    If `contact_resolver` (a ContactResolver) is given, the message's contacts
+    are left to it; otherwise they're created here.
+
     Returns
     -------
     imapuid : inbox.models.backends.imap.ImapUid
@@ -241,13 +285,14 @@ def create_imap_message(db_session, account, folder, msg):
     log.debug(
         "creating message", account_id=account.id, folder_name=folder.name, mid=msg.uid
     )
-    new_message = Message.create_from_synced(
-        account=account,
-        mid=msg.uid,
-        folder_name=folder.name,
-        received_date=msg.internaldate,
-        body_string=msg.body,
-    )
+    if new_message is None:
+        new_message = Message.create_from_synced(
+            account=account,
+            mid=msg.uid,
+            folder_name=folder.name,
+            received_date=msg.internaldate,
+            body_string=msg.body,
+        )
 
     # Check to see if this is a copy of a message that was first created
     # by the Nylas API. If so, don't create a new object; just use the old one.
@@ -269,7 +314,10 @@ def create_imap_message(db_session, account, folder, msg):
         )
         update_message_metadata(db_session, account, new_message, is_draft)
 
-    update_contacts_from_message(db_session, new_message, account.namespace.id)
+    if contact_resolver is not None:
+        contact_resolver.add(new_message)
+    else:
+        update_contacts_from_message(db_session, new_message, account.namespace.id)
 
     return imapuid
 
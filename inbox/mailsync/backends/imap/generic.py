@@ -74,13 +74,23 @@ from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
 
 from inbox.basicauth import ValidationError
+from inbox.config import config
+from inbox.contacts.processing import ContactResolver
 from inbox.logging import get_logger
 from inbox.util.concurrency import retry_with_logging
 from inbox.util.debug import bind_context
 from inbox.util.itert import chunk
 from inbox.util.misc import or_none
 from inbox.util.stats import statsd_client
-from inbox.util.threading import MAX_THREAD_LENGTH, fetch_corresponding_thread
+from inbox.util.threading import (
+    MAX_THREAD_LENGTH,
+    MESSAGE_COUNT_RECOUNT_MARGIN,
+    THREADING_INDEX_ENABLED,
+    fetch_corresponding_thread,
+    fetch_indexed_thread,
+    index_message,
+    thread_message_count,
+)
 
 log = get_logger()
 from inbox.crispin import FolderMissingError, connection_pool, retry_crispin
@@ -93,6 +103,10 @@ from inbox.mailsync.backends.base import (
     MailsyncError,
 )
 from inbox.mailsync.backends.imap import common
+from inbox.mailsync.backends.imap.pipeline import (
+    INGEST_PIPELINE_ENABLED,
+    IngestPipeline,
+)
 from inbox.models import Account, Folder, Message
 from inbox.models.backends.imap import (
     ImapFolderInfo,
@@ -119,6 +133,16 @@ MAX_UIDINVALID_RESYNCS = 5
 
 CONDSTORE_FLAGS_REFRESH_BATCH_SIZE = 200
 
+# Download several UIDs per FETCH during initial sync of generic IMAP folders.
+# Batches stay within both the byte and the count budget, except that a single
+# message bigger than the byte budget makes a batch on its own (message sizes
+# come from RFC822.SIZE).
+BATCH_DOWNLOAD_ENABLED = config.get("IMAP_BATCH_DOWNLOAD_ENABLED", False)
+MAX_BATCH_DOWNLOAD_BYTES = config.get("IMAP_MAX_BATCH_DOWNLOAD_BYTES", 2 ** 22)
+MAX_BATCH_DOWNLOAD_COUNT = config.get("IMAP_MAX_BATCH_DOWNLOAD_COUNT", 50)
+# Number of UIDs whose sizes are looked up ahead of downloading them.
+BATCH_DOWNLOAD_SIZES_LOOKAHEAD = 1000
+
 
 class FolderSyncEngine(Greenlet):
     """Base class for a per-folder IMAP sync engine."""
@@ -366,8 +390,10 @@ class FolderSyncEngine(Greenlet):
             self._report_initial_sync_start()
             self.is_first_sync = False
 
-        with self.conn_pool.get() as crispin_client:
-            crispin_client.select_folder(self.folder_name, uidvalidity_cb)
+        with self.conn_pool.get(self.folder_name) as crispin_client:
+            # The initial sync lists the folder's UIDs itself, so an existing
+            # session on the folder (and its HIGHESTMODSEQ) will do.
+            crispin_client.select_folder_if_necessary(self.folder_name, uidvalidity_cb)
             # Ensure we have an ImapFolderInfo row created prior to sync start.
             with session_scope(self.namespace_id) as db_session:
                 try:
@@ -444,9 +470,10 @@ class FolderSyncEngine(Greenlet):
             change_poller = gevent.spawn(self.poll_for_changes)
             bind_context(change_poller, "changepoller", self.account_id, self.folder_id)
             uids = sorted(new_uids, reverse=True)
+            if BATCH_DOWNLOAD_ENABLED and not throttled:
+                self.download_uid_batches(crispin_client, uids)
+                return
             for count, uid in enumerate(uids, start=1):
-                # The speedup from batching appears to be less clear for
-                # non-Gmail accounts, so for now just download one-at-a-time.
                 self.download_and_commit_uids(crispin_client, [uid])
                 self.heartbeat_status.publish()
                 if throttled and count >= THROTTLE_COUNT:
@@ -461,6 +488,50 @@ class FolderSyncEngine(Greenlet):
                 # schedule change_poller to die
                 gevent.kill(change_poller)
 
+    def download_uid_batches(
+        self,
+        crispin_client,
+        uids,
+        max_download_bytes=MAX_BATCH_DOWNLOAD_BYTES,
+        max_download_count=MAX_BATCH_DOWNLOAD_COUNT,
+    ):
+        """Download `uids` (in the given order) in batches bounded by
+        `max_download_bytes` and `max_download_count`."""
+        batches = self._uid_batches(
+            crispin_client, uids, max_download_bytes, max_download_count
+        )
+        if INGEST_PIPELINE_ENABLED:
+            IngestPipeline(self, crispin_client).run(batches)
+            return
+        for batch in batches:
+            self.download_and_commit_uids(crispin_client, batch)
+            self.heartbeat_status.publish()
+
+    def _uid_batches(
+        self, crispin_client, uids, max_download_bytes, max_download_count
+    ):
+        sizes = {}
+        batch = []
+        dl_size = 0
+        for uid_chunk in chunk(uids, BATCH_DOWNLOAD_SIZES_LOOKAHEAD):
+            sizes.update(crispin_client.sizes(uid_chunk))
+            for uid in uid_chunk:
+                # Unknown sizes only count towards the count budget.
+                msg_size = sizes.pop(uid, 0)
+                # Close the batch before the message would take it over the
+                # byte budget. Messages bigger than the budget get a batch of
+                # their own.
+                if batch and dl_size + msg_size > max_download_bytes:
+                    yield batch
+                    batch, dl_size = [], 0
+                batch.append(uid)
+                dl_size += msg_size
+                if len(batch) >= max_download_count:
+                    yield batch
+                    batch, dl_size = [], 0
+        if batch:
+            yield batch
+
     def should_idle(self, crispin_client):
         if not hasattr(self, "_should_idle"):
             self._should_idle = (
@@ -470,10 +541,13 @@ class FolderSyncEngine(Greenlet):
         return self._should_idle
 
     def poll_impl(self):
-        with self.conn_pool.get() as crispin_client:
+        with self.conn_pool.get(self.folder_name) as crispin_client:
             self.check_uid_changes(crispin_client)
             if self.should_idle(crispin_client):
-                crispin_client.select_folder(self.folder_name, self.uidvalidity_cb)
+                # IDLE only needs the folder selected.
+                crispin_client.select_folder_if_necessary(
+                    self.folder_name, self.uidvalidity_cb
+                )
                 idling = True
                 try:
                     crispin_client.idle(IDLE_WAIT)
@@ -504,7 +578,7 @@ class FolderSyncEngine(Greenlet):
     def resync_uids_impl(self):
         # First, let's check if the UIVDALIDITY change was spurious, if
         # it is, just discard it and go on.
-        with self.conn_pool.get() as crispin_client:
+        with self.conn_pool.get(self.folder_name) as crispin_client:
             crispin_client.select_folder(self.folder_name, lambda *args: True)
             remote_uidvalidity = crispin_client.selected_uidvalidity
             remote_uidnext = crispin_client.selected_uidnext
@@ -536,7 +610,9 @@ class FolderSyncEngine(Greenlet):
             log.debug("polling for changes")
             self.poll_impl()
 
-    def create_message(self, db_session, acct, folder, msg):
+    def create_message(
+        self, db_session, acct, folder, msg, new_message=None, contact_resolver=None
+    ):
         assert acct is not None and acct.namespace is not None
 
         # Check if we somehow already saved the imapuid (shouldn't happen, but
@@ -563,7 +639,14 @@ class FolderSyncEngine(Greenlet):
             log.warning("Server returned a message with an empty body.")
             return None
 
-        new_uid = common.create_imap_message(db_session, acct, folder, msg)
+        new_uid = common.create_imap_message(
+            db_session,
+            acct,
+            folder,
+            msg,
+            new_message=new_message,
+            contact_resolver=contact_resolver,
+        )
         self.add_message_to_thread(db_session, new_uid.message, msg)
 
         db_session.flush()
@@ -604,6 +687,9 @@ class FolderSyncEngine(Greenlet):
     def add_message_to_thread(self, db_session, message_obj, raw_message):
         """Associate message_obj to the right Thread object, creating a new
         thread if necessary."""
+        if THREADING_INDEX_ENABLED:
+            return self._add_message_to_indexed_thread(db_session, message_obj)
+
         with db_session.no_autoflush:
             # Disable autoflush so we don't try to flush a message with null
             # thread_id.
@@ -628,28 +714,83 @@ class FolderSyncEngine(Greenlet):
             else:
                 parent_thread.messages.append(message_obj)
 
+    def _add_message_to_indexed_thread(self, db_session, message_obj):
+        # Like add_message_to_thread, but looks the thread up in the threading
+        # index and keeps Thread.message_count up to date instead of counting
+        # the thread's messages, unless the count is close to the limit.
+        # Messages of an account are committed under its syncmanager_lock, so
+        # the count can't race.
+        with db_session.no_autoflush:
+            parent_thread = fetch_indexed_thread(
+                db_session, self.namespace_id, message_obj
+            )
+            if (
+                parent_thread is not None
+                and thread_message_count(
+                    db_session,
+                    parent_thread,
+                    recount_from=MAX_THREAD_LENGTH - MESSAGE_COUNT_RECOUNT_MARGIN,
+                )
+                < MAX_THREAD_LENGTH
+            ):
+                parent_thread.messages.append(message_obj)
+                parent_thread.message_count += 1
+            else:
+                message_obj.thread = ImapThread.from_imap_message(
+                    db_session, self.namespace_id, message_obj
+                )
+                message_obj.thread.message_count = 1
+
+        # Gmail threads by X-GM-THRID and never reads the index, so only the
+        # messages threaded here are indexed.
+        db_session.flush()
+        index_message(db_session, self.namespace_id, message_obj, message_obj.thread_id)
+
     def download_and_commit_uids(self, crispin_client, uids):
         start = datetime.utcnow()
         raw_messages = crispin_client.uids(uids)
         if not raw_messages:
             return 0
+        return self.commit_messages(raw_messages, start=start, batched=len(uids) > 1)
 
+    def commit_messages(
+        self, raw_messages, parsed_messages=None, start=None, batched=False
+    ):
+        """Create and commit the given downloaded messages. Returns the number
+        of new UIDs.
+
+        `parsed_messages` optionally maps UIDs to Messages that were already
+        created from the raw messages (see `IngestPipeline`); the others are
+        parsed here."""
+        start = start or datetime.utcnow()
+        parsed_messages = parsed_messages or {}
         new_uids = set()
+        contact_resolver = ContactResolver(self.namespace_id)
         with self.syncmanager_lock, session_scope(self.namespace_id) as db_session:
             account = Account.get(self.account_id, db_session)
             folder = Folder.get(self.folder_id, db_session)
             for msg in raw_messages:
-                uid = self.create_message(db_session, account, folder, msg)
+                uid = self.create_message(
+                    db_session,
+                    account,
+                    folder,
+                    msg,
+                    parsed_messages.get(msg.uid),
+                    contact_resolver=contact_resolver,
+                )
                 if uid is not None:
                     db_session.add(uid)
                     db_session.flush()
                     new_uids.add(uid)
+            contact_resolver.resolve(db_session)
             db_session.commit()
 
         log.debug("Committed new UIDs", new_committed_message_count=len(new_uids))
         # If we downloaded uids, record message velocity (#uid / latency)
         if self.state == "initial" and len(new_uids):
-            self._report_message_velocity(datetime.utcnow() - start, len(new_uids))
+            elapsed = datetime.utcnow() - start
+            self._report_message_velocity(elapsed, len(new_uids))
+            self._report_message_throughput(elapsed, len(new_uids), batched)
         if self.is_first_message:
             self._report_first_message()
             self.is_first_message = False
@@ -688,6 +829,22 @@ class FolderSyncEngine(Greenlet):
         for metric in metrics:
             statsd_client.timing(metric, latency_per_uid)
 
+    def _report_message_throughput(self, timedelta, num_uids, batched):
+        # Messages/sec, split by download mode so that batched and
+        # one-at-a-time downloads can be compared per provider.
+        seconds = timedelta.total_seconds()
+        if seconds <= 0:
+            return
+        mode = "batched" if batched else "single"
+        metrics = [
+            ".".join(
+                ["mailsync", "providers", self.provider_name, mode, "messages_per_sec"]
+            ),
+            ".".join(["mailsync", "providers", "overall", mode, "messages_per_sec"]),
+        ]
+        for metric in metrics:
+            statsd_client.gauge(metric, num_uids / seconds)
+
     def update_uid_counts(self, db_session, **kwargs):
         saved_status = (
             db_session.query(ImapFolderSyncStatus)
@@ -12,6 +12,7 @@ from inbox.mailsync.backends.base import BaseMailSyncMonitor
 from inbox.mailsync.backends.imap.generic import FolderSyncEngine
 from inbox.mailsync.gc import DeleteHandler
 from inbox.models import Account, Folder
+from inbox.models.backends.imap import ImapUid
 from inbox.models.category import Category, sanitize_name
 from inbox.models.session import session_scope
 
@@ -165,6 +166,7 @@ class ImapSyncMonitor(BaseMailSyncMonitor):
                 namespace_id=self.namespace_id,
                 provider_name=self.provider_name,
                 uid_accessor=lambda m: m.imapuids,
+                uid_class=ImapUid,
             )
             self.delete_handler.start()
 
@@ -0,0 +1,155 @@
+"""
+A pipelined download path for the initial sync of IMAP folders.
+
+Downloading a batch of messages involves three stages that mostly wait on
+different things: fetching the raw messages (the IMAP server), parsing them
+and saving them to the blockstore (CPU, S3) and committing them (MySQL, and
+the account's syncmanager_lock). `FolderSyncEngine.download_and_commit_uids`
+runs them back to back for every batch. `IngestPipeline` instead runs each
+stage in its own greenlet, connected by bounded queues, so that e.g. the next
+batch is being fetched while the previous one is committed. When a stage falls
+behind, the queue in front of it fills up and the stages before it block.
+
+For every batch, the time spent in each stage and the depth of the queue in
+front of it are reported to statsd, so that the stage that limits the
+throughput can be identified per provider:
+
+    mailsync.providers.<provider>.ingest.<stage>.latency
+    mailsync.providers.<provider>.ingest.<stage>.queue_depth
+
+"""
+import time
+
+import gevent
+from gevent.queue import Full, Queue
+
+from inbox.config import config
+from inbox.models import Account, Message
+from inbox.models.session import session_scope
+from inbox.util.stats import statsd_client
+
+# Only batched downloads (IMAP_BATCH_DOWNLOAD_ENABLED) go through the pipeline.
+INGEST_PIPELINE_ENABLED = config.get("IMAP_INGEST_PIPELINE_ENABLED", False)
+# Batches that may wait in front of the parse and the commit stage each.
+INGEST_QUEUE_DEPTH = config.get("IMAP_INGEST_QUEUE_DEPTH", 2)
+
+# Sentinel that tells a stage that there are no more batches.
+_DONE = object()
+
+
+class IngestPipeline(object):
+    """
+    Downloads, parses and commits batches of UIDs of a folder concurrently.
+
+    Parameters
+    ----------
+    engine : inbox.mailsync.backends.imap.generic.FolderSyncEngine
+        The engine of the folder, which commits the messages.
+    crispin_client : inbox.crispin.CrispinClient
+        A client with the folder selected. Only the fetch stage uses it.
+    queue_depth : int
+        How many batches may wait in front of each of the later stages.
+    """
+
+    def __init__(self, engine, crispin_client, queue_depth=INGEST_QUEUE_DEPTH):
+        self.engine = engine
+        self.crispin_client = crispin_client
+        self.parse_queue = Queue(maxsize=queue_depth)
+        self.commit_queue = Queue(maxsize=queue_depth)
+        self.committed = 0
+        self._stages = []
+
+    def run(self, batches):
+        """
+        Download and commit the given batches of UIDs, in order. Returns the
+        number of messages that were committed.
+
+        Raises the first exception of any stage; the other stages are stopped
+        then.
+        """
+        self._stages = [
+            gevent.spawn(self._parse_stage),
+            gevent.spawn(self._commit_stage),
+        ]
+        try:
+            for uids in batches:
+                start = time.time()
+                raw_messages = self.crispin_client.uids(uids)
+                self._report("fetch", start)
+                if raw_messages:
+                    self._put(self.parse_queue, (raw_messages, len(uids) > 1))
+            self._put(self.parse_queue, _DONE)
+            for stage in self._stages:
+                # Re-raises the exception of a failed stage.
+                stage.get()
+        finally:
+            gevent.killall(self._stages)
+        return self.committed
+
+    def _parse_stage(self):
+        while True:
+            item = self.parse_queue.get()
+            if item is _DONE:
+                self._put(self.commit_queue, _DONE)
+                return
+            raw_messages, batched = item
+            start = time.time()
+            parsed_messages = self._parse(raw_messages)
+            self._report("parse", start, self.parse_queue)
+            self._put(self.commit_queue, (raw_messages, parsed_messages, batched))
+
+    def _parse(self, raw_messages):
+        # The messages aren't added to this session; the commit stage adds
+        # them to its own along with their ImapUids.
+        parsed_messages = {}
+        with session_scope(self.engine.namespace_id) as db_session:
+            account = Account.get(self.engine.account_id, db_session)
+            for msg in raw_messages:
+                if msg.body is None:
+                    # The commit stage logs and skips these.
+                    continue
+                parsed_messages[msg.uid] = Message.create_from_synced(
+                    account=account,
+                    mid=msg.uid,
+                    folder_name=self.engine.folder_name,
+                    received_date=msg.internaldate,
+                    body_string=msg.body,
+                )
+                # Let the other stages run between messages.
+                gevent.sleep(0)
+        return parsed_messages
+
+    def _commit_stage(self):
+        while True:
+            item = self.commit_queue.get()
+            if item is _DONE:
+                return
+            raw_messages, parsed_messages, batched = item
+            start = time.time()
+            self.committed += self.engine.commit_messages(
+                raw_messages, parsed_messages=parsed_messages, batched=batched
+            )
+            self.engine.heartbeat_status.publish()
+            self._report("commit", start, self.commit_queue)
+
+    def _put(self, queue, item):
+        # Block while the queue is full, but notice if a later stage failed
+        # rather than waiting for it forever.
+        while True:
+            for stage in self._stages:
+                if stage.ready() and not stage.successful():
+                    raise stage.exception
+            try:
+                queue.put(item, timeout=1)
+                return
+            except Full:
+                continue
+
+    def _report(self, stage, start, queue=None):
+        latency = (time.time() - start) * 1000
+        prefix = ".".join(
+            ["mailsync", "providers", self.engine.provider_name, "ingest", stage]
+        )
+        statsd_client.timing(prefix + ".latency", latency)
+        if queue is not None:
+            statsd_client.gauge(prefix + ".queue_depth", queue.qsize())
@@ -76,9 +76,22 @@ class ProfilingHTTPFrontend(HTTPFrontend):
 
 
 class SyncbackHTTPFrontend(ProfilingHTTPFrontend):
+    def __init__(self, syncback_service, port, trace_greenlets, profile):
+        self.syncback_service = syncback_service
+        super(SyncbackHTTPFrontend, self).__init__(port, trace_greenlets, profile)
+
     def greenlet_tracer_cls(self):
         return KillerGreenletTracer
 
+    def _create_app_impl(self, app):
+        super(SyncbackHTTPFrontend, self)._create_app_impl(app)
+
+        @app.route("/syncback-queues")
+        def syncback_queues():
+            # account id -> queue depth and latency percentiles (in seconds)
+            queues = self.syncback_service.stats.summary()
+            return jsonify({str(k): v for k, v in queues.items()})
+
 
 class SyncHTTPFrontend(ProfilingHTTPFrontend):
     def __init__(self, sync_service, port, trace_greenlets, profile):
@@ -4,9 +4,10 @@ standard_library.install_aliases()
 import datetime
 
 import gevent
-from sqlalchemy import func
+from sqlalchemy import and_, exists, false, func, or_
 from sqlalchemy.orm import load_only
 
+from inbox.config import config
 from inbox.crispin import connection_pool
 from inbox.logging import get_logger
 from inbox.mailsync.backends.imap import common
@@ -19,6 +20,7 @@ from inbox.models.session import session_scope
 from inbox.util.concurrency import retry_with_logging
 from inbox.util.debug import bind_context
 from inbox.util.itert import chunk
+from inbox.util.stats import statsd_client
 
 log = get_logger()
 
@@ -26,6 +28,14 @@ DEFAULT_MESSAGE_TTL = 2 * 60  # 2 minutes
 DEFAULT_THREAD_TTL = 60 * 60 * 24 * 7  # 7 days
 MAX_FETCH = 1000
 
+# Find and delete dangling messages and categories a batch at a time, with
+# set-based queries, rather than one by one. Requires the DeleteHandler to be
+# given the uid_class.
+GC_SET_BASED_ENABLED = config.get("GC_SET_BASED_ENABLED", False)
+# The number of messages or categories deleted per transaction in set-based
+# mode. Bounds how long InnoDB locks taken by the deletes are held.
+GC_COMMIT_BATCH_SIZE = config.get("GC_COMMIT_BATCH_SIZE", 100)
+
 
 class DeleteHandler(gevent.Greenlet):
     """
@@ -51,6 +61,10 @@ class DeleteHandler(gevent.Greenlet):
     message_ttl: int
         Number of seconds to wait after a message is marked for deletion before
         deleting it for good.
+    uid_class: type, optional
+        The model of the uid objects, which must have a `message_id` column.
+        For IMAP sync, this would be `ImapUid`. Needed to find dangling
+        messages with a single query when GC_SET_BASED_ENABLED is set.
 
     """
 
@@ -62,12 +76,14 @@ class DeleteHandler(gevent.Greenlet):
         uid_accessor,
         message_ttl=DEFAULT_MESSAGE_TTL,
         thread_ttl=DEFAULT_THREAD_TTL,
+        uid_class=None,
     ):
         bind_context(self, "deletehandler", account_id)
         self.account_id = account_id
         self.namespace_id = namespace_id
         self.provider_name = provider_name
         self.uids_for_message = uid_accessor
+        self.uid_class = uid_class
         self.log = log.new(account_id=account_id)
         self.message_ttl = datetime.timedelta(seconds=message_ttl)
         self.thread_ttl = datetime.timedelta(seconds=thread_ttl)
@@ -81,8 +97,12 @@ class DeleteHandler(gevent.Greenlet):
 
     def _run_impl(self):
         current_time = datetime.datetime.utcnow()
-        self.check(current_time)
-        self.gc_deleted_categories()
+        if GC_SET_BASED_ENABLED and self.uid_class is not None:
+            self.check_set_based(current_time)
+            self.gc_deleted_categories_set_based()
+        else:
+            self.check(current_time)
+            self.gc_deleted_categories()
         self.gc_deleted_threads(current_time)
         gevent.sleep(self.message_ttl.total_seconds())
 
@@ -153,6 +173,135 @@ class DeleteHandler(gevent.Greenlet):
                 # transaction.
                 db_session.commit()
 
+    def check_set_based(self, current_time):
+        """
+        Like `check`, but finds the dangling messages of a batch, and the
+        messages that are still referenced by uids, with a single query, and
+        recomputes the attributes of all the threads the batch touched with
+        aggregate queries. Each batch of up to GC_COMMIT_BATCH_SIZE messages
+        is committed separately, and at most MAX_FETCH messages are handled
+        per call. Returns the number of messages deleted.
+
+        """
+        deleted = 0
+        handled = 0
+        has_uids = exists().where(self.uid_class.message_id == Message.id)
+        with session_scope(self.namespace_id) as db_session:
+            while handled < MAX_FETCH:
+                batch = (
+                    db_session.query(Message, has_uids)
+                    .filter(
+                        Message.namespace_id == self.namespace_id,
+                        Message.deleted_at <= current_time - self.message_ttl,
+                        Message.thread_id.isnot(None),
+                    )
+                    .order_by(Message.deleted_at)
+                    .limit(min(GC_COMMIT_BATCH_SIZE, MAX_FETCH - handled))
+                    .all()
+                )
+                if not batch:
+                    break
+                handled += len(batch)
+
+                thread_ids = set()
+                for message, is_referenced in batch:
+                    if is_referenced:
+                        # Not actually dangling, undelete it.
+                        message.deleted_at = None
+                        continue
+                    thread_ids.add(message.thread_id)
+                    db_session.delete(message)
+                    deleted += 1
+                db_session.flush()
+                self._update_threads(db_session, thread_ids)
+                db_session.commit()
+
+            self._report_lag(db_session, current_time)
+        return deleted
+
+    def _update_threads(self, db_session, thread_ids):
+        # Recompute the attributes of the threads from their remaining
+        # messages, the same way `check` does.
+        if not thread_ids:
+            return
+        message_counts = dict(
+            db_session.query(Message.thread_id, func.count(Message.id))
+            .filter(Message.thread_id.in_(thread_ids))
+            .group_by(Message.thread_id)
+        )
+        bounds = (
+            db_session.query(
+                Message.thread_id.label("thread_id"),
+                func.min(Message.received_date).label("first_date"),
+                func.max(Message.received_date).label("last_date"),
+            )
+            .filter(Message.thread_id.in_(thread_ids), Message.is_draft == false())
+            .group_by(Message.thread_id)
+            .subquery()
+        )
+        first_messages = {}
+        last_messages = {}
+        rows = (
+            db_session.query(
+                Message.thread_id,
+                Message.received_date,
+                Message.subject,
+                Message.snippet,
+                bounds.c.first_date,
+                bounds.c.last_date,
+            )
+            .join(
+                bounds,
+                and_(
+                    Message.thread_id == bounds.c.thread_id,
+                    or_(
+                        Message.received_date == bounds.c.first_date,
+                        Message.received_date == bounds.c.last_date,
+                    ),
+                ),
+            )
+            .filter(Message.is_draft == false())
+            .order_by(Message.id)
+        )
+        for thread_id, received_date, subject, snippet, first_date, last_date in rows:
+            if received_date == first_date:
+                first_messages.setdefault(thread_id, (subject, received_date))
+            if received_date == last_date:
+                last_messages[thread_id] = (snippet, received_date)
+
+        for thread in db_session.query(Thread).filter(Thread.id.in_(thread_ids)):
+            # Removing messages from a thread changes it even if none of its
+            # attributes do.
+            thread.dirty = True
+            if thread.message_count is not None:
+                thread.message_count = message_counts.get(thread.id, 0)
+            if not message_counts.get(thread.id):
+                # See `check` for why empty threads aren't deleted right away.
+                thread.mark_for_deletion()
+            elif thread.id in first_messages:
+                thread.subject, thread.subjectdate = first_messages[thread.id]
+                thread.snippet, thread.recentdate = last_messages[thread.id]
+
+    def _report_lag(self, db_session, current_time):
+        # How long the oldest marked message is overdue for deletion.
+        oldest = (
+            db_session.query(func.min(Message.deleted_at))
+            .filter(
+                Message.namespace_id == self.namespace_id,
+                Message.deleted_at.isnot(None),
+            )
+            .scalar()
+        )
+        lag = 0
+        if oldest is not None:
+            lag = max(0, (current_time - self.message_ttl - oldest).total_seconds())
+        statsd_client.timing(
+            ".".join(["mailsync", "providers", self.provider_name, "gc", "lag"]),
+            lag * 1000,
+        )
+        if lag:
+            self.log.info("Dangling messages overdue for deletion", lag=lag)
+
     def gc_deleted_categories(self):
         # Delete categories which have been deleted on the backend.
         # Go through all the categories and check if there are messages
@@ -175,6 +324,28 @@ class DeleteHandler(gevent.Greenlet):
                     db_session.delete(category)
                     db_session.commit()
 
+    def gc_deleted_categories_set_based(self):
+        """
+        Like `gc_deleted_categories`, but finds the deleted categories that no
+        message uses with a single query.
+
+        """
+        with session_scope(self.namespace_id) as db_session:
+            categories = (
+                db_session.query(Category)
+                .filter(
+                    Category.namespace_id == self.namespace_id,
+                    Category.deleted_at > EPOCH,
+                    ~exists().where(MessageCategory.category_id == Category.id),
+                )
+                .limit(MAX_FETCH)
+                .all()
+            )
+            for categories_chunk in chunk(categories, GC_COMMIT_BATCH_SIZE):
+                for category in categories_chunk:
+                    db_session.delete(category)
+                db_session.commit()
+
     def gc_deleted_threads(self, current_time):
         with session_scope(self.namespace_id) as db_session:
             deleted_threads = (
@@ -16,7 +16,7 @@ from inbox.heartbeat.status import clear_heartbeat_status
 from inbox.logging import get_logger
 from inbox.mailsync.backends import module_registry
 from inbox.models import Account
-from inbox.models.session import global_session_scope, session_scope
+from inbox.models.session import query_shards, session_scope
 from inbox.providers import providers
 from inbox.scheduling.event_queue import EventQueue, EventQueueGroup
 from inbox.util.concurrency import retry_with_logging
@@ -224,8 +224,8 @@ class SyncService(object):
                 log_uncaught_errors()
 
     def account_ids_to_sync(self):
-        with global_session_scope() as db_session:
-            return {
+        def query(db_session):
+            return [
                 r[0]
                 for r in db_session.query(Account.id)
                 .filter(
@@ -246,16 +246,21 @@ class SyncService(object):
                     ),
                 )
                 .all()
-            }
+            ]
+
+        # Accounts of any shard may be assigned to this process.
+        return {id_ for ids in query_shards(query) for id_ in ids}
 
     def account_ids_owned(self):
-        with global_session_scope() as db_session:
-            return {
+        def query(db_session):
+            return [
                 r[0]
                 for r in db_session.query(Account.id)
                 .filter(Account.sync_host == self.process_identifier)
                 .all()
-            }
+            ]
+
+        return {id_ for ids in query_shards(query) for id_ in ids}
 
     def register_pending_avgs_provider(self, pending_avgs_provider):
         self._pending_avgs_provider = pending_avgs_provider
@@ -35,10 +35,21 @@ from inbox.models.mixins import (
 from inbox.providers import provider_info
 from inbox.scheduling.event_queue import EventQueue
 from inbox.sqlalchemy_ext.util import JSON, MutableDict
+from inbox.util.auth_cache import invalidate_namespace_auth
 
 log = get_logger()
 
 
+def is_marked_for_deletion(sync_state, sync_should_run, sync_status):
+    # Whether an account with these column values was marked for deletion,
+    # for callers that only load the columns.
+    return (
+        sync_state in ("stopped", "killed", "invalid")
+        and sync_should_run is False
+        and (sync_status or {}).get("sync_disabled_reason") == "account deleted"
+    )
+
+
 # Note, you should never directly create Account objects. Instead you
 # should use objects that inherit from this, such as GenericAccount or
 # GmailAccount
@@ -287,12 +298,14 @@ class Account(
         self.sync_state = "stopped"
         # Commit this to prevent race conditions
         inspect(self).session.commit()
+        invalidate_namespace_auth(self.namespace.public_id)
 
     def unmark_for_deletion(self):
         self.enable_sync()
         self._sync_status = {}
         self.sync_state = "running"
         inspect(self).session.commit()
+        invalidate_namespace_auth(self.namespace.public_id)
 
     def sync_stopped(self, requesting_host):
         """
@@ -328,10 +341,8 @@ class Account(
 
     @property
     def is_marked_for_deletion(self):
-        return (
-            self.sync_state in ("stopped", "killed", "invalid")
-            and self.sync_should_run is False
-            and self._sync_status.get("sync_disabled_reason") == "account deleted"
+        return is_marked_for_deletion(
+            self.sync_state, self.sync_should_run, self._sync_status
         )
 
     @property
@@ -2,38 +2,223 @@
 Generic OAuth class that provides abstraction for access and
 refresh tokens.
 """
+import base64
+import json
+import time
+import uuid
 from datetime import datetime, timedelta
 from typing import Union
 
+import gevent
+from gevent.lock import Semaphore
+from redis import StrictRedis
 from sqlalchemy import Column, ForeignKey
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.orm import relationship
 
 from inbox.basicauth import OAuthError
+from inbox.config import config
 from inbox.logging import get_logger
 from inbox.models.secret import Secret, SecretType
+from inbox.security.oracles import get_decryption_oracle, get_encryption_oracle
+from inbox.util.stats import statsd_client
 
 log = get_logger()
 
+# Share access tokens between processes through Redis, and let only one
+# process at a time refresh the token of an account.
+OAUTH_TOKEN_CACHE_ENABLED = config.get("OAUTH_TOKEN_CACHE_ENABLED", False)
+OAUTH_TOKEN_CACHE_REDIS_HOSTNAME = config.get(
+    "OAUTH_TOKEN_CACHE_REDIS_HOSTNAME", config.get("TXN_REDIS_HOSTNAME")
+)
+OAUTH_TOKEN_CACHE_REDIS_DB = config.get(
+    "OAUTH_TOKEN_CACHE_REDIS_DB", config.get("TXN_REDIS_DB")
+)
+# How long a process waits for another one to refresh a token before it
+# refreshes the token itself, in seconds. Also bounds how long the refresh
+# lock is held if its holder dies.
+OAUTH_TOKEN_REFRESH_TIMEOUT = config.get("OAUTH_TOKEN_REFRESH_TIMEOUT", 10)
+REFRESH_POLL_INTERVAL = 0.1
+# Tokens are considered expired this many seconds before they actually
+# expire.
+EXPIRATION_MARGIN = 10
+
+SOCKET_CONNECT_TIMEOUT = 5
+SOCKET_TIMEOUT = 5
+
+
+def _get_redis_client():
+    return StrictRedis(
+        host=OAUTH_TOKEN_CACHE_REDIS_HOSTNAME,
+        port=int(config.get("REDIS_PORT")),
+        db=OAUTH_TOKEN_CACHE_REDIS_DB,
+        socket_connect_timeout=SOCKET_CONNECT_TIMEOUT,
+        socket_timeout=SOCKET_TIMEOUT,
+    )
+
 
 class TokenManager(object):
-    def __init__(self):
+    """
+    Caches the access tokens of OAuth accounts until they expire.
+
+    Concurrent requests for the token of an account in a process result in a
+    single refresh. If OAUTH_TOKEN_CACHE_ENABLED is set, tokens are also
+    cached in Redis, encrypted like other secrets, and a lock in Redis makes
+    the processes that need the token of an account at the same time wait for
+    a single one of them to refresh it.
+    """
+
+    def __init__(self, redis=None):
+        # account id -> (token, expiration, time of refresh)
         self._tokens = {}
+        self._locks = {}
+        self._redis = redis
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            self._redis = _get_redis_client()
+        return self._redis
 
     def get_token(self, account, force_refresh=False):
-        if account.id in self._tokens:
-            token, expiration = self._tokens[account.id]
-            if not force_refresh and expiration > datetime.utcnow():
+        if not force_refresh:
+            token = self._get_cached_token(account.id)
+            if token is not None:
+                return token
+
+        requested_at = time.time()
+        # A forced refresh means that the cached token was rejected, so only
+        # a token that was refreshed since will do.
+        refreshed_since = requested_at if force_refresh else None
+        lock = self._locks.setdefault(account.id, Semaphore())
+        with lock:
+            # Another greenlet may have refreshed the token while this one was
+            # waiting for the lock.
+            token = self._get_cached_token(account.id, refreshed_since)
+            if token is not None:
                 return token
+            if OAUTH_TOKEN_CACHE_ENABLED:
+                return self._refresh_shared_token(
+                    account, force_refresh, refreshed_since
+                )
+            return self._refresh_token(account, force_refresh)
 
+    def cache_token(self, account, token, expires_in):
+        expires_in -= EXPIRATION_MARGIN
+        now = time.time()
+        expiration = datetime.utcnow() + timedelta(seconds=expires_in)
+        self._tokens[account.id] = token, expiration, now
+        if OAUTH_TOKEN_CACHE_ENABLED and expires_in > 0:
+            with get_encryption_oracle("SECRET_ENCRYPTION_KEY") as e_oracle:
+                ciphertext, scheme = e_oracle.encrypt(token)
+            value = json.dumps(
+                {
+                    "token": base64.b64encode(ciphertext).decode("ascii"),
+                    "encryption_scheme": scheme,
+                    "expires_at": now + expires_in,
+                    "refreshed_at": now,
+                }
+            )
+            try:
+                self.redis.set(self._cache_key(account.id), value, ex=int(expires_in))
+            except Exception:
+                log.warning(
+                    "Error caching access token", account_id=account.id, exc_info=True
+                )
+
+    def _get_cached_token(self, account_id, refreshed_since=None):
+        if account_id in self._tokens:
+            token, expiration, refreshed_at = self._tokens[account_id]
+            if expiration > datetime.utcnow() and (
+                refreshed_since is None or refreshed_at >= refreshed_since
+            ):
+                return token
+        if not OAUTH_TOKEN_CACHE_ENABLED:
+            return None
+
+        try:
+            value = self.redis.get(self._cache_key(account_id))
+        except Exception:
+            log.warning(
+                "Error reading cached access token",
+                account_id=account_id,
+                exc_info=True,
+            )
+            return None
+        if value is None:
+            return None
+        value = json.loads(value)
+        if value["expires_at"] <= time.time() or (
+            refreshed_since is not None and value["refreshed_at"] < refreshed_since
+        ):
+            return None
+        with get_decryption_oracle("SECRET_ENCRYPTION_KEY") as d_oracle:
+            token = d_oracle.decrypt(
+                base64.b64decode(value["token"]),
+                encryption_scheme=value["encryption_scheme"],
+            ).decode("utf-8")
+        expiration = datetime.utcfromtimestamp(value["expires_at"])
+        self._tokens[account_id] = token, expiration, value["refreshed_at"]
+        return token
+
+    def _refresh_shared_token(self, account, force_refresh, refreshed_since):
+        lock_key = self._lock_key(account.id)
+        lock_owner = uuid.uuid4().hex
+        try:
+            acquired = self.redis.set(
+                lock_key, lock_owner, nx=True, ex=OAUTH_TOKEN_REFRESH_TIMEOUT
+            )
+        except Exception:
+            log.warning(
+                "Error acquiring token refresh lock",
+                account_id=account.id,
+                exc_info=True,
+            )
+            return self._refresh_token(account, force_refresh)
+
+        if not acquired:
+            # Another process is refreshing the token; wait for it.
+            statsd_client.incr("oauth.token_refresh.waits")
+            deadline = time.time() + OAUTH_TOKEN_REFRESH_TIMEOUT
+            while time.time() < deadline:
+                gevent.sleep(REFRESH_POLL_INTERVAL)
+                token = self._get_cached_token(account.id, refreshed_since)
+                if token is not None:
+                    return token
+            log.warning(
+                "Timed out waiting for token refresh by another process",
+                account_id=account.id,
+            )
+            return self._refresh_token(account, force_refresh)
+
+        try:
+            return self._refresh_token(account, force_refresh)
+        finally:
+            try:
+                if self.redis.get(lock_key) == lock_owner.encode("ascii"):
+                    self.redis.delete(lock_key)
+            except Exception:
+                log.warning(
+                    "Error releasing token refresh lock",
+                    account_id=account.id,
+                    exc_info=True,
+                )
+
+    def _refresh_token(self, account, force_refresh):
+        start = time.time()
+        statsd_client.incr("oauth.token_refresh.count")
         new_token, expires_in = account.new_token(force_refresh=force_refresh)
+        statsd_client.timing(
+            "oauth.token_refresh.latency", (time.time() - start) * 1000
+        )
         self.cache_token(account, new_token, expires_in)
         return new_token
 
-    def cache_token(self, account, token, expires_in):
-        expires_in -= 10
-        expiration = datetime.utcnow() + timedelta(seconds=expires_in)
-        self._tokens[account.id] = token, expiration
+    def _cache_key(self, account_id):
+        return "oauth-token:{}".format(account_id)
+
+    def _lock_key(self, account_id):
+        return "oauth-token-refresh-lock:{}".format(account_id)
 
 
 token_manager = TokenManager()
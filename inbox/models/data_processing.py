@@ -20,6 +20,9 @@ class DataProcessingCache(MailSyncBase, UpdatedAtMixin, DeletedAtMixin):
     _contact_groups = Column("contact_groups", MEDIUMBLOB)
     contact_rankings_last_updated = Column(DateTime)
     contact_groups_last_updated = Column(DateTime)
+    # See inbox.contacts.rankings.
+    _contact_aggregates = Column("contact_aggregates", MEDIUMBLOB)
+    contact_aggregates_rebuilt_at = Column(DateTime)
 
     @property
     def contact_rankings(self):
@@ -45,4 +48,17 @@ class DataProcessingCache(MailSyncBase, UpdatedAtMixin, DeletedAtMixin):
         self._contact_groups = zlib.compress(json.dumps(value).encode("utf-8"))
         self.contact_groups_last_updated = datetime.datetime.now()
 
+    @property
+    def contact_aggregates(self):
+        from inbox.contacts.rankings import ContactAggregates
+
+        if self._contact_aggregates is None:
+            return None
+        else:
+            return ContactAggregates.from_bytes(self._contact_aggregates)
+
+    @contact_aggregates.setter
+    def contact_aggregates(self, value):
+        self._contact_aggregates = value.to_bytes()
+
     __table_args__ = (UniqueConstraint("namespace_id"),)
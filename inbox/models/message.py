@@ -1,4 +1,3 @@
-import binascii
 import datetime
 import itertools
 import os
@@ -6,8 +5,6 @@ from collections import defaultdict
 from hashlib import sha256
 from typing import Any, DefaultDict, Dict, List, Optional, Set, Tuple, Union
 
-from flanker import mime
-from flanker.mime.message.part import MimePart
 from future.utils import iteritems
 from sqlalchemy import (
     BigInteger,
@@ -34,7 +31,6 @@ from sqlalchemy.orm import (
 )
 from sqlalchemy.sql.expression import false
 
-from inbox.config import config
 from inbox.logging import get_logger
 from inbox.models.account import Account
 from inbox.models.base import MailSyncBase
@@ -47,17 +43,22 @@ from inbox.models.mixins import (
     UpdatedAtMixin,
 )
 from inbox.security.blobstorage import decode_blob, encode_blob
-from inbox.sqlalchemy_ext.util import JSON, MAX_MYSQL_INTEGER, json_field_too_long
-from inbox.util.addr import parse_mimepart_address_header
+from inbox.sqlalchemy_ext.util import JSON, MAX_MYSQL_INTEGER
 from inbox.util.blockstore import save_to_blockstore
 from inbox.util.encoding import unicode_safe_truncate
-from inbox.util.html import HTMLParseError, plaintext2html, strip_tags
-from inbox.util.misc import get_internaldate, parse_references
+from inbox.util.mime_parse import (
+    SNIPPET_LENGTH,
+    MimeParseError,
+    ParsedAttachment,
+    ParsedMessage,
+    calculate_body,
+    calculate_html_snippet,
+    calculate_plaintext_snippet,
+    get_parse_service,
+)
 
 log = get_logger()
 
-SNIPPET_LENGTH = 191
-
 
 def _trim_filename(s, namespace_id, max_len=255):
     # type: (Optional[Union[str, bytes]], int, int) -> str
@@ -271,6 +272,9 @@ class Message(MailSyncBase, HasRevisions, HasPublicID, UpdatedAtMixin, DeletedAt
 
         Threads are not computed here; you gotta do that separately.
 
+        The message is parsed by the configured parse service, possibly in
+        another process (see inbox.util.mime_parse).
+
         Parameters
         ----------
         mid : int
@@ -300,248 +304,86 @@ class Message(MailSyncBase, HasRevisions, HasPublicID, UpdatedAtMixin, DeletedAt
 
         # Persist the processed message to the database
         msg.namespace_id = account.namespace.id
+        # Non-persisted instance attribute: the first value of each header, by
+        # lowercased name.
+        msg.parsed_headers = {}
 
-        try:
-            body_length = len(body_string)
-            if body_length > MAX_MESSAGE_BODY_PARSE_LENGTH:
-                raise Exception(
-                    "message length ({}) is over the parsing limit".format(body_length)
-                )
-            parsed = mime.from_string(body_string)  # type: MimePart
-            # Non-persisted instance attribute used by EAS.
-            msg.parsed_body = parsed
-            msg._parse_metadata(
-                parsed, body_string, received_date, account.id, folder_name, mid
-            )
-        except Exception as e:
-            parsed = None
-            # Non-persisted instance attribute used by EAS.
-            msg.parsed_body = ""
+        body_length = len(body_string)
+        if body_length > MAX_MESSAGE_BODY_PARSE_LENGTH:
             log.error(
                 "Error parsing message metadata",
                 folder_name=folder_name,
                 account_id=account.id,
-                error=e,
+                error=Exception(
+                    "message length ({}) is over the parsing limit".format(body_length)
+                ),
                 mid=mid,
             )
             msg._mark_error()
+            return msg
 
-        if parsed is not None:
-            plain_parts = []  # type: List[bytes]
-            html_parts = []  # type: List[bytes]
-            for mimepart in parsed.walk(with_self=parsed.content_type.is_singlepart()):
-                try:
-                    if mimepart.content_type.is_multipart():
-                        continue  # TODO should we store relations?
-                    msg._parse_mimepart(
-                        mid, mimepart, account.namespace.id, html_parts, plain_parts
-                    )
-                except (
-                    mime.DecodingError,
-                    AttributeError,
-                    RuntimeError,
-                    TypeError,
-                    binascii.Error,
-                    ValueError,
-                ) as e:
-                    if isinstance(e, ValueError) and not isinstance(
-                        e, UnicodeEncodeError
-                    ):
-                        message = e.args[0] if e.args else ""
-                        if (
-                            message
-                            != "string argument should contain only ASCII characters"
-                        ):
-                            raise
-
-                    log.error(
-                        "Error parsing message MIME parts",
-                        folder_name=folder_name,
-                        account_id=account.id,
-                        error=e,
-                        mid=mid,
-                    )
-                    msg._mark_error()
-            store_body = config.get("STORE_MESSAGE_BODIES", True)  # type: bool
-            msg.calculate_body(html_parts, plain_parts, store_body=store_body)
-
-            # Occasionally people try to send messages to way too many
-            # recipients. In such cases, empty the field and treat as a parsing
-            # error so that we don't break the entire sync.
-            for field in ("to_addr", "cc_addr", "bcc_addr", "references", "reply_to"):
-                value = getattr(msg, field)  # type: List[Any]
-                if json_field_too_long(value):
-                    log.error(
-                        "Recipient field too long",
-                        field=field,
-                        account_id=account.id,
-                        folder_name=folder_name,
-                        mid=mid,
-                    )
-                    setattr(msg, field, [])
-                    msg._mark_error()
-
-        return msg
-
-    def _parse_metadata(
-        self, parsed, body_string, received_date, account_id, folder_name, mid
-    ):
-        # type: (MimePart, bytes, Optional[datetime.datetime], int, str, int) -> None
-        mime_version = parsed.headers.get("Mime-Version")  # type: Optional[str]
-        # sometimes MIME-Version is '1.0 (1.0)', hence the .startswith()
-        if mime_version is not None and not mime_version.startswith("1.0"):
-            log.warning(
-                "Unexpected MIME-Version",
-                account_id=account_id,
-                folder_name=folder_name,
-                mid=mid,
-                mime_version=mime_version,
-            )
-
-        self.subject = parsed.subject  # type: Optional[str]
-        self.from_addr = parse_mimepart_address_header(parsed, "From")
-        self.sender_addr = parse_mimepart_address_header(parsed, "Sender")
-        self.reply_to = parse_mimepart_address_header(parsed, "Reply-To")
-        self.to_addr = parse_mimepart_address_header(parsed, "To")
-        self.cc_addr = parse_mimepart_address_header(parsed, "Cc")
-        self.bcc_addr = parse_mimepart_address_header(parsed, "Bcc")
-
-        self.in_reply_to = parsed.headers.get("In-Reply-To")  # type: Optional[str]
-
-        # The RFC mandates that the Message-Id header must be at most 998
-        # characters. Sadly, not everybody follows specs.
-        self.message_id_header = parsed.headers.get("Message-Id")  # type: Optional[str]
-        if self.message_id_header and len(self.message_id_header) > 998:
-            self.message_id_header = self.message_id_header[:998]
-            log.warning(
-                "Message-Id header too long. Truncating",
-                parsed.headers.get("Message-Id"),
-                logstash_tag="truncated_message_id",
-            )
-
-        self.received_date = (
-            received_date
-            if received_date
-            else get_internaldate(
-                parsed.headers.get("Date"), parsed.headers.get("Received")
+        try:
+            parsed = get_parse_service().parse(
+                body_string, received_date, account.id, folder_name, mid
             )
-        )
-
-        # It seems MySQL rounds up fractional seconds in a weird way,
-        # preventing us from reconciling messages correctly. See:
-        # https://github.com/nylas/sync-engine/commit/ed16b406e0a for
-        # more details.
-        self.received_date = self.received_date.replace(microsecond=0)
-
-        # Custom Nylas header
-        self.nylas_uid = parsed.headers.get("X-INBOX-ID")  # type: Optional[str]
-
-        # In accordance with JWZ (http://www.jwz.org/doc/threading.html)
-        self.references = parse_references(
-            parsed.headers.get("References", ""), parsed.headers.get("In-Reply-To", "")
-        )
-
-        self.size = len(body_string)  # includes headers text
-
-    def _parse_mimepart(self, mid, mimepart, namespace_id, html_parts, plain_parts):
-        # type: (int, MimePart, int, List[bytes], List[bytes]) -> None
-        disposition, _ = mimepart.content_disposition
-        content_id = mimepart.headers.get("Content-Id")  # type: Optional[str]
-        content_type, params = mimepart.content_type
-
-        filename = mimepart.detected_file_name  # type: Optional[str]
-        if filename == "":
-            filename = None
-
-        data = mimepart.body  # type: Optional[str]
-
-        is_text = content_type.startswith("text")
-        if disposition not in (None, "inline", "attachment"):
+        except MimeParseError as e:
+            # The parse worker died or timed out. Retrying would most likely
+            # do the same, so keep the message with what we know about it.
             log.error(
-                "Unknown Content-Disposition",
-                message_public_id=self.public_id,
-                bad_content_disposition=mimepart.content_disposition,
-            )
-            self._mark_error()
-            return
-
-        if disposition == "attachment":
-            self._save_attachment(
-                data, disposition, content_type, filename, content_id, namespace_id, mid
+                "Error parsing message metadata",
+                folder_name=folder_name,
+                account_id=account.id,
+                error=e,
+                mid=mid,
             )
-            return
+            msg._mark_error()
+            return msg
+        parsed.replay_log(log)
+        msg.parsed_headers = parsed.headers
+        msg._apply_parsed(parsed)
+        return msg
 
-        if disposition == "inline" and not (
-            is_text and filename is None and content_id is None
+    def _apply_parsed(self, parsed):
+        # type: (ParsedMessage) -> None
+        for attr in (
+            "subject",
+            "from_addr",
+            "sender_addr",
+            "reply_to",
+            "to_addr",
+            "cc_addr",
+            "bcc_addr",
+            "in_reply_to",
+            "message_id_header",
+            "received_date",
+            "nylas_uid",
+            "references",
+            "size",
+            "body",
+            "snippet",
         ):
-            # Some clients set Content-Disposition: inline on text MIME parts
-            # that we really want to treat as part of the text body. Don't
-            # treat those as attachments.
-            self._save_attachment(
-                data, disposition, content_type, filename, content_id, namespace_id, mid
-            )
-            return
-
-        if is_text:
-            if data is None:
-                return
-            normalized_data = data.encode("utf-8", "strict")  # type: bytes
-            normalized_data = normalized_data.replace(b"\r\n", b"\n").replace(
-                b"\r", b"\n"
-            )
-            if content_type == "text/html":
-                html_parts.append(normalized_data)
-            elif content_type == "text/plain":
-                plain_parts.append(normalized_data)
-            else:
-                log.info(
-                    "Saving other text MIME part as attachment",
-                    content_type=content_type,
-                    namespace_id=namespace_id,
-                )
-                self._save_attachment(
-                    data,
-                    "attachment",
-                    content_type,
-                    filename,
-                    content_id,
-                    namespace_id,
-                    mid,
-                )
-            return
-
-        # Finally, if we get a non-text MIME part without Content-Disposition,
-        # treat it as an attachment.
-        self._save_attachment(
-            data, "attachment", content_type, filename, content_id, namespace_id, mid
-        )
+            value = getattr(parsed, attr)
+            if value is not None:
+                setattr(self, attr, value)
+        for attachment in parsed.attachments:
+            self._save_attachment(attachment)
+        if parsed.decode_error:
+            self._mark_error()
 
-    def _save_attachment(
-        self,
-        data,
-        content_disposition,
-        content_type,
-        filename,
-        content_id,
-        namespace_id,
-        mid,
-    ):
-        # type: (Optional[str], str, str, Optional[str], Optional[str], int, int) -> None
+    def _save_attachment(self, attachment):
+        # type: (ParsedAttachment) -> None
         from inbox.models import Block, Part
 
         block = Block()
-        block.namespace_id = namespace_id
-        block.filename = _trim_filename(filename, namespace_id=namespace_id)
-        block.content_type = content_type
+        block.namespace_id = self.namespace_id
+        block.filename = _trim_filename(
+            attachment.filename, namespace_id=self.namespace_id
+        )
+        block.content_type = attachment.content_type
         part = Part(block=block, message=self)
-        if content_id:
-            content_id = content_id[:255]
-        part.content_id = content_id
-        part.content_disposition = content_disposition
-        data = data or ""
-        if not isinstance(data, bytes):
-            data = data.encode("utf-8", "strict")
-        block.data = data
+        part.content_id = attachment.content_id
+        part.content_disposition = attachment.content_disposition
+        block.data = attachment.data
 
     def _mark_error(self):
         # type: () -> None
@@ -568,39 +410,17 @@ class Message(MailSyncBase, HasRevisions, HasPublicID, UpdatedAtMixin, DeletedAt
 
     def calculate_body(self, html_parts, plain_parts, store_body=True):
         # type: (List[bytes], List[bytes], bool) -> None
-        html_body = b"".join(html_parts).decode("utf-8").strip()
-        plain_body = b"\n".join(plain_parts).decode("utf-8").strip()
-        if html_body:
-            self.snippet = self.calculate_html_snippet(html_body)
-            if store_body:
-                self.body = html_body
-            else:
-                self.body = None
-        elif plain_body:
-            self.snippet = self.calculate_plaintext_snippet(plain_body)
-            if store_body:
-                self.body = plaintext2html(plain_body, False)
-            else:
-                self.body = None
-        else:
-            self.body = None
-            self.snippet = u""
+        self.body, self.snippet = calculate_body(
+            html_parts, plain_parts, store_body=store_body, nylas_uid=self.nylas_uid
+        )
 
     def calculate_html_snippet(self, text):
         # type: (str) -> str
-        try:
-            text = strip_tags(text)
-        except HTMLParseError:
-            log.error(
-                "error stripping tags", message_nylas_uid=self.nylas_uid, exc_info=True
-            )
-            text = ""
-
-        return self.calculate_plaintext_snippet(text)
+        return calculate_html_snippet(text, nylas_uid=self.nylas_uid)
 
     def calculate_plaintext_snippet(self, text):
         # type: (str) -> str
-        return unicode_safe_truncate(" ".join(text.split()), SNIPPET_LENGTH)
+        return calculate_plaintext_snippet(text)
 
     @property
     def body(self):
@@ -706,7 +526,7 @@ class Message(MailSyncBase, HasRevisions, HasPublicID, UpdatedAtMixin, DeletedAt
         if self.decode_error:
             log.warning("Error getting message header", mid=mid)
             return
-        return self.parsed_body.headers.get(header)
+        return self.parsed_headers.get(header.lower())
 
     @classmethod
     def from_public_id(cls, public_id, namespace_id, db_session):
@@ -25,6 +25,8 @@ def load_models():
     from inbox.models.search import ContactSearchIndexCursor
     from inbox.models.secret import Secret
     from inbox.models.thread import Thread
+    from inbox.models.thread_counter import ThreadCounter
+    from inbox.models.threading_key import ThreadingKey
     from inbox.models.transaction import AccountTransaction, Transaction
     from inbox.models.when import Date, DateSpan, Time, TimeSpan, When
 
@@ -47,6 +49,8 @@ def load_models():
         ContactSearchIndexCursor,
         Secret,
         Thread,
+        ThreadCounter,
+        ThreadingKey,
         Transaction,
         When,
         Time,
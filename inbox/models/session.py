@@ -2,6 +2,7 @@ import sys
 import time
 from contextlib import contextmanager
 
+import gevent
 from sqlalchemy import event
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.horizontal_shard import ShardedSession
@@ -91,17 +92,28 @@ def new_session(engine, versioned=True):
 
 
 def configure_versioning(session):
+    from inbox.contacts.processing import (
+        cache_committed_contacts,
+        discard_uncommitted_contacts,
+    )
+    from inbox.models.thread_counter import snapshot_thread_counts, update_thread_counts
     from inbox.models.transaction import (
         bump_redis_txn_id,
         create_revisions,
         increment_versions,
         propagate_changes,
     )
+    from inbox.transactions.syncback_scheduler import (
+        collect_pending_actions,
+        discard_pending_actions,
+        notify_pending_actions,
+    )
 
     @event.listens_for(session, "before_flush")
     def before_flush(session, flush_context, instances):
         propagate_changes(session)
         increment_versions(session)
+        snapshot_thread_counts(session)
 
     @event.listens_for(session, "after_flush")
     def after_flush(session, flush_context):
@@ -120,8 +132,24 @@ def configure_versioning(session):
         except Exception:
             log.exception("bump_redis_txn_id exception")
             pass
+        update_thread_counts(session)
+        collect_pending_actions(session)
         create_revisions(session)
 
+    @event.listens_for(session, "after_commit")
+    def after_commit(session):
+        try:
+            notify_pending_actions(session)
+        except Exception:
+            # The syncback service's periodic scan will find the actions.
+            log.exception("notify_pending_actions exception")
+        cache_committed_contacts(session)
+
+    @event.listens_for(session, "after_rollback")
+    def after_rollback(session):
+        discard_pending_actions(session)
+        discard_uncommitted_contacts(session)
+
     return session
 
 
@@ -200,6 +228,12 @@ def session_scope_by_shard_id(shard_id, versioned=True):
 
 
 def shard_chooser(mapper, instance, clause=None):
+    if instance.id is None:
+        # A new object doesn't have a shard yet, and its related objects must
+        # end up on the same one. Create it in a session_scope() instead.
+        raise ValueError(
+            "Can't create {} in a global session".format(type(instance).__name__)
+        )
     return str(engine_manager.shard_key_for_id(instance.id))
 
 
@@ -230,3 +264,44 @@ def global_session_scope():
         yield session
     finally:
         session.close()
+
+
+def query_shards(fn, shard_ids=None, versioned=False):
+    """
+    Run a query against several shards concurrently.
+
+    Unlike a global_session_scope(), which queries the shards one after
+    another, this runs `fn` on every shard at the same time, each with a
+    session of its own.
+
+    Parameters
+    ----------
+    fn : callable
+        Called with the session of a shard; returns the results for it. The
+        session is closed once `fn` returns, so the results shouldn't be ORM
+        objects that are still used afterwards.
+    shard_ids : list of int, optional
+        The shards to query. Defaults to all shards.
+    versioned : bool
+        Do you want to enable the transaction log?
+
+    Returns
+    -------
+    list
+        The results of `fn`, ordered like `shard_ids` (by shard id by
+        default).
+
+    """
+    if shard_ids is None:
+        shard_ids = sorted(engine_manager.engines)
+
+    def query_shard(shard_id):
+        with session_scope_by_shard_id(shard_id, versioned) as db_session:
+            return fn(db_session)
+
+    greenlets = [gevent.spawn(query_shard, shard_id) for shard_id in shard_ids]
+    try:
+        gevent.joinall(greenlets, raise_error=True)
+    finally:
+        gevent.killall(greenlets)
+    return [greenlet.value for greenlet in greenlets]
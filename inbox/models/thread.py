@@ -56,6 +56,9 @@ class Thread(MailSyncBase, HasPublicID, HasRevisions, UpdatedAtMixin, DeletedAtM
     recentdate = Column(DateTime, nullable=False, index=True)
     snippet = Column(String(191), nullable=True, default="")
     version = Column(Integer, nullable=True, server_default="0")
+    # The number of messages in the thread, maintained by IMAP threading when
+    # THREADING_INDEX_ENABLED is set. NULL if it's not known.
+    message_count = Column(Integer, nullable=True)
 
     @validates("subject")
     def compute_cleaned_up_subject(self, key, value):
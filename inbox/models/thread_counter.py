@@ -0,0 +1,303 @@
+"""
+Materialized per-namespace, per-category thread and message counts.
+
+They let `view=count` on /threads and /messages answer the common filters
+(`in`, `unread`, `starred`) with a single-row lookup instead of counting over
+joins.
+
+The counters are maintained incrementally from the session's flush hooks:
+`snapshot_thread_counts` runs before each flush and records what the threads
+about to change contribute to the counters, and `update_thread_counts` runs
+after the flush, recomputes their contribution and applies the difference
+with atomic increments. Writes that bypass the ORM (bulk deletes, raw SQL)
+aren't seen by the hooks, so `reconcile_thread_counters` recomputes a
+namespace's counters from scratch to repair any drift.
+
+"""
+import itertools
+from collections import defaultdict
+
+from sqlalchemy import BigInteger, Column, Integer, inspect
+from sqlalchemy.dialects.mysql import insert
+from sqlalchemy.schema import UniqueConstraint
+
+from inbox.config import config
+from inbox.logging import get_logger
+from inbox.models.base import MailSyncBase
+from inbox.util.stats import statsd_client
+
+log = get_logger()
+
+# Enable only after running bin/reconcile-thread-counters.py, so that the
+# counters start out right.
+THREAD_COUNTERS_ENABLED = config.get("THREAD_COUNTERS_ENABLED", False)
+RECONCILE_CHUNK_SIZE = 1000
+
+# The category_id of the counters that cover the whole namespace.
+ALL_CATEGORIES = 0
+COUNTER_COLUMNS = (
+    "threads",
+    "unread_threads",
+    "starred_threads",
+    "messages",
+    "unread_messages",
+    "starred_messages",
+)
+
+_SNAPSHOT_KEY = "thread_counter_snapshot"
+
+
+class ThreadCounter(MailSyncBase):
+    """
+    Thread and message counts of a namespace, either in a single category or,
+    if category_id is ALL_CATEGORIES, overall.
+
+    The counts mirror the API's filters: a thread is in a category if any of
+    its messages is, and it is unread (starred) if any of its messages is.
+    Message counts only include non-draft messages. Deleted threads and their
+    messages aren't counted.
+
+    """
+
+    namespace_id = Column(BigInteger, nullable=False)
+    category_id = Column(BigInteger, nullable=False)
+
+    threads = Column(Integer, nullable=False, server_default="0")
+    unread_threads = Column(Integer, nullable=False, server_default="0")
+    starred_threads = Column(Integer, nullable=False, server_default="0")
+    messages = Column(Integer, nullable=False, server_default="0")
+    unread_messages = Column(Integer, nullable=False, server_default="0")
+    starred_messages = Column(Integer, nullable=False, server_default="0")
+
+    __table_args__ = (UniqueConstraint("namespace_id", "category_id"),)
+
+
+def get_thread_count(db_session, namespace_id, category_id, column):
+    """Return one of the counts of a namespace, 0 if nothing was counted."""
+    assert column in COUNTER_COLUMNS
+    count = (
+        db_session.query(getattr(ThreadCounter, column))
+        .filter(
+            ThreadCounter.namespace_id == namespace_id,
+            ThreadCounter.category_id == category_id,
+        )
+        .scalar()
+    )
+    return count or 0
+
+
+def thread_contributions(db_session, thread_ids):
+    """
+    Return what the given threads contribute to the counters, as a dict
+    mapping (namespace_id, category_id) to a list of counts in the order of
+    COUNTER_COLUMNS.
+
+    """
+    from inbox.models.message import Message, MessageCategory
+    from inbox.models.thread import Thread
+
+    contributions = defaultdict(lambda: [0] * len(COUNTER_COLUMNS))
+    if not thread_ids:
+        return contributions
+
+    rows = (
+        db_session.query(
+            Thread.id,
+            Thread.namespace_id,
+            Message.id,
+            Message.is_read,
+            Message.is_starred,
+            Message.is_draft,
+            MessageCategory.category_id,
+        )
+        .outerjoin(Message, Message.thread_id == Thread.id)
+        .outerjoin(MessageCategory, MessageCategory.message_id == Message.id)
+        .filter(Thread.id.in_(thread_ids), Thread.deleted_at.is_(None))
+        .order_by(Thread.id, Message.id)
+    )
+
+    for (_, namespace_id), thread_rows in itertools.groupby(
+        rows, key=lambda row: (row[0], row[1])
+    ):
+        thread_categories = {ALL_CATEGORIES}
+        unread = starred = False
+        messages = {}
+        for _, _, message_id, is_read, is_starred, is_draft, category_id in thread_rows:
+            if message_id is None:
+                continue
+            unread = unread or not is_read
+            starred = starred or is_starred
+            if category_id is not None:
+                thread_categories.add(category_id)
+            if is_draft:
+                continue
+            message = messages.setdefault(
+                message_id, (is_read, is_starred, {ALL_CATEGORIES})
+            )
+            if category_id is not None:
+                message[2].add(category_id)
+
+        for category_id in thread_categories:
+            counts = contributions[(namespace_id, category_id)]
+            counts[0] += 1
+            counts[1] += unread
+            counts[2] += starred
+        for is_read, is_starred, message_categories in messages.values():
+            for category_id in message_categories:
+                counts = contributions[(namespace_id, category_id)]
+                counts[3] += 1
+                counts[4] += not is_read
+                counts[5] += is_starred
+
+    return contributions
+
+
+def _touched_threads(session):
+    # Return the threads whose contribution the pending flush may change, as
+    # objects (new threads don't have an id yet) and as ids.
+    from inbox.models.message import Message, MessageCategory
+    from inbox.models.thread import Thread
+
+    threads = set()
+    thread_ids = set()
+
+    def add_message(message):
+        state = inspect(message)
+        threads.update(state.attrs._thread.history.sum())
+        thread_ids.update(state.attrs.thread_id.history.sum())
+
+    for obj in itertools.chain(session.new, session.deleted):
+        if isinstance(obj, Thread):
+            threads.add(obj)
+        elif isinstance(obj, Message):
+            add_message(obj)
+        elif isinstance(obj, MessageCategory) and obj.message is not None:
+            add_message(obj.message)
+
+    for obj in session.dirty:
+        state = inspect(obj)
+        if isinstance(obj, Thread):
+            if state.attrs.deleted_at.history.has_changes():
+                threads.add(obj)
+        elif isinstance(obj, Message):
+            attrs = obj.propagated_attributes + ["is_draft", "_thread", "thread_id"]
+            if any(getattr(state.attrs, attr).history.has_changes() for attr in attrs):
+                add_message(obj)
+
+    threads.discard(None)
+    thread_ids.discard(None)
+    return threads, thread_ids
+
+
+def snapshot_thread_counts(session):
+    """
+    Called from the pre-flush hook to record what the threads touched by the
+    flush currently contribute to the counters.
+    """
+    if not THREAD_COUNTERS_ENABLED:
+        return
+
+    threads, thread_ids = _touched_threads(session)
+    if not threads and not thread_ids:
+        session.info.pop(_SNAPSHOT_KEY, None)
+        return
+
+    thread_ids.update(thread.id for thread in threads if thread.id is not None)
+    session.info[_SNAPSHOT_KEY] = (
+        threads,
+        thread_ids,
+        thread_contributions(session, thread_ids),
+    )
+
+
+def update_thread_counts(session):
+    """
+    Called from the post-flush hook to apply the change in the contribution
+    of the threads recorded by `snapshot_thread_counts`.
+    """
+    snapshot = session.info.pop(_SNAPSHOT_KEY, None)
+    if snapshot is None:
+        return
+
+    threads, thread_ids, before = snapshot
+    thread_ids.update(thread.id for thread in threads if thread.id is not None)
+    after = thread_contributions(session, thread_ids)
+
+    for key in set(before) | set(after):
+        delta = [new - old for new, old in zip(after[key], before[key])]
+        if any(delta):
+            _increment_counter(session, key[0], key[1], delta)
+
+
+def _increment_counter(session, namespace_id, category_id, delta):
+    table = ThreadCounter.__table__
+    values = dict(zip(COUNTER_COLUMNS, delta))
+    stmt = insert(table).values(
+        namespace_id=namespace_id, category_id=category_id, **values
+    )
+    stmt = stmt.on_duplicate_key_update(
+        **{column: table.c[column] + value for column, value in values.items()}
+    )
+    session.execute(stmt)
+
+
+def reconcile_thread_counters(db_session, namespace_id):
+    """
+    Recompute the counters of a namespace from its threads and overwrite any
+    that drifted. Returns the number of counters that were fixed.
+
+    The recount isn't atomic with respect to concurrent syncs, so a counter
+    that changes while it runs may be off until the next reconciliation.
+
+    """
+    from inbox.models.thread import Thread
+
+    totals = defaultdict(lambda: [0] * len(COUNTER_COLUMNS))
+    last_id = 0
+    while True:
+        thread_ids = [
+            thread_id
+            for thread_id, in db_session.query(Thread.id)
+            .filter(Thread.namespace_id == namespace_id, Thread.id > last_id)
+            .order_by(Thread.id)
+            .limit(RECONCILE_CHUNK_SIZE)
+        ]
+        if not thread_ids:
+            break
+        last_id = thread_ids[-1]
+        for key, counts in thread_contributions(db_session, thread_ids).items():
+            totals[key] = [total + count for total, count in zip(totals[key], counts)]
+
+    counters = {
+        counter.category_id: counter
+        for counter in db_session.query(ThreadCounter).filter(
+            ThreadCounter.namespace_id == namespace_id
+        )
+    }
+
+    fixed = 0
+    category_ids = set(counters) | {category_id for _, category_id in totals}
+    for category_id in category_ids:
+        expected = totals.get((namespace_id, category_id), [0] * len(COUNTER_COLUMNS))
+        counter = counters.get(category_id)
+        if counter is None:
+            if not any(expected):
+                continue
+            counter = ThreadCounter(namespace_id=namespace_id, category_id=category_id)
+            db_session.add(counter)
+        elif [getattr(counter, column) for column in COUNTER_COLUMNS] == expected:
+            continue
+
+        log.warning(
+            "Fixing drifted thread counter",
+            namespace_id=namespace_id,
+            category_id=category_id,
+            expected=expected,
+        )
+        for column, value in zip(COUNTER_COLUMNS, expected):
+            setattr(counter, column, value)
+        fixed += 1
+
+    db_session.commit()
+    statsd_client.incr("thread_counters.reconciled", fixed)
+    return fixed
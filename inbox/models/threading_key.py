@@ -0,0 +1,19 @@
+from sqlalchemy import BigInteger, Column, String
+from sqlalchemy.schema import UniqueConstraint
+
+from inbox.models.base import MailSyncBase
+
+
+class ThreadingKey(MailSyncBase):
+    """
+    Maps the hash of a threading key of a message to the thread the message
+    was put in, so that later messages with the same key can be threaded with
+    a single lookup. See inbox.util.threading for the keys.
+
+    """
+
+    namespace_id = Column(BigInteger, nullable=False)
+    key_hash = Column(String(40), nullable=False)
+    thread_id = Column(BigInteger, nullable=False)
+
+    __table_args__ = (UniqueConstraint("namespace_id", "key_hash"),)
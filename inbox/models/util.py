@@ -15,6 +15,7 @@ from inbox.logging import get_logger
 from inbox.models import Account, Block, Message, Namespace
 from inbox.models.session import session_scope, session_scope_by_shard_id
 from inbox.models.transaction import TXN_REDIS_KEY, Transaction
+from inbox.util.auth_cache import invalidate_namespace_auth
 from inbox.util.blockstore import delete_from_blockstore
 from inbox.util.stats import statsd_client
 
@@ -82,8 +83,8 @@ def reconcile_message(new_message, session):
     if version is None or int(version) == existing_message.version:
         existing_message.message_id_header = new_message.message_id_header
         existing_message.references = new_message.references
-        # Non-persisted instance attribute used by EAS.
-        existing_message.parsed_body = new_message.parsed_body
+        # Non-persisted instance attribute.
+        existing_message.parsed_headers = new_message.parsed_headers
 
     return existing_message
 
@@ -188,6 +189,7 @@ def delete_namespace(namespace_id, throttle=False, dry_run=False):
             )
         account_id = account.id
         account_discriminator = account.discriminator
+        namespace_public_id = account.namespace.public_id
 
     log.info("Deleting account", account_id=account_id)
     start_time = time.time()
@@ -274,6 +276,9 @@ def delete_namespace(namespace_id, throttle=False, dry_run=False):
     log.debug("Deleting liveness data", account_id=account_id)
     clear_heartbeat_status(account_id)
 
+    if dry_run is False:
+        invalidate_namespace_auth(namespace_public_id)
+
     statsd_client.timing(
         "mailsync.account_deletion.queue.deleted", time.time() - start_time
     )
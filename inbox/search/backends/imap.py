@@ -1,12 +1,22 @@
+import contextlib
 import socket
+import time
+from collections import OrderedDict
 from imaplib import IMAP4
 
+import gevent.pool
 from imapclient import IMAPClient
 from sqlalchemy import desc
 
 from inbox.api.kellogs import APIEncoder
 from inbox.basicauth import NotSupportedError, ValidationError
-from inbox.crispin import CrispinClient, FolderMissingError
+from inbox.config import config
+from inbox.crispin import (
+    IMAP_SEARCH_POOL_SIZE,
+    CrispinClient,
+    FolderMissingError,
+    search_connection_pool,
+)
 from inbox.logging import get_logger
 from inbox.mailsync.backends.imap.generic import UidInvalid, uidvalidity_cb
 from inbox.models import Account, Folder, Message, Thread
@@ -17,6 +27,64 @@ from inbox.search.base import SearchBackendException
 
 PROVIDER = "imap"
 
+# Search folders concurrently over pooled connections (see
+# inbox.crispin.search_connection_pool), returning the results of each folder
+# as soon as it's searched, and cache the results of folders.
+IMAP_SEARCH_FANOUT_ENABLED = config.get("IMAP_SEARCH_FANOUT_ENABLED", False)
+IMAP_SEARCH_CACHE_TTL = config.get("IMAP_SEARCH_CACHE_TTL", 120)
+IMAP_SEARCH_CACHE_SIZE = config.get("IMAP_SEARCH_CACHE_SIZE", 10000)
+
+CONNECTION_ERROR_MESSAGE = (
+    "Unable to connect to the IMAP server. Please retry in a couple minutes."
+)
+CREDENTIALS_ERROR_MESSAGE = (
+    "This search can't be performed because the account's credentials are out "
+    "of date. Please reauthenticate and try again."
+)
+
+
+class FolderSearchCache(object):
+    """
+    A TTL and size-bounded LRU cache of the UIDs a search matched in a folder.
+
+    Entries are keyed by the UIDVALIDITY and UIDNEXT of the folder, so they're
+    only used while no message was added to it. Messages removed from it since
+    may still be returned, but they aren't in the database either.
+    """
+
+    def __init__(self, ttl=IMAP_SEARCH_CACHE_TTL, size=IMAP_SEARCH_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        # key -> (uids, expiry), least recently used first.
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        cached = self._entries.get(key)
+        if cached is None:
+            return None
+        uids, expiry = cached
+        if expiry < time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return uids
+
+    def set(self, key, uids):
+        self._entries[key] = (uids, time.time() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+
+folder_search_cache = FolderSearchCache()
+
+
+def _search_criteria(search_query):
+    try:
+        return [b"TEXT", search_query.encode("ascii")], None
+    except UnicodeEncodeError:
+        return [u"TEXT", search_query], "UTF-8"
+
 
 class IMAPSearchClient(object):
     def __init__(self, account):
@@ -29,24 +97,9 @@ class IMAPSearchClient(object):
         try:
             conn = account.auth_handler.get_authenticated_imap_connection(account)
         except (IMAPClient.Error, socket.error, IMAP4.error):
-            raise SearchBackendException(
-                (
-                    "Unable to connect to the IMAP "
-                    "server. Please retry in a "
-                    "couple minutes."
-                ),
-                503,
-            )
+            raise SearchBackendException(CONNECTION_ERROR_MESSAGE, 503)
         except ValidationError:
-            raise SearchBackendException(
-                (
-                    "This search can't be performed "
-                    "because the account's credentials "
-                    "are out of date. Please "
-                    "reauthenticate and try again."
-                ),
-                403,
-            )
+            raise SearchBackendException(CREDENTIALS_ERROR_MESSAGE, 403)
 
         try:
             acct_provider_info = provider_info(account.provider)
@@ -156,15 +209,20 @@ class IMAPSearchClient(object):
         return g
 
     def _search(self, db_session, search_query):
+        if IMAP_SEARCH_FANOUT_ENABLED:
+            for uids in self._search_fanout(db_session, search_query):
+                yield uids
+            return
+
         self._open_crispin_connection(db_session)
+        criteria, charset = _search_criteria(search_query)
 
-        try:
-            criteria = [b"TEXT", search_query.encode("ascii")]
-            charset = None
-        except UnicodeEncodeError:
-            criteria = [u"TEXT", search_query]
-            charset = "UTF-8"
+        for folder in self._folders(db_session):
+            yield self._search_folder(folder, criteria, charset)
 
+        self._close_crispin_connection()
+
+    def _folders(self, db_session):
         folders = []
 
         account_folders = db_session.query(Folder).filter(
@@ -188,27 +246,95 @@ class IMAPSearchClient(object):
                 # Don't search the folder twice.
                 account_folders = account_folders.filter(Folder.id != special_folder.id)
 
-        folders = folders + account_folders.all()
+        return folders + account_folders.all()
 
-        for folder in folders:
-            yield self._search_folder(folder, criteria, charset)
+    def _search_fanout(self, db_session, search_query):
+        # Folders are searched concurrently, over at most as many connections
+        # as the account's search pool has, and their results are yielded as
+        # they come in. The inbox, sent and archive folders still start first.
+        criteria, charset = _search_criteria(search_query)
+        folder_names = [folder.name for folder in self._folders(db_session)]
+        account = db_session.query(Account).get(self.account_id)
+        pool_size = 1 if account.throttled else IMAP_SEARCH_POOL_SIZE
+        with search_connection_pool(self.account_id, pool_size) as connections:
 
-        self._close_crispin_connection()
+            def search(folder_name):
+                with self._pooled_crispin_client(connections, folder_name) as client:
+                    return self._search_folder_cached(
+                        client, folder_name, search_query, criteria, charset
+                    )
+
+            greenlets = gevent.pool.Pool(pool_size)
+            try:
+                for uids in greenlets.imap_unordered(search, folder_names):
+                    yield uids
+            finally:
+                # Before the connections are closed.
+                greenlets.kill()
+
+    @contextlib.contextmanager
+    def _pooled_crispin_client(self, connections, folder_name):
+        try:
+            with connections.get(folder_name) as crispin_client:
+                yield crispin_client
+        except (IMAPClient.Error, socket.error, IMAP4.error):
+            raise SearchBackendException(CONNECTION_ERROR_MESSAGE, 503)
+        except ValidationError:
+            raise SearchBackendException(CREDENTIALS_ERROR_MESSAGE, 403)
+
+    def _search_folder_cached(
+        self, crispin_client, folder_name, search_query, criteria, charset
+    ):
+        # Like _search_folder, but empty folders aren't searched, and nor are
+        # folders that haven't changed since the same search last ran.
+        select_info = self._select_folder(crispin_client, folder_name)
+        if not select_info or select_info.get(b"EXISTS") == 0:
+            return []
+
+        key = None
+        if b"UIDNEXT" in select_info:
+            key = (
+                self.account_id,
+                search_query,
+                folder_name,
+                select_info[b"UIDVALIDITY"],
+                select_info[b"UIDNEXT"],
+            )
+            uids = folder_search_cache.get(key)
+            if uids is not None:
+                return uids
+
+        uids = self._search_selected_folder(
+            crispin_client, folder_name, criteria, charset
+        )
+        if key is not None:
+            folder_search_cache.set(key, uids)
+        return uids
 
     def _search_folder(self, folder, criteria, charset):
+        if not self._select_folder(self.crispin_client, folder.name):
+            return []
+
+        return self._search_selected_folder(
+            self.crispin_client, folder.name, criteria, charset
+        )
+
+    def _select_folder(self, crispin_client, folder_name):
+        # Returns the select info of the folder, or None if it can't be
+        # searched.
         try:
-            self.crispin_client.select_folder(folder.name, uidvalidity_cb)
+            return crispin_client.select_folder(folder_name, uidvalidity_cb)
         except FolderMissingError:
             self.log.warn("Won't search missing IMAP folder", exc_info=True)
-            return []
         except UidInvalid:
             self.log.error(
                 ("Got Uidvalidity error when searching. " "Skipping."), exc_info=True
             )
-            return []
+        return None
 
+    def _search_selected_folder(self, crispin_client, folder_name, criteria, charset):
         try:
-            uids = self.crispin_client.conn.search(criteria, charset=charset)
+            uids = crispin_client.conn.search(criteria, charset=charset)
         except IMAP4.error:
             self.log.warn("Search error", exc_info=True)
             raise SearchBackendException(
@@ -216,6 +342,6 @@ class IMAPSearchClient(object):
             )
 
         self.log.debug(
-            "Search found messages for folder", folder_name=folder.id, uids=len(uids)
+            "Search found messages for folder", folder_name=folder_name, uids=len(uids)
         )
         return uids
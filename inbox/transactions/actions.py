@@ -8,6 +8,7 @@ talking to the same database backend things could go really badly.
 
 """
 import random
+import time
 import weakref
 from collections import defaultdict
 from datetime import datetime, timedelta
@@ -44,6 +45,16 @@ from inbox.ignition import engine_manager
 from inbox.logging import get_logger
 from inbox.models import ActionLog, Event
 from inbox.models.session import session_scope, session_scope_by_shard_id
+from inbox.transactions.syncback_scheduler import (
+    SYNCBACK_PENDING_SCAN_INTERVAL,
+    SYNCBACK_SCHEDULER_ENABLED,
+    SyncbackStats,
+    WeightedRoundRobin,
+    account_weight,
+    pending_namespaces,
+    pending_queues,
+    scan_pending_namespace_ids,
+)
 from inbox.util.concurrency import retry_with_logging
 from inbox.util.misc import DummyContextManager
 from inbox.util.stats import statsd_client
@@ -156,6 +167,11 @@ class SyncbackService(gevent.Greenlet):
         self.worker_did_finish.clear()
         self.task_queue = Queue()
         self.running_action_ids = set()
+        # Used by the scheduler, see inbox.transactions.syncback_scheduler.
+        self.stats = SyncbackStats()
+        self.round_robins = defaultdict(WeightedRoundRobin)
+        self.last_scanned = {}
+        self.listener = None
         gevent.Greenlet.__init__(self)
 
     def _has_recent_move_action(self, db_session, log_entries):
@@ -435,6 +451,9 @@ class SyncbackService(gevent.Greenlet):
         return batch_task
 
     def _process_log(self):
+        if SYNCBACK_SCHEDULER_ENABLED:
+            self._process_pending_namespaces()
+            return
         for key in self.keys:
             with session_scope_by_shard_id(key) as db_session:
 
@@ -477,6 +496,73 @@ class SyncbackService(gevent.Greenlet):
                     if task is not None:
                         self.task_queue.put(task)
 
+    def _process_pending_namespaces(self):
+        for key in self.keys:
+            with session_scope_by_shard_id(key) as db_session:
+                namespace_ids = pending_namespaces.get(key)
+
+                # Redis may have missed actions (e.g. if it was unavailable
+                # when they were scheduled), so scan for them now and then.
+                now = time.time()
+                last_scanned = self.last_scanned.get(key)
+                if (
+                    last_scanned is None
+                    or now - last_scanned >= SYNCBACK_PENDING_SCAN_INTERVAL
+                ):
+                    self.last_scanned[key] = now
+                    missed = scan_pending_namespace_ids(db_session) - namespace_ids
+                    if missed:
+                        self.log.info(
+                            "Found pending actions missing from Redis",
+                            shard_id=key,
+                            namespace_ids=sorted(missed)[:100],
+                        )
+                        pending_namespaces.add(missed)
+                        namespace_ids |= missed
+
+                queues = pending_queues(db_session, namespace_ids)
+                idle = namespace_ids - set(queues)
+                if idle:
+                    pending_namespaces.remove(key, idle)
+                    # Actions may have been committed, and their namespaces
+                    # added back, between the query and the removal. Check
+                    # again in a new transaction, which sees them, and add
+                    # back the namespaces that do have work.
+                    db_session.commit()
+                    requeued = pending_queues(db_session, idle)
+                    if requeued:
+                        pending_namespaces.add(requeued)
+                        queues.update(requeued)
+                self.stats.set_queue_depths(
+                    key, {account_id: depth for account_id, depth in queues.values()}
+                )
+
+                # Rather than sampling randomly, take turns, giving accounts
+                # with more pending actions more turns.
+                weights = {
+                    ns_id: account_weight(depth) for ns_id, (_, depth) in queues.items()
+                }
+                for ns_id in self.round_robins[key].select(
+                    weights, NUM_PARALLEL_ACCOUNTS
+                ):
+                    query = (
+                        db_session.query(ActionLog)
+                        .filter(
+                            ActionLog.discriminator == "actionlog",
+                            ActionLog.status == "pending",
+                            ActionLog.namespace_id == ns_id,
+                        )
+                        .order_by(ActionLog.id)
+                        .limit(self.fetch_batch_size)
+                    )
+                    task = self._batch_log_entries(db_session, query.all())
+                    if task is not None:
+                        self.task_queue.put(task)
+
+    def _listen_for_actions(self):
+        # Wake up _run_impl as if a worker had finished.
+        pending_namespaces.listen(self.keys, self.worker_did_finish.set)
+
     def _restart_workers(self):
         while len(self.workers) < self.num_workers:
             worker = SyncbackWorker(self)
@@ -486,18 +572,23 @@ class SyncbackService(gevent.Greenlet):
 
     def _run_impl(self):
         self._restart_workers()
+        # Clear before processing the log so that actions scheduled meanwhile
+        # aren't missed.
+        self.worker_did_finish.clear()
         self._process_log()
-        # Wait for a worker to finish or for the fixed poll_interval,
-        # whichever happens first.
+        # Wait for a worker to finish (or, with the scheduler, for actions to
+        # be scheduled) or for the fixed poll_interval, whichever happens
+        # first.
         timeout = self.poll_interval
         if self.num_idle_workers == 0:
             timeout = None
-        self.worker_did_finish.clear()
         self.worker_did_finish.wait(timeout=timeout)
 
     def stop(self):
         self.keep_running = False
         self.workers.kill()
+        if self.listener is not None:
+            self.listener.kill()
 
     def _run(self):
         self.log.info(
@@ -506,6 +597,10 @@ class SyncbackService(gevent.Greenlet):
             total_processes=self.total_processes,
             keys=self.keys,
         )
+        if SYNCBACK_SCHEDULER_ENABLED and self.keys:
+            self.listener = gevent.spawn(
+                retry_with_logging, self._listen_for_actions, self.log
+            )
         while self.keep_running:
             retry_with_logging(self._run_impl, self.log)
 
@@ -771,6 +866,7 @@ class SyncbackTask(object):
         )
         func_latency = round((after - before).total_seconds(), 2)
         self._log_to_statsd(action_log_entry.status, latency)
+        self.parent_service().stats.record_latency(self.account_id, latency)
         return (latency, func_latency)
 
     def _mark_action_as_failed(self, action_log_entry, db_session):
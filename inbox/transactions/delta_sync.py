@@ -1,18 +1,36 @@
 import collections
+import contextlib
 import time
 from datetime import datetime
 
 import gevent
+from gevent.lock import BoundedSemaphore
 from sqlalchemy import asc, bindparam, desc
 from sqlalchemy.orm.exc import NoResultFound
 
 from inbox.api.kellogs import APIEncoder, encode
+from inbox.config import config
+from inbox.ignition import redis_txn
+from inbox.logging import get_logger
 from inbox.models import Account, Message, Namespace, Thread, Transaction
 from inbox.models.session import session_scope
+from inbox.models.transaction import TXN_REDIS_KEY
 from inbox.models.util import transaction_objects
+from inbox.transactions.watcher import (
+    DELTA_NOTIFICATIONS_ENABLED,
+    DELTA_NOTIFICATIONS_FALLBACK_INTERVAL,
+    get_transaction_watcher,
+)
+
+log = get_logger()
 
 EVENT_NAME_FOR_COMMAND = {"insert": "create", "update": "modify", "delete": "delete"}
 
+# Whether concurrent streaming clients with the same parameters should share
+# encoded deltas (see `DeltaBroadcaster`), and how many deltas to keep around.
+DELTA_BROADCAST_ENABLED = config.get("DELTA_BROADCAST_ENABLED", False)
+DELTA_BROADCAST_BUFFER_SIZE = config.get("DELTA_BROADCAST_BUFFER_SIZE", 1000)
+
 
 def get_transaction_cursor_near_timestamp(namespace_id, timestamp, db_session):
     """
@@ -125,6 +143,46 @@ def format_transactions_after_pointer(
     exclude_types: list, optional
         If given, don't include transactions for these types of objects.
 
+    """
+    results, covered_pointer = _transaction_deltas_after_pointer(
+        namespace,
+        pointer,
+        db_session,
+        result_limit,
+        exclude_types,
+        include_types,
+        exclude_folders,
+        exclude_metadata,
+        exclude_account,
+        expand=expand,
+        is_n1=is_n1,
+    )
+    if not results:
+        return ([], covered_pointer)
+    return ([d for _, d in results], results[-1][0])
+
+
+def _transaction_deltas_after_pointer(
+    namespace,
+    pointer,
+    db_session,
+    result_limit,
+    exclude_types=None,
+    include_types=None,
+    exclude_folders=True,
+    exclude_metadata=True,
+    exclude_account=True,
+    expand=False,
+    is_n1=False,
+):
+    """
+    Like `format_transactions_after_pointer`, but return a pair
+    (results, covered_pointer), where results is a list of
+    (transaction id, delta) pairs sorted by transaction id, and
+    covered_pointer is the id up to which the transaction log has been
+    examined: there are no deltas matching the filters between the last
+    result and covered_pointer.
+
     """
     exclude_types = set(exclude_types) if exclude_types else set()
     # Begin backwards-compatibility shim -- suppress new object types for now,
@@ -251,9 +309,8 @@ def format_transactions_after_pointer(
 
         if results:
             # Sort deltas by id of the underlying transactions.
-            results.sort()
-            deltas = [d for _, d in results]
-            return (deltas, results[-1][0])
+            results.sort(key=lambda result: result[0])
+            return (results, transactions[-1].id)
         else:
             # It's possible that none of the referenced objects exist any more,
             # meaning the result list is empty. In that case, keep traversing
@@ -261,6 +318,150 @@ def format_transactions_after_pointer(
             pointer = transactions[-1].id
 
 
+class DeltaBroadcaster(object):
+    """
+    Shares encoded deltas between streaming clients of the same namespace that
+    asked for the same filters and view.
+
+    Each batch of deltas is loaded and encoded once, and kept in a bounded
+    buffer indexed by transaction id. Subscribers whose pointer falls inside
+    the buffered window are served from the buffer; the others fall back to
+    reading the transaction log themselves until they catch up. The
+    transaction log is only read when the namespace's latest transaction id
+    in Redis (see `bump_redis_txn_id`) is past the buffer, or at least every
+    DELTA_NOTIFICATIONS_FALLBACK_INTERVAL seconds.
+
+    Parameters
+    ----------
+    namespace: Namespace
+        Namespace to broadcast deltas for. May be detached from its session.
+    buffer_size: int
+        Maximum number of encoded deltas to keep around.
+    filters: dict
+        Keyword arguments for `format_transactions_after_pointer`.
+    """
+
+    def __init__(self, namespace, buffer_size, **filters):
+        self.namespace = namespace
+        self.buffer_size = buffer_size
+        self.filters = filters
+        self.encoder = APIEncoder(is_n1=filters.get("is_n1", False))
+        self.subscribers = 0
+        # (transaction id, encoded delta) pairs, sorted by transaction id. The
+        # buffer holds every delta after `self.start` up to `self.end`.
+        self._buffer = collections.deque()
+        self.start = None
+        self.end = None
+        # When the transaction log was last read.
+        self._read_at = 0
+        self._lock = BoundedSemaphore(1)
+
+    def deltas_after(self, pointer):
+        """
+        Return a pair (encoded_deltas, new_pointer), where encoded_deltas is a
+        list of JSON-encoded deltas for transactions after `pointer`.
+
+        """
+        if self.end is None:
+            self._seed()
+
+        if self.end is not None and pointer >= self.end:
+            self._refresh()
+
+        if self.start is None or not self.start <= pointer <= self.end:
+            return self._read_transaction_log(pointer)
+
+        encoded_deltas = []
+        for trx_id, encoded in reversed(self._buffer):
+            if trx_id <= pointer:
+                break
+            encoded_deltas.append(encoded)
+        encoded_deltas.reverse()
+        return (encoded_deltas, max(pointer, self.end))
+
+    def _seed(self):
+        with self._lock:
+            if self.end is not None:
+                return
+            with session_scope(self.namespace.id) as db_session:
+                try:
+                    self.end = _get_last_trx_id_for_namespace(
+                        self.namespace.id, db_session
+                    )
+                except NoResultFound:
+                    self.end = 0
+            self.start = self.end
+
+    def _refresh(self):
+        end = self.end
+        with self._lock:
+            if self.end != end:
+                # Another subscriber refreshed the buffer while we were
+                # waiting for the lock.
+                return
+            if not self._may_have_new_transactions(end):
+                return
+            self._read_at = time.time()
+            with session_scope(self.namespace.id) as db_session:
+                results, covered_pointer = _transaction_deltas_after_pointer(
+                    self.namespace, end, db_session, 100, **self.filters
+                )
+            for trx_id, delta in results:
+                self._buffer.append((trx_id, self.encoder.cereal(delta)))
+            while len(self._buffer) > self.buffer_size:
+                self.start, _ = self._buffer.popleft()
+            self.end = max(end, covered_pointer)
+
+    def _may_have_new_transactions(self, pointer):
+        # The Redis zset is bumped post-flush, i.e. possibly before the
+        # transactions are visible to us, and failing to bump it is only
+        # logged, so the transaction log is still read every
+        # DELTA_NOTIFICATIONS_FALLBACK_INTERVAL seconds.
+        if time.time() - self._read_at >= DELTA_NOTIFICATIONS_FALLBACK_INTERVAL:
+            return True
+        try:
+            txnid = redis_txn.zscore(TXN_REDIS_KEY, self.namespace.public_id)
+        except Exception:
+            log.warning("Error checking for new transactions", exc_info=True)
+            return True
+        return txnid is not None and int(txnid) > pointer
+
+    def _read_transaction_log(self, pointer):
+        with session_scope(self.namespace.id) as db_session:
+            deltas, new_pointer = format_transactions_after_pointer(
+                self.namespace, pointer, db_session, 100, **self.filters
+            )
+        return ([self.encoder.cereal(delta) for delta in deltas], new_pointer)
+
+
+_broadcasters = {}
+
+
+@contextlib.contextmanager
+def delta_broadcaster(namespace, **filters):
+    """
+    Per-process DeltaBroadcaster for the given namespace and filters. The
+    broadcaster is discarded when its last subscriber leaves.
+
+    """
+    key = (namespace.id,) + tuple(
+        (name, frozenset(value) if isinstance(value, (list, set)) else value)
+        for name, value in sorted(filters.items())
+    )
+    broadcaster = _broadcasters.get(key)
+    if broadcaster is None:
+        broadcaster = _broadcasters[key] = DeltaBroadcaster(
+            namespace, DELTA_BROADCAST_BUFFER_SIZE, **filters
+        )
+    broadcaster.subscribers += 1
+    try:
+        yield broadcaster
+    finally:
+        broadcaster.subscribers -= 1
+        if broadcaster.subscribers == 0 and _broadcasters.get(key) is broadcaster:
+            del _broadcasters[key]
+
+
 def streaming_change_generator(
     namespace,
     poll_interval,
@@ -290,28 +491,76 @@ def streaming_change_generator(
         `transaction_pointer`.
 
     """
+    filters = dict(
+        exclude_types=exclude_types,
+        include_types=include_types,
+        exclude_folders=exclude_folders,
+        exclude_metadata=exclude_metadata,
+        exclude_account=exclude_account,
+        expand=expand,
+        is_n1=is_n1,
+    )
+    if DELTA_BROADCAST_ENABLED:
+        with delta_broadcaster(namespace, **filters) as broadcaster:
+            for chunk in _streaming_change_generator(
+                namespace,
+                poll_interval,
+                timeout,
+                transaction_pointer,
+                broadcaster.deltas_after,
+            ):
+                yield chunk
+        return
+
     encoder = APIEncoder(is_n1=is_n1)
-    start_time = time.time()
-    while time.time() - start_time < timeout:
+
+    def read_transaction_log(pointer):
         with session_scope(namespace.id) as db_session:
             deltas, new_pointer = format_transactions_after_pointer(
-                namespace,
-                transaction_pointer,
-                db_session,
-                100,
-                exclude_types,
-                include_types,
-                exclude_folders,
-                exclude_metadata,
-                exclude_account,
-                expand=expand,
-                is_n1=is_n1,
+                namespace, pointer, db_session, 100, **filters
             )
+        return ([encoder.cereal(delta) for delta in deltas], new_pointer)
+
+    for chunk in _streaming_change_generator(
+        namespace, poll_interval, timeout, transaction_pointer, read_transaction_log
+    ):
+        yield chunk
+
+
+def _streaming_change_generator(
+    namespace, poll_interval, timeout, transaction_pointer, deltas_after
+):
+    start_time = time.time()
+    # Highest transaction id we know about; only used when waiting on
+    # notifications rather than polling.
+    last_seen_txnid = transaction_pointer
+    while time.time() - start_time < timeout:
+        encoded_deltas, new_pointer = deltas_after(transaction_pointer)
 
         if new_pointer is not None and new_pointer != transaction_pointer:
             transaction_pointer = new_pointer
-            for delta in deltas:
-                yield encoder.cereal(delta) + "\n"
+            for encoded_delta in encoded_deltas:
+                yield encoded_delta + "\n"
         else:
             yield "\n"
-            gevent.sleep(poll_interval)
+            if not DELTA_NOTIFICATIONS_ENABLED:
+                gevent.sleep(poll_interval)
+                continue
+            # Keep the connection alive every `poll_interval` while waiting
+            # to be notified of new transactions.
+            deadline = min(
+                start_time + timeout,
+                time.time() + DELTA_NOTIFICATIONS_FALLBACK_INTERVAL,
+            )
+            while True:
+                txnid = get_transaction_watcher().wait(
+                    namespace.public_id,
+                    last_seen_txnid,
+                    max(0, min(poll_interval, deadline - time.time())),
+                )
+                if txnid is not None:
+                    last_seen_txnid = txnid
+                    break
+                if time.time() >= deadline:
+                    break
+                yield "\n"
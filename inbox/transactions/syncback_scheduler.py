@@ -0,0 +1,247 @@
+"""
+Event-driven scheduling for the syncback service.
+
+Without it, SyncbackService finds the namespaces with pending actions by
+running a SELECT DISTINCT over the actionlog table of each of its shards on
+every poll, and randomly samples NUM_PARALLEL_ACCOUNTS of them. With
+SYNCBACK_SCHEDULER_ENABLED set:
+
+* Every commit that creates actionlog entries adds their namespaces to a
+  per-shard Redis set and publishes to the shard's channel (see
+  `notify_pending_actions`). The service wakes up on those notifications and
+  only looks at the namespaces in the set. The full scan still runs every
+  SYNCBACK_PENDING_SCAN_INTERVAL seconds, to pick up anything Redis missed.
+* Namespaces are picked with smooth weighted round-robin, weighted by how
+  many actions they have pending (up to SYNCBACK_MAX_ACCOUNT_WEIGHT), so that
+  accounts with a backlog get more turns without starving the others.
+* The queue depth of every account and the latency percentiles of its recent
+  actions are kept in `SyncbackStats`, which the syncback HTTP frontend serves
+  at /syncback-queues.
+
+"""
+from collections import defaultdict, deque
+
+from sqlalchemy import func
+
+from inbox.config import config
+from inbox.ignition import engine_manager, redis_txn
+from inbox.logging import get_logger
+from inbox.models.action_log import ActionLog
+from inbox.models.namespace import Namespace
+from inbox.util.stats import statsd_client
+
+log = get_logger()
+
+SYNCBACK_SCHEDULER_ENABLED = config.get("SYNCBACK_SCHEDULER_ENABLED", False)
+SYNCBACK_PENDING_SCAN_INTERVAL = config.get("SYNCBACK_PENDING_SCAN_INTERVAL", 60)
+SYNCBACK_MAX_ACCOUNT_WEIGHT = config.get("SYNCBACK_MAX_ACCOUNT_WEIGHT", 10)
+SYNCBACK_LATENCY_SAMPLES = config.get("SYNCBACK_LATENCY_SAMPLES", 100)
+
+PENDING_KEY_PREFIX = "syncback:pending:"
+PENDING_NAMESPACE_IDS_KEY = "syncback_pending_namespace_ids"
+LATENCY_PERCENTILES = (50, 90, 99)
+
+
+def pending_key(shard_id):
+    return "{}{}".format(PENDING_KEY_PREFIX, shard_id)
+
+
+class PendingNamespaces(object):
+    """
+    The ids of the namespaces with pending actions, as one Redis set per
+    shard. Namespaces are added when actions are scheduled and removed by the
+    syncback service once it finds they have none left.
+
+    """
+
+    def __init__(self, redis=None):
+        self.redis = redis if redis is not None else redis_txn
+
+    def add(self, namespace_ids):
+        by_shard = defaultdict(list)
+        for namespace_id in namespace_ids:
+            shard_id = engine_manager.shard_key_for_id(namespace_id)
+            by_shard[shard_id].append(namespace_id)
+        if not by_shard:
+            return
+        pipe = self.redis.pipeline()
+        for shard_id, shard_namespace_ids in by_shard.items():
+            pipe.sadd(pending_key(shard_id), *shard_namespace_ids)
+            pipe.publish(pending_key(shard_id), len(shard_namespace_ids))
+        pipe.execute()
+
+    def get(self, shard_id):
+        return {int(n) for n in self.redis.smembers(pending_key(shard_id))}
+
+    def remove(self, shard_id, namespace_ids):
+        if namespace_ids:
+            self.redis.srem(pending_key(shard_id), *namespace_ids)
+
+    def listen(self, shard_ids, callback):
+        """Call `callback` whenever actions are scheduled on the shards."""
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(*[pending_key(shard_id) for shard_id in shard_ids])
+        try:
+            for _ in pubsub.listen():
+                callback()
+        finally:
+            pubsub.close()
+
+
+pending_namespaces = PendingNamespaces()
+
+
+def collect_pending_actions(session):
+    """
+    Called from the post-flush hook to remember the namespaces of new
+    actionlog entries until the session commits.
+    """
+    if not SYNCBACK_SCHEDULER_ENABLED:
+        return
+    namespace_ids = {
+        obj.namespace_id
+        for obj in session.new
+        if isinstance(obj, ActionLog) and obj.discriminator == "actionlog"
+    }
+    if namespace_ids:
+        session.info.setdefault(PENDING_NAMESPACE_IDS_KEY, set()).update(namespace_ids)
+
+
+def notify_pending_actions(session):
+    """
+    Called from the post-commit hook: the new actionlog entries are visible
+    to the syncback service now, so tell it about them.
+    """
+    namespace_ids = session.info.pop(PENDING_NAMESPACE_IDS_KEY, None)
+    if namespace_ids:
+        pending_namespaces.add(namespace_ids)
+
+
+def discard_pending_actions(session):
+    """Called from the post-rollback hook."""
+    session.info.pop(PENDING_NAMESPACE_IDS_KEY, None)
+
+
+def scan_pending_namespace_ids(db_session):
+    """All the namespaces of a shard with pending actions, the slow way."""
+    return {
+        namespace_id
+        for namespace_id, in db_session.query(ActionLog.namespace_id)
+        .filter(ActionLog.discriminator == "actionlog", ActionLog.status == "pending")
+        .distinct()
+    }
+
+
+def pending_queues(db_session, namespace_ids):
+    """
+    Return namespace id -> (account id, number of pending actions) for those
+    of the given namespaces that have pending actions.
+    """
+    if not namespace_ids:
+        return {}
+    rows = (
+        db_session.query(
+            ActionLog.namespace_id, Namespace.account_id, func.count(ActionLog.id)
+        )
+        .join(Namespace, ActionLog.namespace_id == Namespace.id)
+        .filter(
+            ActionLog.namespace_id.in_(namespace_ids),
+            ActionLog.status == "pending",
+            ActionLog.discriminator == "actionlog",
+        )
+        .group_by(ActionLog.namespace_id, Namespace.account_id)
+    )
+    return {
+        namespace_id: (account_id, depth) for namespace_id, account_id, depth in rows
+    }
+
+
+class WeightedRoundRobin(object):
+    """
+    Smooth weighted round-robin over a changing set of keys.
+
+    Every round, each key earns its weight in credit and the keys with the
+    most credit are selected, paying an equal share of what all keys earned.
+    Keys are selected in proportion to their weights (until they're selected
+    every round), and none is left waiting for more than a few rounds.
+    Credit is capped at zero after paying, so keys can't save up.
+    """
+
+    def __init__(self):
+        self._credit = {}
+
+    def select(self, weights, n):
+        """
+        Select up to `n` of the keys of `weights` (key -> positive weight),
+        most overdue first.
+        """
+        self._credit = {key: self._credit.get(key, 0) for key in weights}
+        for key, weight in weights.items():
+            self._credit[key] += weight
+        selected = sorted(weights, key=lambda key: -self._credit[key])[:n]
+        if selected:
+            share = sum(weights.values()) / len(selected)
+            for key in selected:
+                self._credit[key] = min(self._credit[key] - share, 0)
+        return selected
+
+
+class SyncbackStats(object):
+    """
+    The queue depth of every account, i.e. its number of pending actions, and
+    the latencies of its recently completed actions, from when they were
+    scheduled until they were synced back.
+    """
+
+    def __init__(self, samples=SYNCBACK_LATENCY_SAMPLES):
+        # shard id -> account id -> queue depth
+        self._queue_depths = {}
+        self._latencies = defaultdict(lambda: deque(maxlen=samples))
+
+    def set_queue_depths(self, shard_id, queue_depths):
+        self._queue_depths[shard_id] = queue_depths
+        depths = queue_depths.values()
+        statsd_client.gauge(
+            "syncback.queues.{}.accounts".format(shard_id), len(queue_depths)
+        )
+        statsd_client.gauge(
+            "syncback.queues.{}.max_depth".format(shard_id), max(depths, default=0)
+        )
+
+    @property
+    def queue_depths(self):
+        return {
+            account_id: depth
+            for queue_depths in self._queue_depths.values()
+            for account_id, depth in queue_depths.items()
+        }
+
+    def record_latency(self, account_id, latency):
+        self._latencies[account_id].append(latency)
+
+    def latency_percentiles(self, account_id):
+        """Return {"p50": ..., ...} over the recent actions of an account."""
+        latencies = sorted(self._latencies.get(account_id, ()))
+        if not latencies:
+            return {}
+        return {
+            "p{}".format(p): latencies[
+                min(len(latencies) - 1, int(len(latencies) * p / 100.0))
+            ]
+            for p in LATENCY_PERCENTILES
+        }
+
+    def summary(self):
+        queue_depths = self.queue_depths
+        account_ids = set(queue_depths) | set(self._latencies)
+        return {
+            account_id: {
+                "queue_depth": queue_depths.get(account_id, 0),
+                "latency": self.latency_percentiles(account_id),
+            }
+            for account_id in account_ids
+        }
+
+
+def account_weight(queue_depth):
+    return max(1, min(queue_depth, SYNCBACK_MAX_ACCOUNT_WEIGHT))
@@ -0,0 +1,136 @@
+"""
+Notification-driven wakeups for delta long-polling and streaming.
+
+Every flush that creates transactions bumps the namespace's latest transaction
+id in the `latest-txn-by-namespace` zset (see `bump_redis_txn_id`). Instead of
+having every open /delta/longpoll or /delta/streaming connection query MySQL
+once per poll interval, a single per-process watcher greenlet reads the scores
+of all namespaces that currently have waiters (one pipelined Redis round trip
+per interval) and wakes only the greenlets whose namespace advanced.
+
+Use like this:
+
+    txnid = get_transaction_watcher().wait(namespace.public_id, pointer, 10)
+    if txnid is not None:
+        # There are transactions after `pointer`, go look at the database.
+
+"""
+import collections
+
+import gevent
+import gevent.event
+
+from inbox.config import config
+from inbox.ignition import redis_txn
+from inbox.logging import get_logger
+from inbox.models.transaction import TXN_REDIS_KEY
+
+log = get_logger()
+
+# Whether the delta endpoints should wait on the watcher rather than poll the
+# database every poll interval.
+DELTA_NOTIFICATIONS_ENABLED = config.get("DELTA_NOTIFICATIONS_ENABLED", False)
+# How often the watcher checks Redis for advanced namespaces.
+DELTA_NOTIFICATIONS_POLL_INTERVAL = config.get("DELTA_NOTIFICATIONS_POLL_INTERVAL", 1)
+# The Redis zset is bumped post-flush, i.e. possibly before the transaction
+# becomes visible to other database sessions. Waiters therefore still check the
+# database at least this often so that such a race can't stall them.
+DELTA_NOTIFICATIONS_FALLBACK_INTERVAL = config.get(
+    "DELTA_NOTIFICATIONS_FALLBACK_INTERVAL", 10
+)
+
+
+class _Waiter(object):
+    __slots__ = ("after", "event", "txnid")
+
+    def __init__(self, after):
+        self.after = after
+        self.event = gevent.event.Event()
+        self.txnid = None
+
+
+class TransactionWatcher(object):
+    """
+    Wakes greenlets waiting for new transactions in a namespace.
+
+    Parameters
+    ----------
+    poll_interval : float
+        How many seconds to wait between checks of the Redis zset.
+    """
+
+    def __init__(self, poll_interval=DELTA_NOTIFICATIONS_POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self._waiters = collections.defaultdict(set)
+        self._greenlet = None
+
+    def wait(self, namespace_public_id, after, timeout):
+        """
+        Block until the latest transaction id of the given namespace is
+        greater than `after`, or until `timeout` seconds have passed.
+
+        Returns
+        -------
+        int or None
+            The latest transaction id of the namespace if it advanced, None on
+            timeout.
+        """
+        self._ensure_running()
+        waiter = _Waiter(after)
+        waiters = self._waiters[namespace_public_id]
+        waiters.add(waiter)
+        try:
+            waiter.event.wait(timeout)
+        finally:
+            waiters.discard(waiter)
+            if not waiters:
+                self._waiters.pop(namespace_public_id, None)
+        return waiter.txnid
+
+    def check(self):
+        """
+        Read the latest transaction id of every namespace that has waiters and
+        wake the waiters whose namespace advanced.
+        """
+        namespace_public_ids = list(self._waiters)
+        if not namespace_public_ids:
+            return
+
+        pipe = redis_txn.pipeline(transaction=False)
+        for namespace_public_id in namespace_public_ids:
+            pipe.zscore(TXN_REDIS_KEY, namespace_public_id)
+        scores = pipe.execute()
+
+        for namespace_public_id, score in zip(namespace_public_ids, scores):
+            if score is None:
+                continue
+            txnid = int(score)
+            for waiter in list(self._waiters.get(namespace_public_id, ())):
+                if txnid > waiter.after:
+                    waiter.txnid = txnid
+                    waiter.event.set()
+
+    def _ensure_running(self):
+        if self._greenlet is None or self._greenlet.dead:
+            self._greenlet = gevent.spawn(self._run)
+
+    def _run(self):
+        while True:
+            try:
+                self.check()
+            except Exception:
+                # Waiters fall back to checking the database once their
+                # timeout expires, so keep going.
+                log.warning("Error checking for new transactions", exc_info=True)
+            gevent.sleep(self.poll_interval)
+
+
+_watcher = None
+
+
+def get_transaction_watcher():
+    """Return the per-process TransactionWatcher."""
+    global _watcher
+    if _watcher is None:
+        _watcher = TransactionWatcher()
+    return _watcher
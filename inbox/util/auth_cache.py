@@ -0,0 +1,215 @@
+"""
+A cache of the namespaces API credentials resolve to.
+
+Every API request authenticates with the public id of a namespace, which the
+API maps to the namespace's and account's ids. With API_AUTH_CACHE_ENABLED
+set, the mapping is cached in-process for API_AUTH_CACHE_TTL seconds, so hot
+namespaces are authenticated without touching MySQL. Public ids that don't
+resolve to a namespace (any more), or whose account is marked for deletion,
+are cached too, as deleted.
+
+With API_AUTH_CACHE_REDIS_ENABLED also set, entries are shared between API
+processes through Redis, for API_AUTH_CACHE_REDIS_TTL seconds. Deleting an
+account or marking it for deletion invalidates the entry of its namespace in
+the current process and in Redis; other processes may still use their local
+entry until it expires.
+
+"""
+import json
+import time
+from collections import OrderedDict, namedtuple
+
+from redis import StrictRedis
+
+from inbox.config import config
+from inbox.logging import get_logger
+from inbox.util.stats import statsd_client
+
+log = get_logger()
+
+AUTH_CACHE_ENABLED = config.get("API_AUTH_CACHE_ENABLED", False)
+AUTH_CACHE_TTL = config.get("API_AUTH_CACHE_TTL", 30)
+AUTH_CACHE_SIZE = config.get("API_AUTH_CACHE_SIZE", 10000)
+AUTH_CACHE_REDIS_ENABLED = config.get("API_AUTH_CACHE_REDIS_ENABLED", False)
+AUTH_CACHE_REDIS_TTL = config.get("API_AUTH_CACHE_REDIS_TTL", 300)
+AUTH_CACHE_REDIS_HOSTNAME = config.get(
+    "API_AUTH_CACHE_REDIS_HOSTNAME", config.get("TXN_REDIS_HOSTNAME")
+)
+AUTH_CACHE_REDIS_DB = config.get("API_AUTH_CACHE_REDIS_DB", config.get("TXN_REDIS_DB"))
+
+REDIS_KEY_PREFIX = "api:auth:"
+SOCKET_CONNECT_TIMEOUT = 5
+SOCKET_TIMEOUT = 5
+
+NamespaceAuth = namedtuple("NamespaceAuth", ["namespace_id", "account_id", "deleted"])
+
+DELETED = NamespaceAuth(None, None, True)
+
+
+def _get_redis_client():
+    return StrictRedis(
+        host=AUTH_CACHE_REDIS_HOSTNAME,
+        port=int(config.get("REDIS_PORT")),
+        db=AUTH_CACHE_REDIS_DB,
+        socket_connect_timeout=SOCKET_CONNECT_TIMEOUT,
+        socket_timeout=SOCKET_TIMEOUT,
+    )
+
+
+def _load(namespace_public_id):
+    from inbox.models import Account, Namespace
+    from inbox.models.account import is_marked_for_deletion
+    from inbox.models.session import global_session_scope
+
+    with global_session_scope() as db_session:
+        row = (
+            db_session.query(
+                Namespace.id,
+                Namespace.account_id,
+                Account.sync_state,
+                Account.sync_should_run,
+                Account._sync_status,
+            )
+            .join(Account, Namespace.account_id == Account.id)
+            .filter(Namespace.public_id == namespace_public_id)
+            .first()
+        )
+    if row is None:
+        return DELETED
+    namespace_id, account_id, sync_state, sync_should_run, sync_status = row
+    if is_marked_for_deletion(sync_state, sync_should_run, sync_status):
+        return DELETED
+    return NamespaceAuth(namespace_id, account_id, False)
+
+
+class NamespaceAuthCache(object):
+    """
+    A TTL and size-bounded LRU cache of public id -> NamespaceAuth.
+
+    Parameters
+    ----------
+    ttl : int
+        How long entries are used for, in seconds.
+    size : int
+        The most entries the cache holds.
+    redis : redis.StrictRedis, optional
+        If given, entries are shared through it.
+    redis_ttl : int
+        How long entries are kept in Redis, in seconds.
+    """
+
+    def __init__(
+        self, ttl=AUTH_CACHE_TTL, size=AUTH_CACHE_SIZE, redis=None, redis_ttl=None
+    ):
+        self.ttl = ttl
+        self.size = size
+        self.redis = redis
+        self.redis_ttl = redis_ttl or AUTH_CACHE_REDIS_TTL
+        # public id -> (NamespaceAuth, expiry), least recently used first.
+        self._entries = OrderedDict()
+
+    def get(self, namespace_public_id, load=None):
+        """
+        Return the NamespaceAuth of a public id, calling `load` with it on a
+        miss. Loads it from the database by default.
+        """
+        entry = self._get_local(namespace_public_id)
+        if entry is not None:
+            statsd_client.incr("api.auth_cache.hits")
+            return entry
+
+        entry = self._get_redis(namespace_public_id)
+        if entry is not None:
+            statsd_client.incr("api.auth_cache.redis_hits")
+        else:
+            statsd_client.incr("api.auth_cache.misses")
+            entry = (load or _load)(namespace_public_id)
+            self._set_redis(namespace_public_id, entry)
+        self._set_local(namespace_public_id, entry)
+        return entry
+
+    def invalidate(self, namespace_public_id):
+        self._entries.pop(namespace_public_id, None)
+        if self.redis is not None:
+            try:
+                self.redis.delete(REDIS_KEY_PREFIX + namespace_public_id)
+            except Exception:
+                log.warning(
+                    "Failed to invalidate cached namespace auth",
+                    namespace_public_id=namespace_public_id,
+                    exc_info=True,
+                )
+
+    def _get_local(self, namespace_public_id):
+        cached = self._entries.get(namespace_public_id)
+        if cached is None:
+            return None
+        entry, expiry = cached
+        if expiry < time.time():
+            del self._entries[namespace_public_id]
+            return None
+        self._entries.move_to_end(namespace_public_id)
+        return entry
+
+    def _set_local(self, namespace_public_id, entry):
+        self._entries[namespace_public_id] = (entry, time.time() + self.ttl)
+        self._entries.move_to_end(namespace_public_id)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def _get_redis(self, namespace_public_id):
+        if self.redis is None:
+            return None
+        try:
+            value = self.redis.get(REDIS_KEY_PREFIX + namespace_public_id)
+        except Exception:
+            # Fall back to the database rather than failing the request.
+            log.warning("Failed to get cached namespace auth", exc_info=True)
+            return None
+        if value is None:
+            return None
+        return NamespaceAuth(*json.loads(value))
+
+    def _set_redis(self, namespace_public_id, entry):
+        if self.redis is None:
+            return
+        try:
+            self.redis.set(
+                REDIS_KEY_PREFIX + namespace_public_id,
+                json.dumps(list(entry)),
+                ex=self.redis_ttl,
+            )
+        except Exception:
+            log.warning("Failed to cache namespace auth", exc_info=True)
+
+
+_cache = None
+
+
+def _get_cache():
+    global _cache
+    if _cache is None:
+        redis = _get_redis_client() if AUTH_CACHE_REDIS_ENABLED else None
+        _cache = NamespaceAuthCache(redis=redis)
+    return _cache
+
+
+def get_namespace_auth(namespace_public_id):
+    """
+    Return the NamespaceAuth of the namespace with the given public id; from
+    the cache if API_AUTH_CACHE_ENABLED is set.
+
+    """
+    if not AUTH_CACHE_ENABLED:
+        return _load(namespace_public_id)
+    return _get_cache().get(namespace_public_id)
+
+
+def invalidate_namespace_auth(namespace_public_id):
+    """
+    Drop the cached NamespaceAuth of a namespace, e.g. because its account
+    was deleted.
+
+    """
+    if AUTH_CACHE_ENABLED:
+        _get_cache().invalidate(namespace_public_id)
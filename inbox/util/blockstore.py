@@ -1,6 +1,7 @@
 import os
 import time
 from hashlib import sha256
+from typing import Optional
 
 from inbox.config import config
 from inbox.logging import get_logger
@@ -10,13 +11,52 @@ log = get_logger()
 
 # TODO: store AWS credentials in a better way.
 STORE_MSG_ON_S3 = config.get("STORE_MESSAGES_ON_S3", None)
+# How many bytes streaming reads pull from disk or S3 at a time.
+STREAM_CHUNK_SIZE = config.get("BLOCKSTORE_STREAM_CHUNK_SIZE", 64 * 1024)
+# Blobs up to this size are read and verified before any of them is sent.
+STREAM_VERIFY_MAX_SIZE = config.get("BLOCKSTORE_STREAM_VERIFY_MAX_SIZE", 1024 * 1024)
+# Keep recently read and written S3 blobs in a process-local cache.
+CACHE_ENABLED = config.get("BLOCKSTORE_CACHE_ENABLED", False)
+CACHE_DIRECTORY = config.get("BLOCKSTORE_CACHE_DIRECTORY", None)
+CACHE_SIZE = config.get("BLOCKSTORE_CACHE_SIZE", 256 * 1024 * 1024)
+CACHE_MAX_BLOB_SIZE = config.get("BLOCKSTORE_CACHE_MAX_BLOB_SIZE", 8 * 1024 * 1024)
+# How many keys known to exist on S3 to remember, so saves can skip the HEAD.
+CACHE_KNOWN_KEYS_SIZE = config.get("BLOCKSTORE_CACHE_KNOWN_KEYS_SIZE", 100000)
+# For how many seconds. Keys get deleted by other processes and expired by the
+# temp bucket's lifecycle rules, so keep this well below both windows.
+CACHE_KNOWN_KEYS_TTL = config.get("BLOCKSTORE_CACHE_KNOWN_KEYS_TTL", 300)
 
 
 from boto.s3.connection import S3Connection
 from boto.s3.key import Key
 
+from inbox.util.blockstore_cache import BlockstoreCache, KnownKeys
 from inbox.util.file import mkdirp
 
+_cache = None
+_known_keys = None
+_s3_buckets = {}
+
+
+def _get_cache():
+    # type: () -> Optional[BlockstoreCache]
+    global _cache
+    if not CACHE_ENABLED:
+        return None
+    if _cache is None:
+        _cache = BlockstoreCache(CACHE_SIZE, CACHE_MAX_BLOB_SIZE, CACHE_DIRECTORY)
+    return _cache
+
+
+def _get_known_keys():
+    # type: () -> Optional[KnownKeys]
+    global _known_keys
+    if not CACHE_ENABLED:
+        return None
+    if _known_keys is None:
+        _known_keys = KnownKeys(CACHE_KNOWN_KEYS_SIZE, CACHE_KNOWN_KEYS_TTL)
+    return _known_keys
+
 
 def _data_file_directory(h):
     return os.path.join(
@@ -55,8 +95,19 @@ def _save_to_s3(data_sha256, data):
 
     _save_to_s3_bucket(data_sha256, config.get("TEMP_MESSAGE_STORE_BUCKET_NAME"), data)
 
+    # Freshly saved blobs tend to be read right back, e.g. when sending.
+    cache = _get_cache()
+    if cache is not None:
+        cache.put(data_sha256, data)
+
 
 def get_s3_bucket(bucket_name):
+    # Boto pools the underlying HTTP connections, so the bucket (and its
+    # connection object) can be shared.
+    bucket = _s3_buckets.get(bucket_name)
+    if bucket is not None:
+        return bucket
+
     conn = S3Connection(
         config.get("AWS_ACCESS_KEY_ID"),
         config.get("AWS_SECRET_ACCESS_KEY"),
@@ -64,7 +115,8 @@ def get_s3_bucket(bucket_name):
         port=config.get("AWS_S3_PORT"),
         is_secure=config.get("AWS_S3_IS_SECURE", True),
     )
-    return conn.get_bucket(bucket_name, validate=False)
+    bucket = _s3_buckets[bucket_name] = conn.get_bucket(bucket_name, validate=False)
+    return bucket
 
 
 def _save_to_s3_bucket(data_sha256, bucket_name, data):
@@ -73,17 +125,26 @@ def _save_to_s3_bucket(data_sha256, bucket_name, data):
     assert "AWS_SECRET_ACCESS_KEY" in config, "Need AWS secret!"
     start = time.time()
 
+    known_keys = _get_known_keys()
+    if known_keys is not None and data_sha256 in known_keys:
+        statsd_client.incr("s3_blockstore.known_keys.hits")
+        return
+
     # Boto pools connections at the class level
     bucket = get_s3_bucket(bucket_name)
 
     # See if it already exists; if so, don't recreate.
     key = bucket.get_key(data_sha256)
     if key:
+        if known_keys is not None:
+            known_keys.add(data_sha256)
         return
 
     key = Key(bucket)
     key.key = data_sha256
     key.set_contents_from_string(data)
+    if known_keys is not None:
+        known_keys.add(data_sha256)
 
     end = time.time()
     latency_millis = (end - start) * 1000
@@ -104,6 +165,10 @@ def get_from_blockstore(data_sha256):
     assert (
         data_sha256 == sha256(value).hexdigest()
     ), "Returned data doesn't match stored hash!"
+
+    cache = _get_cache()
+    if STORE_MSG_ON_S3 and cache is not None:
+        cache.put(data_sha256, value)
     return value
 
 
@@ -115,6 +180,12 @@ def _get_from_s3(data_sha256):
         "TEMP_MESSAGE_STORE_BUCKET_NAME" in config
     ), "Need temp bucket name to store message data!"
 
+    cache = _get_cache()
+    if cache is not None:
+        data = cache.get(data_sha256)
+        if data is not None:
+            return data
+
     # Try getting data from our temporary blockstore before
     # trying getting it from the provider.
     data = _get_from_s3_bucket(
@@ -148,6 +219,9 @@ def _get_from_s3_bucket(data_sha256, bucket_name):
         log.warning("No key with name: {} returned!".format(data_sha256))
         return
 
+    known_keys = _get_known_keys()
+    if known_keys is not None:
+        known_keys.add(data_sha256)
     return key.get_contents_as_string()
 
 
@@ -163,6 +237,186 @@ def _get_from_disk(data_sha256):
         return
 
 
+class BlockstoreHashMismatch(Exception):
+    pass
+
+
+class BlockstoreReader(object):
+    """
+    A handle on a blob in the blockstore that can be read in chunks.
+
+    Use `open_blockstore_stream` to get one. The blob's size is known up front
+    so that callers can serve byte ranges; the data itself is only read as
+    `iter_chunks` is consumed.
+    """
+
+    def __init__(self, data_sha256, size):
+        self.data_sha256 = data_sha256
+        self.size = size
+
+    def iter_chunks(self, start=0, stop=None, chunk_size=None):
+        """
+        Yield the bytes in [start, stop) of the blob.
+
+        When the whole blob is read its sha256 is verified incrementally. The
+        last chunk is held back until it is, and BlockstoreHashMismatch is
+        raised instead of yielding it if the hash doesn't match, so that a
+        response streaming the blob is cut short rather than completed.
+        The reader is closed once the generator is exhausted or closed.
+        """
+        if stop is None or stop > self.size:
+            stop = self.size
+        chunk_size = chunk_size or STREAM_CHUNK_SIZE
+        verify = start == 0 and stop == self.size
+        hasher = sha256()
+        last = None
+
+        try:
+            if start < stop:
+                for chunk in self._read(start, stop, chunk_size):
+                    if verify:
+                        hasher.update(chunk)
+                    if last is not None:
+                        yield last
+                    last = chunk
+        finally:
+            self.close()
+
+        if verify and self.data_sha256 != hasher.hexdigest():
+            log.error(
+                "Returned data doesn't match stored hash!",
+                sha256=self.data_sha256,
+                returned_sha256=hasher.hexdigest(),
+            )
+            statsd_client.incr("blockstore.stream.hash_mismatches")
+            raise BlockstoreHashMismatch(self.data_sha256)
+        if last is not None:
+            yield last
+
+    def read(self):
+        """
+        Read and verify the whole blob. Raises BlockstoreHashMismatch if it
+        doesn't match its sha256.
+        """
+        return b"".join(self.iter_chunks())
+
+    def _read(self, start, stop, chunk_size):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class _DiskBlockstoreReader(BlockstoreReader):
+    def __init__(self, data_sha256, f):
+        self._file = f
+        super(_DiskBlockstoreReader, self).__init__(
+            data_sha256, os.fstat(f.fileno()).st_size
+        )
+
+    def _read(self, start, stop, chunk_size):
+        self._file.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = self._file.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+    def close(self):
+        self._file.close()
+
+
+class _S3BlockstoreReader(BlockstoreReader):
+    def __init__(self, data_sha256, key):
+        self._key = key
+        super(_S3BlockstoreReader, self).__init__(data_sha256, key.size)
+
+    def _read(self, start, stop, chunk_size):
+        headers = None
+        if start != 0 or stop != self.size:
+            headers = {"Range": "bytes={}-{}".format(start, stop - 1)}
+        self._key.open_read(headers=headers)
+        while True:
+            chunk = self._key.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        # Don't read the rest of the body first, downloads may be cut short.
+        self._key.close(fast=True)
+
+
+class _MemoryBlockstoreReader(BlockstoreReader):
+    def __init__(self, data_sha256, data):
+        self._data = data
+        super(_MemoryBlockstoreReader, self).__init__(data_sha256, len(data))
+
+    def _read(self, start, stop, chunk_size):
+        for offset in range(start, stop, chunk_size):
+            yield self._data[offset : min(offset + chunk_size, stop)]
+
+
+def open_blockstore_stream(data_sha256):
+    # type: (str) -> Optional[BlockstoreReader]
+    """
+    Open a blob for streaming reads, without loading it into memory.
+
+    Returns None if the blob isn't in the blockstore.
+    """
+    if not data_sha256:
+        return None
+
+    if STORE_MSG_ON_S3:
+        reader = _open_s3_stream(data_sha256)
+    else:
+        reader = _open_disk_stream(data_sha256)
+
+    if reader is None:
+        # The block may have expired.
+        log.warning("No data returned!")
+    return reader
+
+
+def _open_s3_stream(data_sha256):
+    assert "AWS_ACCESS_KEY_ID" in config, "Need AWS key!"
+    assert "AWS_SECRET_ACCESS_KEY" in config, "Need AWS secret!"
+
+    assert (
+        "TEMP_MESSAGE_STORE_BUCKET_NAME" in config
+    ), "Need temp bucket name to store message data!"
+
+    cache = _get_cache()
+    data = cache.get(data_sha256) if cache is not None else None
+    if data is not None:
+        return _MemoryBlockstoreReader(data_sha256, data)
+
+    bucket = get_s3_bucket(config.get("TEMP_MESSAGE_STORE_BUCKET_NAME"))
+    # get_key() only issues a HEAD request; the body is fetched lazily.
+    key = bucket.get_key(data_sha256)
+    if not key:
+        log.info(
+            "Couldn't find data in blockstore",
+            sha256=data_sha256,
+            logstash_tag="s3_direct",
+        )
+        return None
+
+    return _S3BlockstoreReader(data_sha256, key)
+
+
+def _open_disk_stream(data_sha256):
+    try:
+        f = open(_data_file_path(data_sha256), "rb")
+    except IOError:
+        log.warning("No file with name: {}!".format(data_sha256))
+        return None
+
+    return _DiskBlockstoreReader(data_sha256, f)
+
+
 def _delete_from_s3_bucket(data_sha256_hashes, bucket_name):
     data_sha256_hashes = [hash_ for hash_ in data_sha256_hashes if hash_]
     if not data_sha256_hashes:
@@ -195,6 +449,14 @@ def _delete_from_disk(data_sha256):
 def delete_from_blockstore(*data_sha256_hashes):
     log.info("deleting from blockstore", sha256=data_sha256_hashes)
 
+    cache = _get_cache()
+    known_keys = _get_known_keys()
+    for data_sha256 in data_sha256_hashes:
+        if cache is not None:
+            cache.discard(data_sha256)
+        if known_keys is not None:
+            known_keys.discard(data_sha256)
+
     if STORE_MSG_ON_S3:
         _delete_from_s3_bucket(
             data_sha256_hashes, config.get("TEMP_MESSAGE_STORE_BUCKET_NAME")
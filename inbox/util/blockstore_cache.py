@@ -0,0 +1,177 @@
+"""
+A process-local cache tier for the S3 blockstore.
+
+Blobs are copied into a single memory-mapped segment file and indexed by their
+sha256. When the segment is full, the least recently used blobs are evicted
+until the new blob fits. The segment file is unlinked as soon as it's created,
+so it goes away with the process, and it's recreated after a fork so that
+parent and child never write into each other's mapping.
+
+"""
+import bisect
+import mmap
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from inbox.util.file import mkdirp
+from inbox.util.stats import statsd_client
+
+
+class BlockstoreCache(object):
+    """
+    A size-bounded LRU cache of blobs backed by a memory-mapped segment.
+
+    Parameters
+    ----------
+    max_bytes : int
+        The size of the segment, i.e. the most data the cache will hold.
+    max_blob_size : int
+        Blobs larger than this aren't cached.
+    directory : str or None
+        Where to create the segment file. Defaults to the system temporary
+        directory.
+    """
+
+    def __init__(self, max_bytes, max_blob_size, directory=None):
+        self.max_bytes = max_bytes
+        self.max_blob_size = min(max_blob_size, max_bytes)
+        self.directory = directory
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._segment = None
+        self._segment_file = None
+        # data_sha256 -> (offset, size), least recently used first.
+        self._entries = OrderedDict()
+        # Sorted (offset, size) extents of the segment that are unused.
+        self._free = [(0, self.max_bytes)]
+        self.used_bytes = 0
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # Inherited over a fork; don't share the parent's mapping.
+            self._reset()
+
+    def _get_segment(self):
+        self._check_pid()
+        if self._segment is None:
+            if self.directory:
+                mkdirp(self.directory)
+            self._segment_file = tempfile.TemporaryFile(dir=self.directory)
+            self._segment_file.truncate(self.max_bytes)
+            self._segment = mmap.mmap(self._segment_file.fileno(), self.max_bytes)
+        return self._segment
+
+    def __contains__(self, data_sha256):
+        return self._pid == os.getpid() and data_sha256 in self._entries
+
+    def get(self, data_sha256):
+        # type: (str) -> Optional[bytes]
+        self._check_pid()
+        entry = self._entries.get(data_sha256)
+        if entry is None:
+            statsd_client.incr("s3_blockstore.cache.misses")
+            return None
+
+        self._entries.move_to_end(data_sha256)
+        statsd_client.incr("s3_blockstore.cache.hits")
+        offset, size = entry
+        return self._segment[offset : offset + size]
+
+    def put(self, data_sha256, data):
+        # type: (str, bytes) -> None
+        size = len(data)
+        if size == 0 or size > self.max_blob_size:
+            return
+
+        segment = self._get_segment()
+        if data_sha256 in self._entries:
+            self._entries.move_to_end(data_sha256)
+            return
+
+        offset = self._allocate(size)
+        evicted = 0
+        while offset is None:
+            _, (old_offset, old_size) = self._entries.popitem(last=False)
+            self._release(old_offset, old_size)
+            evicted += 1
+            offset = self._allocate(size)
+        if evicted:
+            statsd_client.incr("s3_blockstore.cache.evictions", evicted)
+
+        segment[offset : offset + size] = data
+        self._entries[data_sha256] = (offset, size)
+        statsd_client.gauge("s3_blockstore.cache.bytes", self.used_bytes)
+
+    def discard(self, data_sha256):
+        # type: (str) -> None
+        if data_sha256 not in self:
+            return
+        offset, size = self._entries.pop(data_sha256)
+        self._release(offset, size)
+
+    def _allocate(self, size):
+        # First fit; eviction in put() takes care of fragmentation.
+        for i, (offset, length) in enumerate(self._free):
+            if length >= size:
+                if length == size:
+                    del self._free[i]
+                else:
+                    self._free[i] = (offset + size, length - size)
+                self.used_bytes += size
+                return offset
+        return None
+
+    def _release(self, offset, size):
+        self.used_bytes -= size
+        i = bisect.bisect(self._free, (offset, size))
+        # Coalesce with the following and preceding extents.
+        if i < len(self._free) and offset + size == self._free[i][0]:
+            size += self._free.pop(i)[1]
+        if i > 0 and self._free[i - 1][0] + self._free[i - 1][1] == offset:
+            i -= 1
+            offset = self._free[i][0]
+            size += self._free.pop(i)[1]
+        self._free.insert(i, (offset, size))
+
+
+class KnownKeys(object):
+    """
+    A size-bounded set of keys that are known to exist in a bucket, so that
+    saves can skip checking for them first.
+
+    Keys can disappear behind our back: other processes delete them, and the
+    bucket's lifecycle rules expire them. So keys are only remembered for
+    `ttl` seconds after they were last seen in the bucket, which must be well
+    below both of those windows.
+
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> when it expires, least recently used first.
+        self._keys = OrderedDict()
+
+    def __contains__(self, key):
+        expires_at = self._keys.get(key)
+        if expires_at is None:
+            return False
+        if expires_at <= time.time():
+            del self._keys[key]
+            return False
+        self._keys.move_to_end(key)
+        return True
+
+    def add(self, key):
+        self._keys[key] = time.time() + self.ttl
+        self._keys.move_to_end(key)
+        while len(self._keys) > self.max_size:
+            self._keys.popitem(last=False)
+
+    def discard(self, key):
+        self._keys.pop(key, None)
@@ -0,0 +1,519 @@
+"""
+Parsing of raw MIME messages, optionally off the gevent hub.
+
+Parsing a message with flanker and computing its body and snippet is pure
+CPU work, and for large messages with many parts it can block a sync process
+for seconds. `parse_message` turns a raw message into a `ParsedMessage`, a
+compact, picklable description of its headers, addresses, body and
+attachments, which `Message.create_from_synced` then builds the Message (and
+its Parts and Blocks) from.
+
+Where the parsing happens is up to the parse service, see `get_parse_service`:
+
+- "inline" parses in the calling greenlet.
+- "process" parses messages of at least MIME_PARSE_OFFLOAD_MIN_SIZE bytes in a
+  pool of worker processes while the calling greenlet waits without blocking
+  the hub. Smaller messages are cheaper to parse than to send to a worker, so
+  they're still parsed inline.
+
+Errors are logged by the caller rather than the worker, so that the events
+end up in the sync process' log: `parse_message` records them in
+`ParsedMessage.log_events` and `ParsedMessage.replay_log` emits them.
+
+"""
+import binascii
+import datetime
+import multiprocessing
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from flanker import mime
+from gevent.queue import Queue
+from gevent.socket import wait_read
+
+from inbox.config import config
+from inbox.logging import get_logger
+from inbox.sqlalchemy_ext.util import json_field_too_long
+from inbox.util.addr import parse_mimepart_address_header
+from inbox.util.encoding import unicode_safe_truncate
+from inbox.util.html import HTMLParseError, plaintext2html, strip_tags
+from inbox.util.misc import get_internaldate, parse_references
+from inbox.util.stats import statsd_client
+
+log = get_logger()
+
+SNIPPET_LENGTH = 191
+
+# "inline" or "process".
+MIME_PARSE_BACKEND = config.get("MIME_PARSE_BACKEND", "inline")
+MIME_PARSE_POOL_SIZE = config.get("MIME_PARSE_POOL_SIZE", 2)
+# Messages smaller than this are parsed inline even by the process backend.
+MIME_PARSE_OFFLOAD_MIN_SIZE = config.get("MIME_PARSE_OFFLOAD_MIN_SIZE", 256 * 1024)
+# Workers that take longer than this many seconds to parse a message are
+# killed and replaced.
+MIME_PARSE_TIMEOUT = config.get("MIME_PARSE_TIMEOUT", 60)
+
+
+class ParsedAttachment(object):
+    """A MIME part that's stored as a Block, with its data."""
+
+    def __init__(self, data, content_disposition, content_type, filename, content_id):
+        # type: (bytes, str, str, Optional[str], Optional[str]) -> None
+        self.data = data
+        self.content_disposition = content_disposition
+        self.content_type = content_type
+        self.filename = filename
+        self.content_id = content_id
+
+
+class ParsedMessage(object):
+    """
+    The result of parsing a raw message.
+
+    Attributes that couldn't be parsed are None. `decode_error` is set if any
+    part of the message failed to parse, in which case the Message is marked
+    as such.
+    """
+
+    def __init__(self):
+        # type: () -> None
+        self.subject = None  # type: Optional[str]
+        self.from_addr = None  # type: Optional[List[List[str]]]
+        self.sender_addr = None  # type: Optional[List[List[str]]]
+        self.reply_to = None  # type: Optional[List[List[str]]]
+        self.to_addr = None  # type: Optional[List[List[str]]]
+        self.cc_addr = None  # type: Optional[List[List[str]]]
+        self.bcc_addr = None  # type: Optional[List[List[str]]]
+        self.in_reply_to = None  # type: Optional[str]
+        self.message_id_header = None  # type: Optional[str]
+        self.received_date = None  # type: Optional[datetime.datetime]
+        self.nylas_uid = None  # type: Optional[str]
+        self.references = None  # type: Optional[List[str]]
+        self.size = None  # type: Optional[int]
+        self.body = None  # type: Optional[str]
+        self.snippet = None  # type: Optional[str]
+        self.attachments = []  # type: List[ParsedAttachment]
+        # The first value of each header, by lowercased name.
+        self.headers = {}  # type: Dict[str, Any]
+        self.decode_error = False
+        self.log_events = []  # type: List[Tuple[str, str, Dict[str, Any]]]
+
+    def log(self, level, event, **kwargs):
+        # type: (str, str, **Any) -> None
+        self.log_events.append((level, event, kwargs))
+
+    def replay_log(self, logger):
+        """Emit the events logged while parsing to the given logger."""
+        for level, event, kwargs in self.log_events:
+            getattr(logger, level)(event, **kwargs)
+
+
+def parse_message(body_string, received_date, account_id, folder_name, mid):
+    # type: (bytes, Optional[datetime.datetime], int, str, Any) -> ParsedMessage
+    """
+    Parse a raw message.
+
+    Parameters
+    ----------
+    body_string : bytes
+        The full message including headers (encoded).
+    received_date : datetime.datetime or None
+        The date the message was received, if known; otherwise it's taken
+        from the Date or Received headers.
+    account_id, folder_name, mid
+        Only used for logging errors.
+
+    """
+    result = ParsedMessage()
+    try:
+        parsed = mime.from_string(body_string)
+        for name, value in parsed.headers.items():
+            result.headers.setdefault(name.lower(), value)
+        _parse_metadata(
+            result, parsed, body_string, received_date, account_id, folder_name, mid
+        )
+    except Exception as e:
+        result.log(
+            "error",
+            "Error parsing message metadata",
+            folder_name=folder_name,
+            account_id=account_id,
+            error=e,
+            mid=mid,
+        )
+        result.decode_error = True
+        return result
+
+    html_parts = []  # type: List[bytes]
+    plain_parts = []  # type: List[bytes]
+    for mimepart in parsed.walk(with_self=parsed.content_type.is_singlepart()):
+        try:
+            if mimepart.content_type.is_multipart():
+                continue  # TODO should we store relations?
+            _parse_mimepart(result, mid, mimepart, html_parts, plain_parts)
+        except (
+            mime.DecodingError,
+            AttributeError,
+            RuntimeError,
+            TypeError,
+            binascii.Error,
+            ValueError,
+        ) as e:
+            if isinstance(e, ValueError) and not isinstance(e, UnicodeEncodeError):
+                message = e.args[0] if e.args else ""
+                if message != "string argument should contain only ASCII characters":
+                    raise
+
+            result.log(
+                "error",
+                "Error parsing message MIME parts",
+                folder_name=folder_name,
+                account_id=account_id,
+                error=e,
+                mid=mid,
+            )
+            result.decode_error = True
+    store_body = config.get("STORE_MESSAGE_BODIES", True)  # type: bool
+    result.body, result.snippet = calculate_body(
+        html_parts, plain_parts, store_body=store_body, nylas_uid=result.nylas_uid
+    )
+
+    # Occasionally people try to send messages to way too many
+    # recipients. In such cases, empty the field and treat as a parsing
+    # error so that we don't break the entire sync.
+    for field in ("to_addr", "cc_addr", "bcc_addr", "references", "reply_to"):
+        value = getattr(result, field)  # type: List[Any]
+        if json_field_too_long(value):
+            result.log(
+                "error",
+                "Recipient field too long",
+                field=field,
+                account_id=account_id,
+                folder_name=folder_name,
+                mid=mid,
+            )
+            setattr(result, field, [])
+            result.decode_error = True
+
+    return result
+
+
+def _parse_metadata(
+    result, parsed, body_string, received_date, account_id, folder_name, mid
+):
+    # type: (ParsedMessage, Any, bytes, Optional[datetime.datetime], int, str, Any) -> None
+    mime_version = parsed.headers.get("Mime-Version")  # type: Optional[str]
+    # sometimes MIME-Version is '1.0 (1.0)', hence the .startswith()
+    if mime_version is not None and not mime_version.startswith("1.0"):
+        result.log(
+            "warning",
+            "Unexpected MIME-Version",
+            account_id=account_id,
+            folder_name=folder_name,
+            mid=mid,
+            mime_version=mime_version,
+        )
+
+    result.subject = parsed.subject
+    result.from_addr = parse_mimepart_address_header(parsed, "From")
+    result.sender_addr = parse_mimepart_address_header(parsed, "Sender")
+    result.reply_to = parse_mimepart_address_header(parsed, "Reply-To")
+    result.to_addr = parse_mimepart_address_header(parsed, "To")
+    result.cc_addr = parse_mimepart_address_header(parsed, "Cc")
+    result.bcc_addr = parse_mimepart_address_header(parsed, "Bcc")
+
+    result.in_reply_to = parsed.headers.get("In-Reply-To")
+
+    # The RFC mandates that the Message-Id header must be at most 998
+    # characters. Sadly, not everybody follows specs.
+    result.message_id_header = parsed.headers.get("Message-Id")
+    if result.message_id_header and len(result.message_id_header) > 998:
+        result.message_id_header = result.message_id_header[:998]
+        result.log(
+            "warning",
+            "Message-Id header too long. Truncating",
+            logstash_tag="truncated_message_id",
+        )
+
+    result.received_date = (
+        received_date
+        if received_date
+        else get_internaldate(
+            parsed.headers.get("Date"), parsed.headers.get("Received")
+        )
+    )
+
+    # It seems MySQL rounds up fractional seconds in a weird way,
+    # preventing us from reconciling messages correctly. See:
+    # https://github.com/nylas/sync-engine/commit/ed16b406e0a for
+    # more details.
+    result.received_date = result.received_date.replace(microsecond=0)
+
+    # Custom Nylas header
+    result.nylas_uid = parsed.headers.get("X-INBOX-ID")
+
+    # In accordance with JWZ (http://www.jwz.org/doc/threading.html)
+    result.references = parse_references(
+        parsed.headers.get("References", ""), parsed.headers.get("In-Reply-To", "")
+    )
+
+    result.size = len(body_string)  # includes headers text
+
+
+def _parse_mimepart(result, mid, mimepart, html_parts, plain_parts):
+    # type: (ParsedMessage, Any, Any, List[bytes], List[bytes]) -> None
+    disposition, _ = mimepart.content_disposition
+    content_id = mimepart.headers.get("Content-Id")  # type: Optional[str]
+    content_type, params = mimepart.content_type
+
+    filename = mimepart.detected_file_name  # type: Optional[str]
+    if filename == "":
+        filename = None
+
+    data = mimepart.body  # type: Optional[str]
+
+    is_text = content_type.startswith("text")
+    if disposition not in (None, "inline", "attachment"):
+        result.log(
+            "error",
+            "Unknown Content-Disposition",
+            mid=mid,
+            bad_content_disposition=mimepart.content_disposition,
+        )
+        result.decode_error = True
+        return
+
+    if disposition == "attachment":
+        _add_attachment(result, data, disposition, content_type, filename, content_id)
+        return
+
+    if disposition == "inline" and not (
+        is_text and filename is None and content_id is None
+    ):
+        # Some clients set Content-Disposition: inline on text MIME parts
+        # that we really want to treat as part of the text body. Don't
+        # treat those as attachments.
+        _add_attachment(result, data, disposition, content_type, filename, content_id)
+        return
+
+    if is_text:
+        if data is None:
+            return
+        normalized_data = data.encode("utf-8", "strict")  # type: bytes
+        normalized_data = normalized_data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        if content_type == "text/html":
+            html_parts.append(normalized_data)
+        elif content_type == "text/plain":
+            plain_parts.append(normalized_data)
+        else:
+            result.log(
+                "info",
+                "Saving other text MIME part as attachment",
+                content_type=content_type,
+                mid=mid,
+            )
+            _add_attachment(
+                result, data, "attachment", content_type, filename, content_id
+            )
+        return
+
+    # Finally, if we get a non-text MIME part without Content-Disposition,
+    # treat it as an attachment.
+    _add_attachment(result, data, "attachment", content_type, filename, content_id)
+
+
+def _add_attachment(
+    result, data, content_disposition, content_type, filename, content_id
+):
+    # type: (ParsedMessage, Optional[str], str, str, Optional[str], Optional[str]) -> None
+    if content_id:
+        content_id = content_id[:255]
+    data = data or ""
+    if not isinstance(data, bytes):
+        data = data.encode("utf-8", "strict")
+    result.attachments.append(
+        ParsedAttachment(data, content_disposition, content_type, filename, content_id)
+    )
+
+
+def calculate_body(html_parts, plain_parts, store_body=True, nylas_uid=None):
+    # type: (List[bytes], List[bytes], bool, Optional[str]) -> Tuple[Optional[str], str]
+    """Return the body and the snippet of a message from its text parts."""
+    html_body = b"".join(html_parts).decode("utf-8").strip()
+    plain_body = b"\n".join(plain_parts).decode("utf-8").strip()
+    if html_body:
+        snippet = calculate_html_snippet(html_body, nylas_uid)
+        return (html_body if store_body else None), snippet
+    elif plain_body:
+        snippet = calculate_plaintext_snippet(plain_body)
+        return (plaintext2html(plain_body, False) if store_body else None), snippet
+    return None, u""
+
+
+def calculate_html_snippet(text, nylas_uid=None):
+    # type: (str, Optional[str]) -> str
+    try:
+        text = strip_tags(text)
+    except HTMLParseError:
+        log.error("error stripping tags", message_nylas_uid=nylas_uid, exc_info=True)
+        text = ""
+
+    return calculate_plaintext_snippet(text)
+
+
+def calculate_plaintext_snippet(text):
+    # type: (str) -> str
+    return unicode_safe_truncate(" ".join(text.split()), SNIPPET_LENGTH)
+
+
+class MimeParseError(Exception):
+    """Raised when a worker process fails to parse a message."""
+
+    pass
+
+
+class MimeParseTimeout(MimeParseError):
+    """Raised when a worker process takes too long to parse a message."""
+
+    pass
+
+
+class InlineParseService(object):
+    """Parses messages in the calling greenlet."""
+
+    def parse(self, body_string, received_date, account_id, folder_name, mid):
+        # type: (bytes, Optional[datetime.datetime], int, str, Any) -> ParsedMessage
+        return parse_message(body_string, received_date, account_id, folder_name, mid)
+
+
+def _worker_main(conn):
+    # Runs in the worker processes: parse messages until the parent goes away.
+    while True:
+        try:
+            args = conn.recv()
+        except EOFError:
+            return
+        try:
+            result = (True, parse_message(*args))
+        except Exception as e:
+            result = (False, e)
+        try:
+            conn.send(result)
+        except Exception as e:
+            # Most likely something that couldn't be pickled, e.g. an
+            # exception object in the log events.
+            conn.send((False, MimeParseError(repr(e))))
+
+
+class _Worker(object):
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main, args=(child_conn,), name="mime-parse-worker"
+        )
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+    def parse(self, args, timeout):
+        self.conn.send(args)
+        # Wait for the result without blocking the hub.
+        wait_read(
+            self.conn.fileno(),
+            timeout=timeout,
+            timeout_exc=MimeParseTimeout("MIME parse worker timed out"),
+        )
+        ok, result = self.conn.recv()
+        if not ok:
+            raise result
+        return result
+
+    def close(self):
+        self.conn.close()
+        # The worker may be stuck in a parse, so don't ask nicely.
+        self.process.kill()
+
+
+class ProcessPoolParseService(object):
+    """
+    Parses large messages in a pool of worker processes.
+
+    Parameters
+    ----------
+    size : int
+        The number of worker processes.
+    offload_min_size : int
+        Messages smaller than this many bytes are parsed inline.
+    timeout : float
+        How many seconds a worker gets to parse a message before it's killed
+        and replaced.
+    """
+
+    def __init__(self, size, offload_min_size, timeout=MIME_PARSE_TIMEOUT):
+        self.size = size
+        self.offload_min_size = offload_min_size
+        self.timeout = timeout
+        self._pid = None
+        self._idle = None
+
+    def _get_idle(self):
+        if self._pid != os.getpid():
+            # The workers are started lazily, and again after a fork, so
+            # that processes never share them.
+            self._pid = os.getpid()
+            context = multiprocessing.get_context("spawn")
+            self._idle = Queue()
+            for _ in range(self.size):
+                self._idle.put(_Worker(context))
+        return self._idle
+
+    def parse(self, body_string, received_date, account_id, folder_name, mid):
+        # type: (bytes, Optional[datetime.datetime], int, str, Any) -> ParsedMessage
+        if len(body_string) < self.offload_min_size:
+            return parse_message(
+                body_string, received_date, account_id, folder_name, mid
+            )
+
+        idle = self._get_idle()
+        start = time.time()
+        worker = idle.get()
+        statsd_client.timing("mime_parse.pool.wait", (time.time() - start) * 1000)
+        try:
+            result = worker.parse(
+                (body_string, received_date, account_id, folder_name, mid),
+                self.timeout,
+            )
+        except MimeParseTimeout:
+            worker = self._replace(worker)
+            statsd_client.incr("mime_parse.pool.timeouts")
+            raise
+        except (EOFError, OSError):
+            # The worker died, e.g. it ran out of memory.
+            worker = self._replace(worker)
+            raise MimeParseError("MIME parse worker exited")
+        finally:
+            idle.put(worker)
+        statsd_client.timing("mime_parse.pool.latency", (time.time() - start) * 1000)
+        return result
+
+    def _replace(self, worker):
+        worker.close()
+        statsd_client.incr("mime_parse.pool.worker_restarts")
+        return _Worker(multiprocessing.get_context("spawn"))
+
+
+_parse_service = None
+
+
+def get_parse_service():
+    """Return the per-process parse service configured by MIME_PARSE_BACKEND."""
+    global _parse_service
+    if _parse_service is None:
+        if MIME_PARSE_BACKEND == "process":
+            _parse_service = ProcessPoolParseService(
+                MIME_PARSE_POOL_SIZE, MIME_PARSE_OFFLOAD_MIN_SIZE, MIME_PARSE_TIMEOUT
+            )
+        else:
+            _parse_service = InlineParseService()
+    return _parse_service
@@ -40,11 +40,16 @@ def get_shard_schemas():
 def generate_open_shard_key():
     """
     Return the key that can be passed into session_scope() for an open shard,
-    picked at random.
+    picked at random. New accounts are created on the shard of this key; all
+    of their objects then get ids in the range of that shard.
 
     """
-    open_shards = get_open_shards()
-    # TODO[k]: Always pick min()instead?
+    # Only consider the shards this process has an engine for.
+    open_shards = [
+        shard_id for shard_id in get_open_shards() if shard_id in engine_manager.engines
+    ]
+    if not open_shards:
+        raise ValueError("No open shards to place new accounts on")
     shard_id = random.choice(open_shards)
     key = shard_id << 48
     return key
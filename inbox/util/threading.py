@@ -2,17 +2,33 @@
 from future import standard_library
 
 standard_library.install_aliases()
+import hashlib
+from collections import defaultdict
 from operator import attrgetter
 
-from sqlalchemy import desc
+from sqlalchemy import desc, func
+from sqlalchemy.dialects.mysql import insert
 from sqlalchemy.orm import contains_eager, load_only
 
+from inbox.config import config
 from inbox.models.message import Message
 from inbox.models.thread import Thread
+from inbox.models.threading_key import ThreadingKey
+from inbox.util.itert import chunk
 from inbox.util.misc import cleanup_subject
 
 MAX_THREAD_LENGTH = 500
 MAX_MESSAGES_SCANNED = 20000
+# Thread.message_count can drift (see thread_message_count), so threads whose
+# stored count is at least this close to MAX_THREAD_LENGTH are counted again
+# before deciding whether they're full.
+MESSAGE_COUNT_RECOUNT_MARGIN = 50
+
+# Thread IMAP messages by looking up their threading keys rather than by
+# scanning the threads with the same subject. Enable only after running
+# bin/backfill-threading-index.py.
+THREADING_INDEX_ENABLED = config.get("THREADING_INDEX_ENABLED", False)
+BACKFILL_CHUNK_SIZE = 1000
 
 
 def fetch_corresponding_thread(db_session, namespace_id, message):
@@ -96,3 +112,172 @@ def fetch_corresponding_thread(db_session, namespace_id, message):
                     return match.thread
 
     return None
+
+
+# Threading keys. A message is threaded with the most recent thread that any
+# of its Message-Id keys maps to or, failing that, that its participants key
+# maps to.
+
+
+def message_id_keys(message):
+    """
+    The keys of the Message-Ids a message is linked to: its own and those in
+    its References and In-Reply-To headers (see parse_references). Indexing
+    all of them lets a reply be threaded with a message that references the
+    same parent even if the parent itself hasn't been synced.
+    """
+    message_ids = []
+    if message.message_id_header:
+        message_ids.append(message.message_id_header)
+    message_ids.extend(ref for ref in message.references or [] if ref)
+    return ["message-id:" + message_id.strip() for message_id in message_ids]
+
+
+def participants_key(message):
+    """
+    The key of a message's cleaned-up subject and the set of its participants
+    other than Bcc recipients, or None if it has no sender or recipients (see
+    fetch_corresponding_thread).
+    """
+    if not message.from_addr or not message.to_addr:
+        return None
+    addrs = message.from_addr + message.to_addr + (message.cc_addr or [])
+    emails = sorted({email.lower() for _, email in addrs})
+    return "\0".join(["participants:", cleanup_subject(message.subject)] + emails)
+
+
+def _hash(key):
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def fetch_indexed_thread(db_session, namespace_id, message):
+    """
+    Return the thread a message should be added to according to the
+    threading index, or None.
+    """
+    message_id_hashes = {_hash(key) for key in message_id_keys(message)}
+    key = participants_key(message)
+    participants_hash = _hash(key) if key is not None else None
+    hashes = message_id_hashes | {participants_hash} - {None}
+    if not hashes:
+        return None
+
+    matches = (
+        db_session.query(ThreadingKey.key_hash, Thread)
+        .join(Thread, Thread.id == ThreadingKey.thread_id)
+        .filter(
+            ThreadingKey.namespace_id == namespace_id,
+            ThreadingKey.key_hash.in_(hashes),
+            Thread.deleted_at.is_(None),
+        )
+        .order_by(desc(Thread.id))
+        .all()
+    )
+    for key_hash, thread in matches:
+        if key_hash in message_id_hashes:
+            return thread
+    return matches[0][1] if matches else None
+
+
+def index_message(db_session, namespace_id, message, thread_id):
+    """
+    Point the threading keys of a message at the given thread. Keys that
+    already point at another thread are repointed, so that e.g. replies to a
+    full thread go to the thread that continues it.
+    """
+    keys = message_id_keys(message)
+    key = participants_key(message)
+    if key is not None:
+        keys.append(key)
+    _upsert_keys(db_session, namespace_id, {_hash(key): thread_id for key in keys})
+
+
+def _upsert_keys(db_session, namespace_id, thread_ids_by_hash):
+    if not thread_ids_by_hash:
+        return
+    table = ThreadingKey.__table__
+    stmt = insert(table).values(
+        [
+            {"namespace_id": namespace_id, "key_hash": key_hash, "thread_id": thread_id}
+            for key_hash, thread_id in thread_ids_by_hash.items()
+        ]
+    )
+    stmt = stmt.on_duplicate_key_update(thread_id=stmt.inserted.thread_id)
+    db_session.execute(stmt)
+
+
+def thread_message_count(db_session, thread, recount_from=None):
+    """
+    Return the number of messages in a thread, counting them if the thread's
+    message_count isn't known, or if it's at least `recount_from`.
+
+    message_count is only maintained by the sync as it adds messages to
+    threads: it isn't decremented when messages are deleted, nor incremented
+    when drafts are added to threads, so it's only an estimate unless it was
+    just counted.
+    """
+    if thread.message_count is None or (
+        recount_from is not None and thread.message_count >= recount_from
+    ):
+        (thread.message_count,) = (
+            db_session.query(func.count(Message.id))
+            .filter(Message.thread_id == thread.id)
+            .one()
+        )
+    return thread.message_count
+
+
+def backfill_threading_index(db_session, namespace_id):
+    """
+    Index the threading keys of all the messages of a namespace and count the
+    messages of its threads. Returns the number of messages indexed.
+
+    Messages are indexed in id order, so a key that's shared by several
+    threads ends up pointing at the thread of the newest message.
+    """
+    indexed = 0
+    message_counts = defaultdict(int)
+    last_id = 0
+    while True:
+        messages = (
+            db_session.query(Message)
+            .filter(Message.namespace_id == namespace_id, Message.id > last_id)
+            .options(
+                load_only(
+                    "id",
+                    "thread_id",
+                    "subject",
+                    "message_id_header",
+                    "references",
+                    "from_addr",
+                    "to_addr",
+                    "cc_addr",
+                    "bcc_addr",
+                )
+            )
+            .order_by(Message.id)
+            .limit(BACKFILL_CHUNK_SIZE)
+            .all()
+        )
+        if not messages:
+            break
+        last_id = messages[-1].id
+        thread_ids_by_hash = {}
+        for message in messages:
+            message_counts[message.thread_id] += 1
+            keys = message_id_keys(message)
+            key = participants_key(message)
+            if key is not None:
+                keys.append(key)
+            for key in keys:
+                thread_ids_by_hash[_hash(key)] = message.thread_id
+        _upsert_keys(db_session, namespace_id, thread_ids_by_hash)
+        db_session.commit()
+        indexed += len(messages)
+        db_session.expunge_all()
+
+    for thread_ids in chunk(sorted(message_counts), BACKFILL_CHUNK_SIZE):
+        for thread in db_session.query(Thread).filter(Thread.id.in_(thread_ids)):
+            thread.message_count = message_counts[thread.id]
+        db_session.commit()
+    return indexed
@@ -0,0 +1,44 @@
+"""add threadcounter
+
+Revision ID: 8d3a6f1c52b4
+Revises: 52783469ee6c
+Create Date: 2026-10-18 10:12:41.318504
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "8d3a6f1c52b4"
+down_revision = "52783469ee6c"
+
+import sqlalchemy as sa
+from alembic import op
+
+
+def upgrade():
+    op.create_table(
+        "threadcounter",
+        sa.Column(
+            "created_at",
+            sa.DateTime(),
+            nullable=False,
+            server_default=sa.text(u"now()"),
+        ),
+        sa.Column("id", sa.BigInteger(), nullable=False, autoincrement=True),
+        sa.Column("namespace_id", sa.BigInteger(), nullable=False),
+        sa.Column("category_id", sa.BigInteger(), nullable=False),
+        sa.Column("threads", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("unread_threads", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("starred_threads", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("messages", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("unread_messages", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("starred_messages", sa.Integer(), nullable=False, server_default="0"),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("namespace_id", "category_id"),
+    )
+    op.create_index(
+        "ix_threadcounter_created_at", "threadcounter", ["created_at"], unique=False,
+    )
+
+
+def downgrade():
+    op.drop_table("threadcounter")
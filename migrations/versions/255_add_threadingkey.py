@@ -0,0 +1,41 @@
+"""add threadingkey and thread.message_count
+
+Revision ID: 3c1e5b7a9f20
+Revises: 8d3a6f1c52b4
+Create Date: 2026-10-18 14:02:17.904112
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "3c1e5b7a9f20"
+down_revision = "8d3a6f1c52b4"
+
+import sqlalchemy as sa
+from alembic import op
+
+
+def upgrade():
+    op.create_table(
+        "threadingkey",
+        sa.Column(
+            "created_at",
+            sa.DateTime(),
+            nullable=False,
+            server_default=sa.text(u"now()"),
+        ),
+        sa.Column("id", sa.BigInteger(), nullable=False, autoincrement=True),
+        sa.Column("namespace_id", sa.BigInteger(), nullable=False),
+        sa.Column("key_hash", sa.String(length=40), nullable=False),
+        sa.Column("thread_id", sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("namespace_id", "key_hash"),
+    )
+    op.create_index(
+        "ix_threadingkey_created_at", "threadingkey", ["created_at"], unique=False,
+    )
+    op.add_column("thread", sa.Column("message_count", sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("thread", "message_count")
+    op.drop_table("threadingkey")
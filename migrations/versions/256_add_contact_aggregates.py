@@ -0,0 +1,31 @@
+"""add contact aggregates to dataprocessingcache
+
+Revision ID: 5e2a9c4d7b13
+Revises: 3c1e5b7a9f20
+Create Date: 2026-10-18 16:41:05.218334
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "5e2a9c4d7b13"
+down_revision = "3c1e5b7a9f20"
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import mysql
+
+
+def upgrade():
+    op.add_column(
+        "dataprocessingcache",
+        sa.Column("contact_aggregates", mysql.MEDIUMBLOB(), nullable=True),
+    )
+    op.add_column(
+        "dataprocessingcache",
+        sa.Column("contact_aggregates_rebuilt_at", sa.DateTime(), nullable=True),
+    )
+
+
+def downgrade():
+    op.drop_column("dataprocessingcache", "contact_aggregates_rebuilt_at")
+    op.drop_column("dataprocessingcache", "contact_aggregates")
@@ -1,6 +1,12 @@
 import json
 from base64 import b64encode
 
+import mock
+import pytest
+
+from inbox.util import auth_cache as auth_cache_module
+from inbox.util.auth_cache import REDIS_KEY_PREFIX, NamespaceAuth, NamespaceAuthCache
+
 from tests.api.base import new_api_client  # noqa
 from tests.util.base import db, generic_account  # noqa
 
@@ -59,3 +65,79 @@ def test_invalid_bearer_token_auth(db, generic_account):  # noqa
 
     response = api_client.get_raw("/account")
     assert response.status_code == 401
+
+
+@pytest.fixture
+def auth_cache(monkeypatch, redis_client):
+    cache = NamespaceAuthCache(redis=redis_client)
+    monkeypatch.setattr("inbox.util.auth_cache.AUTH_CACHE_ENABLED", True)
+    monkeypatch.setattr("inbox.util.auth_cache._cache", cache)
+    return cache
+
+
+def test_cached_auth(db, generic_account, auth_cache, redis_client):  # noqa
+    api_client = new_api_client(db, generic_account.namespace)
+    public_id = generic_account.namespace.public_id
+
+    with mock.patch(
+        "inbox.util.auth_cache._load", wraps=auth_cache_module._load
+    ) as load:
+        assert api_client.get_raw("/account").status_code == 200
+        assert api_client.get_raw("/account").status_code == 200
+        assert load.call_count == 1
+
+        # Other processes get the entry from Redis.
+        other_cache = NamespaceAuthCache(redis=redis_client)
+        assert other_cache.get(public_id) == (
+            generic_account.namespace.id,
+            generic_account.id,
+            False,
+        )
+        assert load.call_count == 1
+
+        # Unknown public ids are cached as deleted.
+        api_client.auth_header = {"Authorization": "Bearer {}".format(BAD_TOKEN)}
+        assert api_client.get_raw("/account").status_code == 401
+        assert api_client.get_raw("/account").status_code == 401
+        assert load.call_count == 2
+
+    generic_account.mark_for_deletion()
+    assert auth_cache._get_local(public_id) is None
+    assert redis_client.get(REDIS_KEY_PREFIX + public_id) is None
+
+
+def test_auth_for_account_marked_for_deletion(
+    db, generic_account, auth_cache, redis_client
+):  # noqa
+    api_client = new_api_client(db, generic_account.namespace)
+    assert api_client.get_raw("/account").status_code == 200
+
+    generic_account.mark_for_deletion()
+    assert api_client.get_raw("/account").status_code == 401
+    # Other processes get the deleted entry from Redis.
+    other_cache = NamespaceAuthCache(redis=redis_client)
+    assert other_cache.get(generic_account.namespace.public_id).deleted
+
+    generic_account.unmark_for_deletion()
+    assert api_client.get_raw("/account").status_code == 200
+
+
+def test_auth_cache_expiry():
+    cache = NamespaceAuthCache(ttl=10, size=2)
+    load = mock.Mock(side_effect=lambda public_id: NamespaceAuth(1, 2, False))
+
+    with mock.patch("time.time", return_value=100):
+        cache.get("a", load)
+        cache.get("a", load)
+        assert load.call_count == 1
+
+    with mock.patch("time.time", return_value=111):
+        cache.get("a", load)
+        assert load.call_count == 2
+
+        # The least recently used entry is evicted.
+        cache.get("b", load)
+        cache.get("a", load)
+        cache.get("c", load)
+        assert load.call_count == 4
+        assert list(cache._entries) == ["a", "c"]
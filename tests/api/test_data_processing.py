@@ -1,13 +1,23 @@
+import datetime
 import json
+from collections import namedtuple
 
+import mock
 from sqlalchemy.orm.exc import NoResultFound
 
+from inbox.contacts.algorithms import calculate_contact_scores, calculate_group_scores
+from inbox.contacts.rankings import ContactAggregates
 from inbox.models import DataProcessingCache
 
 from tests.util.base import add_fake_message, add_fake_thread, default_namespace
 
 __all__ = ["default_namespace"]
 
+# A row of inbox.api.filtering.messages_for_contact_scores.
+SentMessage = namedtuple(
+    "SentMessage", ["to_addr", "cc_addr", "bcc_addr", "id", "date"]
+)
+
 
 def test_contact_rankings(db, api_client, default_namespace):
     # Clear cached data (if it exists)
@@ -164,3 +174,92 @@ def test_contact_groups(db, api_client, default_namespace):
         .one()
     )
     assert cached_data.contact_groups_last_updated is not None
+
+
+def _sent_message(id_, date, to_addr, cc_addr=()):
+    return SentMessage(list(to_addr), list(cc_addr), [], id_, date)
+
+
+def test_contact_aggregates_match_algorithms():
+    now = datetime.datetime(2020, 1, 1)
+    recipients = (
+        [[("A", "A@nylas.com"), ("b", "b@nylas.com"), ("c", "c@nylas.com")]] * 8
+        + [[("b", "b@nylas.com"), ("c", "c@nylas.com"), ("d", "d@nylas.com")]] * 8
+        + [[("d", "d@nylas.com"), ("e", "e@nylas.com"), ("me", "me@nylas.com")]] * 8
+        + [[("k", "k@nylas.com"), ("l", "l@nylas.com")]] * 3
+        + [[("m", "m@nylas.com")]] * 4
+    )
+    messages = [
+        _sent_message(i + 1, now - datetime.timedelta(days=10 * i), to_addr)
+        for i, to_addr in enumerate(recipients)
+    ]
+
+    # Messages are added in batches, as they're synced.
+    aggregates = ContactAggregates()
+    assert aggregates.add_messages(messages[:10]) == 10
+    assert aggregates.add_messages(messages[10:]) == len(messages) - 10
+    assert aggregates.add_messages([]) == 0
+    assert aggregates.last_message_id == len(messages)
+    aggregates = ContactAggregates.from_bytes(aggregates.to_bytes())
+
+    with mock.patch("inbox.contacts.algorithms.datetime") as mock_datetime:
+        mock_datetime.datetime.now.return_value = now
+        contact_scores = calculate_contact_scores(messages)
+        group_scores = calculate_group_scores(messages, "me@nylas.com")
+
+    scores = aggregates.contact_scores(now=now)
+    assert scores.keys() == contact_scores.keys()
+    for email, score in contact_scores.items():
+        assert abs(scores[email] - score) < 1e-9
+
+    scores = aggregates.group_scores("me@nylas.com", now=now)
+    assert scores.keys() == group_scores.keys()
+    for group, score in group_scores.items():
+        assert abs(scores[group] - score) < 1e-9
+
+
+def test_contact_rankings_engine(db, api_client, default_namespace):
+    namespace_id = default_namespace.id
+    me = ("me", default_namespace.email_address)
+
+    def send(to_addr):
+        fake_thread = add_fake_thread(db.session, namespace_id)
+        add_fake_message(
+            db.session,
+            namespace_id,
+            fake_thread,
+            subject="Froop",
+            from_addr=[me],
+            to_addr=to_addr,
+            add_sent_category=True,
+        )
+
+    for _ in range(3):
+        send([("first", "number1@nylas.com")])
+
+    with mock.patch("inbox.api.ns_api.CONTACT_RANKINGS_ENGINE_ENABLED", True):
+        resp = api_client.get_raw("/contacts/rankings?force_recalculate=true")
+        assert resp.status_code == 200
+        assert [e for (e, _) in json.loads(resp.data)] == ["number1@nylas.com"]
+
+        cached_data = (
+            db.session.query(DataProcessingCache)
+            .filter(DataProcessingCache.namespace_id == namespace_id)
+            .one()
+        )
+        rebuilt_at = cached_data.contact_aggregates_rebuilt_at
+        assert rebuilt_at is not None
+
+        # Messages sent since are added to the aggregates.
+        for _ in range(4):
+            send([("second", "number2@nylas.com")])
+        resp = api_client.get_raw("/contacts/rankings")
+        assert resp.status_code == 200
+        assert [e for (e, _) in json.loads(resp.data)] == [
+            "number2@nylas.com",
+            "number1@nylas.com",
+        ]
+
+        db.session.refresh(cached_data)
+        assert cached_data.contact_aggregates_rebuilt_at == rebuilt_at
+        assert len(cached_data.contact_aggregates.message_ids) == 7
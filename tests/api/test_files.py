@@ -9,6 +9,7 @@ import mock
 import pytest
 
 from inbox.models import Block, Part
+from inbox.util.blockstore import _MemoryBlockstoreReader
 from inbox.util.testutils import FILENAMES
 
 
@@ -159,6 +160,51 @@ def test_download(api_client, uploaded_file_ids, filename):
     assert local_md5 == dl_md5
 
 
+@pytest.mark.usefixtures("blockstore_backend")
+@pytest.mark.parametrize("blockstore_backend", ["disk", "s3"], indirect=True)
+def test_ranged_and_conditional_download(api_client, uploaded_file_ids):
+    in_file = api_client.get_data("/files?filename=LetMeSendYouEmail.wav")[0]
+    path = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "data",
+        "LetMeSendYouEmail.wav",
+    )
+    with open(path, "rb") as fp:
+        local_data = fp.read()
+    url = "/files/{}/download".format(in_file["id"])
+
+    r = api_client.get_raw(url)
+    assert r.status_code == 200
+    assert r.headers["Accept-Ranges"] == "bytes"
+    assert r.data == local_data
+    etag = r.headers["ETag"]
+
+    r = api_client.get_raw(url, headers={"If-None-Match": etag})
+    assert r.status_code == 304
+    assert r.data == b""
+
+    r = api_client.get_raw(url, headers={"Range": "bytes=10-19"})
+    assert r.status_code == 206
+    assert r.headers["Content-Range"] == "bytes 10-19/{}".format(len(local_data))
+    assert r.data == local_data[10:20]
+
+    r = api_client.get_raw(url, headers={"Range": "bytes=-5"})
+    assert r.status_code == 206
+    assert r.data == local_data[-5:]
+
+    # A stale If-Range means the whole file is sent.
+    r = api_client.get_raw(url, headers={"Range": "bytes=0-9", "If-Range": '"abc"'})
+    assert r.status_code == 200
+    assert r.data == local_data
+
+    r = api_client.get_raw(
+        url, headers={"Range": "bytes={}-".format(len(local_data) + 10)}
+    )
+    assert r.status_code == 416
+    assert r.headers["Content-Range"] == "bytes */{}".format(len(local_data))
+
+
 @pytest.fixture(scope="function")
 def fake_attachment(db, default_account, message):
     block = Block()
@@ -177,11 +223,46 @@ def fake_attachment(db, default_account, message):
     return p
 
 
+def test_corrupted_blob_is_fetched_again(
+    api_client, db, message, fake_attachment, monkeypatch
+):
+    # Small blobs that don't match their hash aren't sent.
+    reader = _MemoryBlockstoreReader(
+        fake_attachment.block.data_sha256, b"Chuis pas rassure"
+    )
+    monkeypatch.setattr(
+        "inbox.util.blockstore.open_blockstore_stream", mock.Mock(return_value=reader)
+    )
+    monkeypatch.setattr(
+        "inbox.util.blockstore.get_from_blockstore", mock.Mock(return_value=None)
+    )
+    monkeypatch.setattr("inbox.util.blockstore.save_to_blockstore", mock.Mock())
+    path = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "data",
+        "raw_message_with_filename_attachment.txt",
+    )
+    with open(path, "rb") as fd:
+        data = fd.read()
+    monkeypatch.setattr(
+        "inbox.s3.backends.gmail.get_gmail_raw_contents", mock.Mock(return_value=data)
+    )
+
+    resp = api_client.get_raw(
+        "/files/{}/download".format(fake_attachment.block.public_id)
+    )
+    assert resp.data.decode("utf8") == u"Chuis pas rassur\xe9"
+
+
 def test_direct_fetching(api_client, db, message, fake_attachment, monkeypatch):
     # Mark a file as missing and check that we try to
     # fetch it from the remote provider.
     get_mock = mock.Mock(return_value=None)
     monkeypatch.setattr("inbox.util.blockstore.get_from_blockstore", get_mock)
+    monkeypatch.setattr(
+        "inbox.util.blockstore.open_blockstore_stream", mock.Mock(return_value=None)
+    )
 
     save_mock = mock.Mock()
     monkeypatch.setattr("inbox.util.blockstore.save_to_blockstore", save_mock)
@@ -12,7 +12,12 @@ from sqlalchemy import desc
 from inbox.models import Block, Category, Message, Namespace, Thread
 from inbox.util.misc import dt_to_timestamp
 
-from tests.util.base import add_fake_message, add_fake_thread, test_client
+from tests.util.base import (
+    add_fake_event,
+    add_fake_message,
+    add_fake_thread,
+    test_client,
+)
 
 __all__ = ["test_client"]
 
@@ -405,3 +410,67 @@ def test_namespace_limiting(db, api_client, default_namespaces):
 
         r = api_client.get_data("/files?filename={}".format(subject))
         assert len(r) == 1
+
+
+def test_page_token_pagination(db, api_client, default_namespace):
+    received_date = datetime.datetime(2020, 1, 1)
+    for i in range(5):
+        thread = add_fake_thread(db.session, default_namespace.id)
+        # Messages with the same date are ordered by id.
+        add_fake_message(
+            db.session,
+            default_namespace.id,
+            thread,
+            received_date=received_date - datetime.timedelta(hours=i // 2),
+        )
+        thread.recentdate = received_date - datetime.timedelta(hours=i // 2)
+    db.session.commit()
+
+    for endpoint in ["/messages?view=ids", "/threads?view=ids", "/messages"]:
+        everything = api_client.get_data("{}&limit=100".format(endpoint))
+
+        paged = []
+        url = "{}&limit=2".format(endpoint)
+        while True:
+            r = api_client.get_raw(url)
+            assert r.status_code == 200
+            paged.extend(json.loads(r.data))
+            token = r.headers.get("X-Next-Page-Token")
+            if token is None:
+                break
+            url = "{}&limit=2&page_token={}".format(endpoint, token)
+
+        assert paged == everything
+
+    r = api_client.get_raw("/threads?page_token=garbage")
+    assert r.status_code == 400
+
+
+def test_event_page_token_pagination(db, api_client, default_namespace):
+    start = datetime.datetime(2020, 1, 1)
+    for i in range(5):
+        # Events that start at the same time are ordered by id.
+        add_fake_event(
+            db.session,
+            default_namespace.id,
+            start=start + datetime.timedelta(hours=i // 2),
+            end=start + datetime.timedelta(hours=3),
+        )
+    db.session.commit()
+
+    for endpoint in ["/events?view=ids", "/events?view=expanded"]:
+        everything = api_client.get_data("{}&limit=100".format(endpoint))
+        assert len(everything) >= 5
+
+        paged = []
+        url = "{}&limit=2".format(endpoint)
+        while True:
+            r = api_client.get_raw(url)
+            assert r.status_code == 200
+            paged.extend(json.loads(r.data))
+            token = r.headers.get("X-Next-Page-Token")
+            if token is None:
+                break
+            url = "{}&limit=2&page_token={}".format(endpoint, token)
+
+        assert paged == everything
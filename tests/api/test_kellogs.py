@@ -0,0 +1,72 @@
+import datetime
+import json
+from collections import namedtuple
+
+import pytest
+
+from inbox.api.kellogs import APIEncoder, _serializer_for, encode
+from inbox.models import Event, Thread
+from inbox.models.event import RecurringEvent
+from inbox.models.when import Time, TimeSpan
+
+
+def test_serializer_dispatch():
+    # Serializers are compiled once per type and options.
+    assert _serializer_for(Thread) is _serializer_for(Thread)
+    assert _serializer_for(Thread) is not _serializer_for(Thread, expand=True)
+    assert _serializer_for(Thread, is_n1=True) is _serializer_for(Thread)
+    # Subclasses are compiled from the serializer of their closest registered
+    # base.
+    assert _serializer_for(RecurringEvent) is not _serializer_for(Event)
+    assert _serializer_for(datetime.datetime) is not _serializer_for(datetime.date)
+    assert _serializer_for(object) is None
+
+    start = datetime.datetime(2020, 1, 1)
+    end = datetime.datetime(2020, 1, 2)
+    assert encode(Time(start)) == {"time": 1577836800, "object": "time"}
+    assert encode(TimeSpan(start, end)) == {
+        "start_time": 1577836800,
+        "end_time": 1577923200,
+        "object": "timespan",
+    }
+
+    assert encode(datetime.datetime(2020, 1, 1)) == 1577836800
+    assert encode(datetime.date(2020, 1, 1)) == "2020-01-01"
+    assert encode(object()) is None
+
+
+def test_cereal(db, default_namespace, thread, message):
+    encoder = APIEncoder(default_namespace.public_id)
+    resp = json.loads(encoder.cereal([thread, message]))
+    assert resp[0]["object"] == "thread"
+    assert resp[0]["id"] == thread.public_id
+    assert resp[0]["message_ids"] == [message.public_id]
+    assert resp[1]["object"] == "message"
+    assert resp[1]["thread_id"] == thread.public_id
+
+    expanded = json.loads(
+        APIEncoder(default_namespace.public_id, expand=True).cereal(thread)
+    )
+    assert [m["id"] for m in expanded["messages"]] == [message.public_id]
+
+    # Encoders don't share their options.
+    assert json.loads(encoder.cereal(thread)) == resp[0]
+
+    with pytest.raises(TypeError):
+        encoder.cereal(object())
+
+
+def test_json_backends_agree_on_tuples(monkeypatch):
+    pytest.importorskip("orjson")
+    Point = namedtuple("Point", ["x", "y"])
+    payload = {
+        "point": Point(1, datetime.datetime(2020, 1, 1)),
+        "points": [Point("a", (1, 2))],
+    }
+
+    encoder = APIEncoder()
+    monkeypatch.setattr("inbox.api.kellogs.API_JSON_BACKEND", "json")
+    expected = json.loads(encoder.cereal(payload))
+    monkeypatch.setattr("inbox.api.kellogs.API_JSON_BACKEND", "orjson")
+    assert json.loads(encoder.cereal(payload)) == expected
+    assert expected == {"point": [1, 1577836800], "points": [["a", [1, 2]]]}
@@ -100,6 +100,13 @@ def test_rfc822_format(stub_message_from_raw, api_client, mime_message):
 
     resp = api_client.get_raw(full_path, headers={"Accept": "message/rfc822"})
     assert resp.data == get_from_blockstore(stub_message_from_raw.data_sha256)
+    assert resp.headers["ETag"] == '"{}"'.format(stub_message_from_raw.data_sha256)
+
+    resp = api_client.get_raw(
+        full_path, headers={"Accept": "message/rfc822", "Range": "bytes=0-99"}
+    )
+    assert resp.status_code == 206
+    assert resp.data == get_from_blockstore(stub_message_from_raw.data_sha256)[:100]
 
 
 @pytest.mark.usefixtures("blockstore_backend")
@@ -109,6 +116,9 @@ def test_direct_fetching(stub_message_from_raw, api_client, mime_message, monkey
     # fetch it from the remote provider.
     get_mock = mock.Mock(return_value=None)
     monkeypatch.setattr("inbox.util.blockstore.get_from_blockstore", get_mock)
+    monkeypatch.setattr(
+        "inbox.util.blockstore.open_blockstore_stream", mock.Mock(return_value=None)
+    )
 
     save_mock = mock.Mock()
     monkeypatch.setattr("inbox.util.blockstore.save_to_blockstore", save_mock)
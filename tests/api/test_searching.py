@@ -9,7 +9,7 @@ from pytest import fixture
 
 from inbox.models import Folder
 from inbox.search.backends.gmail import GmailSearchClient
-from inbox.search.backends.imap import IMAPSearchClient
+from inbox.search.backends.imap import FolderSearchCache, IMAPSearchClient
 from inbox.search.base import get_search_client
 
 from tests.util.base import (
@@ -516,3 +516,77 @@ def test_streaming_search_results(
     assert len(responses) == 3 and responses[2] == ""
     assert len(json.loads(responses[0])) == 3
     assert len(json.loads(responses[1])) == 2
+
+
+class FolderMockImapConnection(MockImapConnection):
+    def __init__(self, folders):
+        # folder name -> (UIDNEXT, uids the search matches)
+        self.folders = folders
+        self.searched = []
+        self.logouts = 0
+
+    def select_folder(self, name, **_):
+        self.selected = name
+        uidnext, uids = self.folders.get(name, (1, []))
+        return {b"UIDVALIDITY": 123, b"UIDNEXT": uidnext, b"EXISTS": len(uids)}
+
+    def logout(self):
+        self.logouts += 1
+
+    def search(self, criteria, charset=None):
+        self.searched.append(self.selected)
+        return self.folders[self.selected][1]
+
+
+@fixture
+def imap_search_fanout(monkeypatch):
+    monkeypatch.setattr("inbox.search.backends.imap.IMAP_SEARCH_FANOUT_ENABLED", True)
+    monkeypatch.setattr(
+        "inbox.search.backends.imap.folder_search_cache", FolderSearchCache()
+    )
+
+
+def test_imap_fanout_search(
+    db,
+    imap_api_client,
+    generic_account,
+    imap_folder,
+    different_imap_folder,
+    monkeypatch,
+    imap_search_fanout,
+    sorted_imap_messages,
+    different_imap_messages,
+):
+    conn = FolderMockImapConnection(
+        {
+            imap_folder.name: (2003, [2000, 2001, 2002]),
+            different_imap_folder.name: (5003, [5000, 5001, 5002]),
+        }
+    )
+    monkeypatch.setattr(
+        "inbox.auth.base.AuthHandler.get_authenticated_imap_connection",
+        lambda *_, **__: conn,
+    )
+
+    def streaming_search():
+        raw_data = imap_api_client.get_raw(
+            "/messages/search/streaming?q=fantastic"
+        ).get_data(as_text=True)
+        return [json.loads(r) for r in raw_data.split("\n") if r]
+
+    responses = streaming_search()
+    assert sorted(len(r) for r in responses) == [3, 3]
+    assert sorted(conn.searched) == sorted(
+        [imap_folder.name, different_imap_folder.name]
+    )
+    # The search's connections are closed when it's done.
+    assert conn.logouts >= 1
+    messages = imap_api_client.get_data("/messages/search?q=fantastic")
+    assert len(messages) == 6
+
+    # Folders that haven't changed since aren't searched again.
+    conn.searched = []
+    conn.folders[different_imap_folder.name] = (5004, [5000, 5001])
+    responses = streaming_search()
+    assert sorted(len(r) for r in responses) == [2, 3]
+    assert conn.searched == [different_imap_folder.name]
@@ -147,6 +147,26 @@ def test_longpoll_delta_newitem(db, api_client, default_namespace, thread):
     )
 
 
+def test_longpoll_delta_newitem_with_notifications(
+    db, api_client, default_namespace, thread, monkeypatch
+):
+    monkeypatch.setattr("inbox.api.ns_api.DELTA_NOTIFICATIONS_ENABLED", True)
+    cursor = get_cursor(api_client, int(time.time() + 22), default_namespace)
+    url = url_concat("/delta/longpoll", {"cursor": cursor})
+    start_time = time.time()
+    longpoll_greenlet = Greenlet.spawn(api_client.get_raw, url)
+    # Committing the message bumps the namespace's latest transaction id in
+    # redis, which should wake the request up.
+    add_fake_message(
+        db.session, default_namespace.id, thread, from_addr=[("Bob", "bob@foocorp.com")]
+    )
+    longpoll_greenlet.join()
+    end_time = time.time()
+    assert end_time - start_time < LONGPOLL_EPSILON
+    parsed_responses = json.loads(longpoll_greenlet.value.data)
+    assert len(parsed_responses["deltas"]) == 3
+
+
 def test_longpoll_delta_timeout(db, api_client, default_namespace):
     test_timeout = 2
     cursor = get_cursor(api_client, int(time.time() + 22), default_namespace)
@@ -0,0 +1,61 @@
+import gevent
+import pytest
+
+from inbox.models.backends.oauth import TokenManager
+
+
+class FakeAccount(object):
+    id = 1
+
+    def __init__(self):
+        self.refreshes = 0
+
+    def new_token(self, force_refresh=False):
+        self.refreshes += 1
+        # Let other greenlets run while the token endpoint is being called.
+        gevent.sleep(0.01)
+        return "token-{}".format(self.refreshes), 3600
+
+
+@pytest.fixture
+def shared_cache(monkeypatch):
+    monkeypatch.setattr("inbox.models.backends.oauth.OAUTH_TOKEN_CACHE_ENABLED", True)
+
+
+def test_concurrent_refreshes_are_coalesced(config):
+    account = FakeAccount()
+    manager = TokenManager()
+    greenlets = [gevent.spawn(manager.get_token, account) for _ in range(5)]
+    gevent.joinall(greenlets, raise_error=True)
+    assert [g.value for g in greenlets] == ["token-1"] * 5
+    assert account.refreshes == 1
+
+    assert manager.get_token(account, force_refresh=True) == "token-2"
+    assert manager.get_token(account) == "token-2"
+
+
+def test_token_shared_between_processes(config, redis_client, shared_cache):
+    account = FakeAccount()
+    first = TokenManager(redis=redis_client)
+    second = TokenManager(redis=redis_client)
+
+    assert first.get_token(account) == "token-1"
+    # The token is encrypted at rest.
+    assert b"token-1" not in redis_client.get("oauth-token:1")
+    assert second.get_token(account) == "token-1"
+    assert account.refreshes == 1
+
+
+def test_waits_for_refresh_by_other_process(config, redis_client, shared_cache):
+    account = FakeAccount()
+    first = TokenManager(redis=redis_client)
+    second = TokenManager(redis=redis_client)
+
+    # Pretend that the first process started refreshing the token.
+    redis_client.set("oauth-token-refresh-lock:1", "other")
+    waiter = gevent.spawn(second.get_token, account)
+    gevent.sleep(0.2)
+    assert not waiter.ready()
+    first.cache_token(account, "token-from-other", 3600)
+    assert waiter.get(timeout=1) == "token-from-other"
+    assert account.refreshes == 0
@@ -1,6 +1,7 @@
 """Sanity-check our logic for updating contact data from message addressees
 during a sync."""
-from inbox.models import Contact
+from inbox.contacts.processing import ContactCache, ContactResolver
+from inbox.models import Contact, MessageContactAssociation
 
 from tests.util.base import add_fake_message
 
@@ -113,3 +114,64 @@ def test_handle_noreply_addresses(db, default_namespace, thread):
         .first()
     )
     assert contact.name is not None
+
+
+def test_contact_resolver(db, default_namespace, thread):
+    existing = add_fake_message(
+        db.session, default_namespace.id, thread, from_addr=[("", "alpha@example.com")]
+    )
+    alpha = existing.contacts[0].contact
+
+    messages = []
+    for to_addr in (
+        [("Beta", "beta@example.com"), ("", "alpha@example.com")],
+        [("Beta B.", "beta@example.com"), ("", "not an address")],
+    ):
+        m = add_fake_message(db.session, default_namespace.id, None, to_addr=to_addr)
+        thread.messages.append(m)
+        messages.append(m)
+    db.session.flush()
+
+    cache = ContactCache(10)
+    resolver = ContactResolver(default_namespace.id, cache)
+    for m in messages:
+        resolver.add(m)
+    resolver.resolve(db.session)
+    db.session.commit()
+
+    beta = (
+        db.session.query(Contact)
+        .filter_by(email_address="beta@example.com", namespace_id=default_namespace.id)
+        .one()
+    )
+    assert beta.name == "Beta"
+    associations = {
+        (a.message_id, a.contact_id, a.field)
+        for a in db.session.query(MessageContactAssociation).filter(
+            MessageContactAssociation.message_id.in_([m.id for m in messages])
+        )
+    }
+    assert associations == {
+        (messages[0].id, beta.id, "to_addr"),
+        (messages[0].id, alpha.id, "to_addr"),
+        (messages[1].id, beta.id, "to_addr"),
+    }
+    assert cache.get(default_namespace.id, "alpha@example.com") == (alpha.id, "")
+    assert cache.get(default_namespace.id, "beta@example.com") == (beta.id, "Beta")
+
+
+def test_contact_resolver_caches_committed_contacts(db, default_namespace, thread):
+    m = add_fake_message(db.session, default_namespace.id, None)
+    m.to_addr = [("Gamma", "gamma@example.com")]
+    thread.messages.append(m)
+    db.session.flush()
+
+    cache = ContactCache(10)
+    resolver = ContactResolver(default_namespace.id, cache)
+    resolver.add(m)
+    resolver.resolve(db.session)
+    assert cache.get(default_namespace.id, "gamma@example.com") is None
+
+    # The contact is gone, so it mustn't be cached.
+    db.session.rollback()
+    assert cache.get(default_namespace.id, "gamma@example.com") is None
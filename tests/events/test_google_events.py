@@ -385,13 +385,35 @@ def test_pagination():
     second_response.status_code = 200
     second_response._content = json.dumps({"items": ["D", "E"]}).encode()
 
-    requests.get = mock.Mock(side_effect=[first_response, second_response])
     provider = GoogleEventsProvider(1, 1)
+    provider.http_session.get = mock.Mock(side_effect=[first_response, second_response])
     provider._get_access_token = mock.Mock(return_value="token")
     items = provider._get_resource_list("https://googleapis.com/testurl")
     assert items == ["A", "B", "C", "D", "E"]
 
 
+def test_page_stream():
+    first_response = requests.Response()
+    first_response.status_code = 200
+    first_response._content = json.dumps(
+        {"items": ["A", "B"], "nextPageToken": "CjkKKzlhb2tkZjNpZTMwNjhtZThllU"}
+    ).encode()
+    second_response = requests.Response()
+    second_response.status_code = 200
+    second_response._content = json.dumps({"items": ["C"]}).encode()
+
+    provider = GoogleEventsProvider(1, 1)
+    provider.http_session.get = mock.Mock(side_effect=[first_response, second_response])
+    provider._get_access_token = mock.Mock(return_value="token")
+    pages = provider._iter_resource_pages("https://googleapis.com/testurl")
+    assert next(pages) == ["A", "B"]
+    # The next page is only fetched once the first one has been consumed.
+    assert provider.http_session.get.call_count == 1
+    assert next(pages) == ["C"]
+    assert list(pages) == []
+    assert provider.http_session.get.call_count == 2
+
+
 def test_handle_http_401():
     first_response = requests.Response()
     first_response.status_code = 401
@@ -400,8 +422,8 @@ def test_handle_http_401():
     second_response.status_code = 200
     second_response._content = json.dumps({"items": ["A", "B", "C"]}).encode()
 
-    requests.get = mock.Mock(side_effect=[first_response, second_response])
     provider = GoogleEventsProvider(1, 1)
+    provider.http_session.get = mock.Mock(side_effect=[first_response, second_response])
     provider._get_access_token = mock.Mock(return_value="token")
     items = provider._get_resource_list("https://googleapis.com/testurl")
     assert items == ["A", "B", "C"]
@@ -433,8 +455,8 @@ def test_handle_quota_exceeded():
     second_response.status_code = 200
     second_response._content = json.dumps({"items": ["A", "B", "C"]}).encode()
 
-    requests.get = mock.Mock(side_effect=[first_response, second_response])
     provider = GoogleEventsProvider(1, 1)
+    provider.http_session.get = mock.Mock(side_effect=[first_response, second_response])
     provider._get_access_token = mock.Mock(return_value="token")
     items = provider._get_resource_list("https://googleapis.com/testurl")
     # Check that we slept, then retried.
@@ -451,8 +473,8 @@ def test_handle_internal_server_error():
     second_response.status_code = 200
     second_response._content = json.dumps({"items": ["A", "B", "C"]}).encode()
 
-    requests.get = mock.Mock(side_effect=[first_response, second_response])
     provider = GoogleEventsProvider(1, 1)
+    provider.http_session.get = mock.Mock(side_effect=[first_response, second_response])
     provider._get_access_token = mock.Mock(return_value="token")
     items = provider._get_resource_list("https://googleapis.com/testurl")
     # Check that we slept, then retried.
@@ -480,8 +502,8 @@ def test_handle_api_not_enabled():
         }
     ).encode()
 
-    requests.get = mock.Mock(return_value=response)
     provider = GoogleEventsProvider(1, 1)
+    provider.http_session.get = mock.Mock(return_value=response)
     provider._get_access_token = mock.Mock(return_value="token")
     with pytest.raises(AccessNotEnabledError):
         provider._get_resource_list("https://googleapis.com/testurl")
@@ -491,16 +513,16 @@ def test_handle_other_errors():
     response = requests.Response()
     response.status_code = 403
     response._content = b"This is not the JSON you're looking for"
-    requests.get = mock.Mock(return_value=response)
     provider = GoogleEventsProvider(1, 1)
+    provider.http_session.get = mock.Mock(return_value=response)
     provider._get_access_token = mock.Mock(return_value="token")
     with pytest.raises(requests.exceptions.HTTPError):
         provider._get_resource_list("https://googleapis.com/testurl")
 
     response = requests.Response()
     response.status_code = 404
-    requests.get = mock.Mock(return_value=response)
     provider = GoogleEventsProvider(1, 1)
+    provider.http_session.get = mock.Mock(return_value=response)
     provider._get_access_token = mock.Mock(return_value="token")
     with pytest.raises(requests.exceptions.HTTPError):
         provider._get_resource_list("https://googleapis.com/testurl")
@@ -2,17 +2,23 @@ import datetime
 from datetime import timedelta
 
 import arrow
+import mock
 import pytest
 from dateutil import tz
 from dateutil.rrule import rrulestr
 
+from inbox.events import recurring
 from inbox.events.recurring import (
+    count_occurrences,
     get_start_times,
+    iter_occurrences,
     link_events,
+    occurrence_cache,
     parse_exdate,
+    prefetch_overrides,
     rrule_to_json,
 )
-from inbox.events.remote_sync import handle_event_updates
+from inbox.events.remote_sync import handle_event_updates, handle_event_updates_batched
 from inbox.logging import get_logger
 from inbox.models.event import Event, RecurringEvent, RecurringEventOverride
 from inbox.models.when import Date, DateSpan, Time, TimeSpan
@@ -438,6 +444,73 @@ def test_override_same_start(db, default_account, calendar):
     assert override in all_events
 
 
+def test_iter_occurrences(db, default_account, calendar):
+    # Occurrences are the same as all_events', with the overrides prefetched.
+    event = recurring_event(db, default_account, calendar, TEST_EXDATE_RULE)
+    override = recurring_override(
+        db,
+        event,
+        arrow.get(2014, 9, 4, 20, 30, 0),
+        arrow.get(2014, 9, 4, 21, 30, 0),
+        arrow.get(2014, 9, 4, 22, 30, 0),
+    )
+    cancelled = recurring_override(
+        db,
+        event,
+        arrow.get(2014, 8, 14, 20, 30, 0),
+        arrow.get(2014, 8, 14, 20, 30, 0),
+        arrow.get(2014, 8, 14, 21, 30, 0),
+    )
+    cancelled.cancelled = True
+    db.session.commit()
+
+    overrides = prefetch_overrides(db.session, [event])
+    assert set(overrides[event.id]) == {override, cancelled}
+
+    occurrences = list(iter_occurrences(event, overrides[event.id]))
+    assert [e.start for e in occurrences] == [e.start for e in event.all_events()]
+    assert override in occurrences
+    assert count_occurrences(event, overrides[event.id]) == len(occurrences) == 6
+
+    # Expansion is lazy.
+    first = next(iter_occurrences(event, overrides[event.id]))
+    assert first.start == arrow.get(2014, 8, 7, 20, 30, 0)
+
+
+def test_occurrence_cache(db, default_account, calendar):
+    event = recurring_event(db, default_account, calendar, TEST_RRULE)
+    start = arrow.get(2014, 8, 1)
+    end = arrow.get(2014, 9, 1)
+    excepted = recurring_event(db, default_account, calendar, TEST_EXDATE_RULE)
+    occurrence_cache.invalidate(event.id)
+
+    with mock.patch.object(
+        recurring, "iter_start_times", wraps=recurring.iter_start_times
+    ) as expand:
+        # Expansions that stop early aren't cached.
+        next(iter_occurrences(event, [], start, end))
+        assert count_occurrences(event, [], start, end) == 4
+        assert expand.call_count == 2
+
+        assert count_occurrences(event, [], start, end) == 4
+        assert len(list(iter_occurrences(event, [], start, end))) == 4
+        assert expand.call_count == 2
+
+        # Windows without an end aren't cached.
+        count_occurrences(event, [], start)
+        assert expand.call_count == 3
+
+        # Updates that don't change the rule keep hitting the cache.
+        event.update(event)
+        assert count_occurrences(event, [], start, end) == 4
+        assert expand.call_count == 3
+
+        # Ones that do miss it, in every process, without invalidating it.
+        event.update(excepted)
+        assert count_occurrences(event, [], start, end) == 4
+        assert expand.call_count == 4
+
+
 def test_override_updated(db, default_account, calendar):
     # Test that when a recurring event override is created or updated
     # remotely, we update our override links appropriately.
@@ -509,6 +582,63 @@ def test_override_updated(db, default_account, calendar):
     assert find_override.location == "walk and talk"
 
 
+def test_batched_updates_link_events(db, default_account, calendar):
+    # Overrides are linked to masters that come in the same chunk, whatever
+    # their order, and to masters that were synced before.
+    params = dict(
+        title="recurring",
+        busy=False,
+        read_only=False,
+        all_day=False,
+        is_owner=False,
+        participants=[],
+        provider_name="inbox",
+        raw_data="",
+        source="local",
+    )
+
+    def override(day):
+        return Event.create(
+            uid="batcheduid_201408{}T203000Z".format(day),
+            master_event_uid="batcheduid",
+            original_start_time=arrow.get(2014, 8, day, 20, 30, 0),
+            start=arrow.get(2014, 8, day, 22, 30, 0),
+            end=arrow.get(2014, 8, day, 23, 30, 0),
+            **params
+        )
+
+    first_override = override(14)
+    master = Event.create(
+        uid="batcheduid",
+        recurrence=TEST_RRULE,
+        start=arrow.get(2014, 8, 7, 20, 30, 0),
+        end=arrow.get(2014, 8, 7, 21, 30, 0),
+        **params
+    )
+    handle_event_updates_batched(
+        default_account.namespace.id,
+        calendar.id,
+        [first_override, master],
+        log,
+        db.session,
+        chunk_size=10,
+    )
+    assert isinstance(master, RecurringEvent)
+    assert first_override.master_event_id == master.id
+
+    second_override = override(21)
+    handle_event_updates_batched(
+        default_account.namespace.id,
+        calendar.id,
+        [second_override],
+        log,
+        db.session,
+        chunk_size=10,
+    )
+    assert second_override.master_event_id == master.id
+    assert len(master.overrides) == 2
+
+
 def test_override_cancelled(db, default_account, calendar):
     # Test that overrides with status 'cancelled' are appropriately missing
     # from the expanded event.
@@ -1,6 +1,8 @@
 # flake8: noqa: F401
 from datetime import datetime
 
+import pytest
+
 from inbox.events.remote_sync import EventSync
 from inbox.events.util import CalendarSyncResponse
 from inbox.models import Calendar, Event, Transaction
@@ -119,7 +121,9 @@ def event_response_with_delete(calendar_uid, sync_from_time):
         ]
 
 
-def test_handle_changes(db, generic_account):
+@pytest.mark.parametrize("batched", [False, True])
+def test_handle_changes(db, generic_account, monkeypatch, batched):
+    monkeypatch.setattr("inbox.events.remote_sync.EVENT_SYNC_BATCH_ENABLED", batched)
     namespace_id = generic_account.namespace.id
     event_sync = EventSync(
         generic_account.email_address, "google", generic_account.id, namespace_id
@@ -0,0 +1,119 @@
+from hashlib import sha256
+
+import mock
+import pytest
+
+from inbox.util import blockstore
+from inbox.util.blockstore_cache import BlockstoreCache, KnownKeys
+
+
+def test_cache_evicts_least_recently_used(tmpdir):
+    cache = BlockstoreCache(100, 60, str(tmpdir))
+    cache.put("a", b"a" * 40)
+    cache.put("b", b"b" * 40)
+    assert cache.get("a") == b"a" * 40
+
+    # "b" is the least recently used blob, so it makes room for "c".
+    cache.put("c", b"c" * 30)
+    assert cache.get("b") is None
+    assert cache.get("a") == b"a" * 40
+    assert cache.get("c") == b"c" * 30
+
+    # Freed extents are coalesced so that a large blob fits again.
+    cache.put("d", b"d" * 60)
+    assert cache.get("d") == b"d" * 60
+    assert cache.used_bytes == 60
+
+    cache.discard("d")
+    assert "d" not in cache
+    assert cache.used_bytes == 0
+
+    # Blobs that are too large aren't cached.
+    cache.put("e", b"e" * 61)
+    assert cache.get("e") is None
+
+
+def test_known_keys_are_bounded():
+    known_keys = KnownKeys(2, 60)
+    known_keys.add("a")
+    known_keys.add("b")
+    assert "a" in known_keys
+    known_keys.add("c")
+    assert "a" in known_keys
+    assert "b" not in known_keys
+    assert "c" in known_keys
+
+
+def test_known_keys_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("inbox.util.blockstore_cache.time.time", lambda: now[0])
+    known_keys = KnownKeys(10, 60)
+    known_keys.add("a")
+    now[0] += 30
+    assert "a" in known_keys
+
+    # Lookups don't extend the TTL, only seeing the key in the bucket again.
+    now[0] += 30
+    assert "a" not in known_keys
+    known_keys.add("a")
+    assert "a" in known_keys
+
+
+def test_s3_reads_and_saves_use_cache(monkeypatch, tmpdir):
+    monkeypatch.setattr("inbox.util.blockstore.STORE_MSG_ON_S3", True)
+    monkeypatch.setattr("inbox.util.blockstore.CACHE_ENABLED", True)
+    monkeypatch.setattr(
+        "inbox.util.blockstore._cache", BlockstoreCache(1024, 1024, str(tmpdir))
+    )
+    monkeypatch.setattr("inbox.util.blockstore._known_keys", KnownKeys(10, 60))
+    monkeypatch.setattr(
+        "inbox.util.blockstore.config",
+        {
+            "AWS_ACCESS_KEY_ID": "key",
+            "AWS_SECRET_ACCESS_KEY": "secret",
+            "TEMP_MESSAGE_STORE_BUCKET_NAME": "bucket",
+        },
+    )
+
+    data = b"Some message contents"
+    data_sha256 = sha256(data).hexdigest()
+    key = mock.Mock(size=len(data))
+    key.get_contents_as_string.return_value = data
+    bucket = mock.Mock()
+    bucket.get_key.return_value = key
+    monkeypatch.setattr(
+        "inbox.util.blockstore.get_s3_bucket", mock.Mock(return_value=bucket)
+    )
+
+    assert blockstore.get_from_blockstore(data_sha256) == data
+    assert blockstore.get_from_blockstore(data_sha256) == data
+    reader = blockstore.open_blockstore_stream(data_sha256)
+    assert b"".join(reader.iter_chunks()) == data
+    assert bucket.get_key.call_count == 1
+
+    # The key is known to exist, so saving it again doesn't check S3.
+    blockstore.save_to_blockstore(data_sha256, data)
+    assert bucket.get_key.call_count == 1
+
+    blockstore.delete_from_blockstore(data_sha256)
+    blockstore.get_from_blockstore(data_sha256)
+    assert bucket.get_key.call_count == 2
+
+
+def test_stream_verifies_hash():
+    data = b"Some message contents"
+    reader = blockstore._MemoryBlockstoreReader(sha256(data).hexdigest(), data)
+    assert reader.read() == data
+    # Ranges can't be verified.
+    reader = blockstore._MemoryBlockstoreReader("bad", data)
+    assert b"".join(reader.iter_chunks(5)) == data[5:]
+
+    # The last chunk is only sent once the hash checks out.
+    reader = blockstore._MemoryBlockstoreReader("bad", data)
+    chunks = reader.iter_chunks(chunk_size=10)
+    assert next(chunks) == data[:10]
+    assert next(chunks) == data[10:20]
+    with pytest.raises(blockstore.BlockstoreHashMismatch):
+        next(chunks)
+    with pytest.raises(blockstore.BlockstoreHashMismatch):
+        blockstore._MemoryBlockstoreReader("bad", data).read()
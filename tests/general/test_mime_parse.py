@@ -0,0 +1,114 @@
+import datetime
+import os
+import pickle
+import signal
+
+import mock
+import pytest
+from flanker import mime
+
+from inbox.models import Message
+from inbox.util.mime_parse import (
+    InlineParseService,
+    MimeParseError,
+    MimeParseTimeout,
+    ProcessPoolParseService,
+    parse_message,
+)
+
+from tests.util.base import default_account
+
+__all__ = ["default_account"]
+
+RECEIVED_DATE = datetime.datetime(2014, 9, 22, 17, 25, 46)
+
+
+def _raw_message_with_attachment():
+    mime_message = mime.create.multipart("mixed")
+    mime_message.append(
+        mime.create.text("plain", "Hello World!"),
+        mime.create.attachment("image/png", "filler", "image.png", "attachment"),
+    )
+    mime_message.headers["To"] = "Alice <alice@example.com>"
+    mime_message.headers["Subject"] = "Hello"
+    return mime_message.to_string().encode()
+
+
+def test_parse_result_is_picklable():
+    raw = _raw_message_with_attachment()
+    result = pickle.loads(pickle.dumps(parse_message(raw, RECEIVED_DATE, 1, "", 1)))
+    assert result.subject == "Hello"
+    assert result.to_addr == [["Alice", "alice@example.com"]]
+    assert result.snippet == "Hello World!"
+    assert result.headers["subject"] == "Hello"
+    assert not result.decode_error
+    [attachment] = result.attachments
+    assert attachment.filename == "image.png"
+    assert attachment.content_type == "image/png"
+    assert attachment.data == b"filler"
+
+
+def test_process_pool_parse():
+    raw = _raw_message_with_attachment()
+    expected = InlineParseService().parse(raw, RECEIVED_DATE, 1, "", 1)
+
+    service = ProcessPoolParseService(1, offload_min_size=0)
+    result = service.parse(raw, RECEIVED_DATE, 1, "", 1)
+    assert result.__dict__.keys() == expected.__dict__.keys()
+    for attr in ("subject", "to_addr", "body", "snippet", "received_date"):
+        assert getattr(result, attr) == getattr(expected, attr)
+    assert [a.data for a in result.attachments] == [b"filler"]
+
+    # Small messages aren't sent to the workers.
+    service = ProcessPoolParseService(1, offload_min_size=len(raw) + 1)
+    with mock.patch.object(service, "_get_idle") as get_idle:
+        service.parse(raw, RECEIVED_DATE, 1, "", 1)
+    assert not get_idle.called
+
+
+def test_process_pool_replaces_failed_workers():
+    raw = _raw_message_with_attachment()
+    service = ProcessPoolParseService(1, offload_min_size=0, timeout=1)
+
+    # A worker that died.
+    [worker] = service._get_idle().queue
+    worker.process.kill()
+    worker.process.join()
+    with pytest.raises(MimeParseError):
+        service.parse(raw, RECEIVED_DATE, 1, "", 1)
+    assert service.parse(raw, RECEIVED_DATE, 1, "", 1).subject == "Hello"
+
+    # A worker that's stuck.
+    [worker] = service._get_idle().queue
+    os.kill(worker.process.pid, signal.SIGSTOP)
+    with pytest.raises(MimeParseTimeout):
+        service.parse(raw, RECEIVED_DATE, 1, "", 1)
+    worker.process.join()
+    assert service.parse(raw, RECEIVED_DATE, 1, "", 1).subject == "Hello"
+
+
+def test_create_from_synced_uses_parse_service(default_account):
+    raw = _raw_message_with_attachment()
+    service = InlineParseService()
+    with mock.patch(
+        "inbox.models.message.get_parse_service", return_value=service
+    ), mock.patch.object(service, "parse", wraps=service.parse) as parse:
+        m = Message.create_from_synced(default_account, 22, "Inbox", RECEIVED_DATE, raw)
+    assert parse.called
+    assert m.subject == "Hello"
+    assert m.get_header("Subject", 22) == "Hello"
+    assert len(m.attachments) == 1
+    assert m.attachments[0].block.filename == "image.png"
+
+
+def test_create_from_synced_parse_error(default_account):
+    raw = _raw_message_with_attachment()
+    service = InlineParseService()
+    with mock.patch(
+        "inbox.models.message.get_parse_service", return_value=service
+    ), mock.patch.object(
+        service, "parse", side_effect=MimeParseError("MIME parse worker exited")
+    ):
+        m = Message.create_from_synced(default_account, 22, "Inbox", RECEIVED_DATE, raw)
+    assert m.decode_error
+    assert m.size == 0
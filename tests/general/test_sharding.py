@@ -0,0 +1,116 @@
+import platform
+
+import mock
+import pytest
+
+from inbox.api.filtering import page_over_shards
+from inbox.ignition import engine_manager
+from inbox.mailsync.service import SyncService
+from inbox.models import Account, Namespace
+from inbox.models.session import query_shards, session_scope
+from inbox.util.sharding import generate_open_shard_key
+
+from tests.util.base import add_generic_imap_account, delete_generic_imap_accounts
+
+SHARD_1_KEY = 1 << 48
+
+
+@pytest.fixture
+def sharded_accounts(db, second_shard_db):
+    delete_generic_imap_accounts(db.session)
+    accounts = [
+        add_generic_imap_account(db.session, email_address="shard0@example.com"),
+        add_generic_imap_account(
+            second_shard_db.session, email_address="shard1@example.com"
+        ),
+    ]
+    yield accounts
+    delete_generic_imap_accounts(db.session)
+
+
+def test_shard_key_for_id():
+    assert engine_manager.shard_key_for_id(1) == 0
+    assert engine_manager.shard_key_for_id(SHARD_1_KEY - 1) == 0
+    assert engine_manager.shard_key_for_id(SHARD_1_KEY) == 1
+    assert engine_manager.shard_key_for_id(SHARD_1_KEY + 12) == 1
+    assert engine_manager.get_for_id(SHARD_1_KEY + 12) is engine_manager.engines[1]
+
+
+def test_objects_are_routed_to_their_shard(sharded_accounts):
+    account_0, account_1 = sharded_accounts
+    assert account_0.id >> 48 == 0
+    assert account_1.id >> 48 == 1
+    assert account_1.namespace.id >> 48 == 1
+
+    with session_scope(account_1.id) as db_session:
+        account = db_session.query(Account).get(account_1.id)
+        assert account.email_address == "shard1@example.com"
+        assert db_session.query(Account).get(account_0.id) is None
+
+
+def test_query_shards(sharded_accounts):
+    results = query_shards(
+        lambda db_session: [r[0] for r in db_session.query(Account.email_address)]
+    )
+    assert results == [["shard0@example.com"], ["shard1@example.com"]]
+
+    results = query_shards(
+        lambda db_session: db_session.query(Account).count(), shard_ids=[1]
+    )
+    assert results == [1]
+
+
+def test_account_ids_to_sync_spans_shards(db, second_shard_db, sharded_accounts):
+    service = SyncService(
+        process_identifier="{}:0".format(platform.node()), process_number=0
+    )
+    for session, account in zip(
+        [db.session, second_shard_db.session], sharded_accounts
+    ):
+        account.desired_sync_host = service.process_identifier
+        account.sync_host = None
+        session.commit()
+
+    ids = {account.id for account in sharded_accounts}
+    assert service.account_ids_to_sync() == ids
+    assert service.account_ids_owned() == set()
+
+
+def get_ids(query):
+    return [{"id": r[0]} for r in query.with_entities(Namespace.id)]
+
+
+def test_page_over_shards(sharded_accounts):
+    expected = [account.namespace.id for account in sharded_accounts]
+
+    results, cursor = page_over_shards(Namespace, 0, 1, get_ids)
+    assert [r["id"] for r in results] == expected[:1]
+    results, cursor = page_over_shards(Namespace, cursor, 1, get_ids)
+    assert [r["id"] for r in results] == expected[1:]
+    results, _ = page_over_shards(Namespace, cursor, 1, get_ids)
+    assert results == []
+
+    results, _ = page_over_shards(Namespace, 0, 10, get_ids)
+    assert [r["id"] for r in results] == expected
+
+
+def test_page_over_shards_stops_when_full(sharded_accounts):
+    with mock.patch(
+        "inbox.api.filtering.query_shards", wraps=query_shards
+    ) as mock_query_shards:
+        # The start shard fills the page, so later shards aren't queried.
+        page_over_shards(Namespace, 0, 1, get_ids)
+        assert [c[0][1] for c in mock_query_shards.call_args_list] == [[0]]
+
+
+def test_new_accounts_are_placed_on_open_shards(monkeypatch):
+    # Only the first shard of the test config is open.
+    assert generate_open_shard_key() == 0
+
+    # Shards without an engine are never picked.
+    monkeypatch.setattr("inbox.util.sharding.get_open_shards", lambda: [1, 7])
+    assert generate_open_shard_key() == SHARD_1_KEY
+
+    monkeypatch.setattr("inbox.util.sharding.get_open_shards", lambda: [7])
+    with pytest.raises(ValueError):
+        generate_open_shard_key()
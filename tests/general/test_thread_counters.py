@@ -0,0 +1,107 @@
+import datetime
+
+import pytest
+
+from inbox.models import Category
+from inbox.models.thread_counter import (
+    ALL_CATEGORIES,
+    COUNTER_COLUMNS,
+    ThreadCounter,
+    reconcile_thread_counters,
+)
+
+from tests.util.base import add_fake_message, add_fake_thread
+
+
+@pytest.fixture
+def thread_counters(db, default_namespace, monkeypatch):
+    monkeypatch.setattr("inbox.models.thread_counter.THREAD_COUNTERS_ENABLED", True)
+    # Start from counters that match whatever other tests left behind.
+    reconcile_thread_counters(db.session, default_namespace.id)
+
+
+def counts(db, namespace_id, category_id):
+    counter = (
+        db.session.query(ThreadCounter)
+        .filter_by(namespace_id=namespace_id, category_id=category_id)
+        .first()
+    )
+    if counter is None:
+        return dict.fromkeys(COUNTER_COLUMNS, 0)
+    db.session.refresh(counter)
+    return {column: getattr(counter, column) for column in COUNTER_COLUMNS}
+
+
+def test_counters_follow_flushes(db, default_namespace, thread_counters):
+    namespace_id = default_namespace.id
+    before = counts(db, namespace_id, ALL_CATEGORIES)
+
+    thread = add_fake_thread(db.session, namespace_id)
+    first = add_fake_message(db.session, namespace_id, thread, add_sent_category=True)
+    second = add_fake_message(db.session, namespace_id, thread)
+    sent = (
+        db.session.query(Category)
+        .filter_by(namespace_id=namespace_id, name="sent")
+        .one()
+    )
+
+    overall = counts(db, namespace_id, ALL_CATEGORIES)
+    assert overall["threads"] == before["threads"] + 1
+    assert overall["unread_threads"] == before["unread_threads"] + 1
+    assert overall["messages"] == before["messages"] + 2
+    assert overall["unread_messages"] == before["unread_messages"] + 2
+    in_sent = counts(db, namespace_id, sent.id)
+    assert in_sent["threads"] >= 1
+    assert reconcile_thread_counters(db.session, namespace_id) == 0
+
+    first.is_read = True
+    second.is_read = True
+    second.is_starred = True
+    db.session.commit()
+    overall = counts(db, namespace_id, ALL_CATEGORIES)
+    assert overall["unread_threads"] == before["unread_threads"]
+    assert overall["unread_messages"] == before["unread_messages"]
+    assert overall["starred_threads"] == before["starred_threads"] + 1
+    assert counts(db, namespace_id, sent.id)["starred_threads"] == (
+        in_sent["starred_threads"] + 1
+    )
+    assert reconcile_thread_counters(db.session, namespace_id) == 0
+
+    thread.deleted_at = datetime.datetime.utcnow()
+    db.session.commit()
+    assert counts(db, namespace_id, ALL_CATEGORIES) == before
+    assert reconcile_thread_counters(db.session, namespace_id) == 0
+
+
+def test_reconcile_fixes_drift(db, default_namespace, thread_counters):
+    namespace_id = default_namespace.id
+    thread = add_fake_thread(db.session, namespace_id)
+    add_fake_message(db.session, namespace_id, thread)
+    expected = counts(db, namespace_id, ALL_CATEGORIES)
+
+    db.session.query(ThreadCounter).filter_by(
+        namespace_id=namespace_id, category_id=ALL_CATEGORIES
+    ).update({"threads": 0, "messages": 0})
+    db.session.commit()
+
+    assert reconcile_thread_counters(db.session, namespace_id) == 1
+    assert counts(db, namespace_id, ALL_CATEGORIES) == expected
+
+
+def test_count_views_use_counters(
+    db, api_client, default_namespace, thread_counters, monkeypatch
+):
+    thread = add_fake_thread(db.session, default_namespace.id)
+    add_fake_message(db.session, default_namespace.id, thread, add_sent_category=True)
+
+    urls = [
+        "/threads?view=count",
+        "/threads?view=count&in=sent",
+        "/threads?view=count&unread=true",
+        "/messages?view=count&in=sent&unread=true",
+        "/messages?view=count&starred=true",
+    ]
+    from_counters = [api_client.get_data(url)["count"] for url in urls]
+
+    monkeypatch.setattr("inbox.models.thread_counter.THREAD_COUNTERS_ENABLED", False)
+    assert from_counters == [api_client.get_data(url)["count"] for url in urls]
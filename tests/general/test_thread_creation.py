@@ -9,15 +9,18 @@ from collections import namedtuple
 
 import pytest
 
+from inbox.mailsync.backends.gmail import GmailFolderSyncEngine
 from inbox.mailsync.backends.imap.generic import FolderSyncEngine
-from inbox.models import Folder, Namespace
+from inbox.models import Folder, Message, Namespace, Thread
 from inbox.models.backends.generic import GenericAccount
 from inbox.models.backends.imap import ImapUid
-from inbox.util.threading import fetch_corresponding_thread
+from inbox.models.threading_key import ThreadingKey
+from inbox.util.threading import backfill_threading_index, fetch_corresponding_thread
 
 from tests.util.base import add_fake_message, add_fake_thread, add_generic_imap_account
 
 MockRawMessage = namedtuple("RawMessage", ["flags"])
+MockGmailRawMessage = namedtuple("RawMessage", ["flags", "g_msgid", "g_thrid"])
 
 
 @pytest.fixture
@@ -93,5 +96,103 @@ def test_threading_limit(db, folder_sync_engine, monkeypatch):
     assert all(len(thread.messages) == MAX_THREAD_LENGTH for thread in new_threads)
 
 
+def _indexed_message(db, folder_sync_engine, subject, message_id, references):
+    m = Message()
+    m.namespace_id = folder_sync_engine.namespace_id
+    m.received_date = datetime.datetime.utcnow()
+    m.message_id_header = message_id
+    m.references = references
+    m.size = 0
+    m.body = ""
+    m.from_addr = [("Karim Hamidou", "karim@nilas.com")]
+    m.to_addr = [("Eben Freeman", "eben@nilas.com")]
+    m.snippet = ""
+    m.subject = subject
+    db.session.add(m)
+    folder_sync_engine.add_message_to_thread(db.session, m, MockRawMessage([]))
+    db.session.commit()
+    return m
+
+
+def test_indexed_threading(db, folder_sync_engine, monkeypatch):
+    monkeypatch.setattr(
+        "inbox.mailsync.backends.imap.generic.THREADING_INDEX_ENABLED", True
+    )
+    monkeypatch.setattr("inbox.mailsync.backends.imap.generic.MAX_THREAD_LENGTH", 3)
+
+    first = _indexed_message(db, folder_sync_engine, "Lunch", "<1@nylas.com>", [])
+    # Same subject and participants.
+    second = _indexed_message(db, folder_sync_engine, "Re: Lunch", "<2@nylas.com>", [])
+    # A reply is threaded by its references, even if its subject changed.
+    third = _indexed_message(
+        db, folder_sync_engine, "Dinner instead?", "<3@nylas.com>", ["<1@nylas.com>"]
+    )
+    assert first.thread_id == second.thread_id == third.thread_id
+    assert first.thread.message_count == 3
+
+    # The thread is full, so the next message starts a new one.
+    fourth = _indexed_message(
+        db, folder_sync_engine, "Re: Lunch", "<4@nylas.com>", ["<2@nylas.com>"]
+    )
+    assert fourth.thread_id != first.thread_id
+    assert fourth.thread.message_count == 1
+
+    # Deleting a message doesn't update the stored count, but a thread that
+    # looks full is counted again.
+    db.session.delete(second)
+    db.session.commit()
+    assert first.thread.message_count == 3
+    fifth = _indexed_message(
+        db, folder_sync_engine, "Re: Dinner", "<5@nylas.com>", ["<3@nylas.com>"]
+    )
+    assert fifth.thread_id == first.thread_id
+    assert first.thread.message_count == 3
+
+    # Rebuilding the index gives the same counts.
+    thread_id = first.thread_id
+    first.thread.message_count = None
+    db.session.commit()
+    assert backfill_threading_index(db.session, folder_sync_engine.namespace_id) >= 4
+    assert db.session.query(Thread).get(thread_id).message_count == 3
+
+
 if __name__ == "__main__":
     pytest.main([__file__])
+
+
+def test_gmail_messages_are_not_indexed(db, default_account, monkeypatch):
+    # Gmail threads by X-GM-THRID, so it has no use for the index.
+    monkeypatch.setattr(
+        "inbox.mailsync.backends.imap.generic.THREADING_INDEX_ENABLED", True
+    )
+    db.session.add(Folder(account=default_account, name="[Gmail]/All Mail"))
+    db.session.commit()
+    namespace_id = default_account.namespace.id
+    engine = GmailFolderSyncEngine(
+        default_account.id,
+        namespace_id,
+        "[Gmail]/All Mail",
+        default_account.email_address,
+        "gmail",
+        None,
+    )
+
+    m = Message()
+    m.namespace_id = namespace_id
+    m.received_date = datetime.datetime.utcnow()
+    m.message_id_header = "<1@nylas.com>"
+    m.references = []
+    m.size = 0
+    m.body = ""
+    m.from_addr = [("Karim Hamidou", "karim@nilas.com")]
+    m.to_addr = [("Eben Freeman", "eben@nilas.com")]
+    m.snippet = ""
+    m.subject = "Lunch"
+    db.session.add(m)
+    engine.add_message_to_thread(db.session, m, MockGmailRawMessage([], 1, 1))
+    db.session.commit()
+
+    assert m.thread_id is not None
+    assert (
+        db.session.query(ThreadingKey).filter_by(namespace_id=namespace_id).count() == 0
+    )
@@ -14,6 +14,7 @@ from inbox.heartbeat.store import (
     HeartbeatStatusKey,
     HeartbeatStatusProxy,
     HeartbeatStore,
+    get_heartbeat_aggregator,
 )
 from inbox.logging import configure_logging
 
@@ -95,6 +96,95 @@ def test_folder_publish_in_index(redis_client):
     assert fuzzy_equals(proxy.heartbeat_at, timestamp)
 
 
+def test_coalesced_publish(monkeypatch, redis_client):
+    monkeypatch.setattr("inbox.heartbeat.config.PUBLISH_INTERVAL", 10)
+    monkeypatch.setattr("inbox.heartbeat.store._aggregator", None)
+    aggregator = get_heartbeat_aggregator()
+
+    proxy = proxy_for(1, 2)
+    proxy.publish()
+    proxy.publish()
+    proxy_for(1, 3).publish()
+    proxy_for(2, 2).publish()
+    # Nothing is written until the aggregator flushes.
+    assert redis_client.zrange("1", 0, -1) == []
+
+    # A cleared heartbeat isn't brought back by the flush.
+    clear_heartbeat_status(2)
+    aggregator.flush()
+    aggregator._greenlet.kill()
+
+    acct_folder_index = redis_client.zrange("1", 0, -1, withscores=True)
+    assert [key.decode() for key, _ in acct_folder_index] == ["2", "3"]
+    assert fuzzy_equals(proxy.heartbeat_at, acct_folder_index[0][1])
+    assert redis_client.zrange("2", 0, -1) == []
+
+    ping = get_ping_status([1])
+    assert all(f.alive for f in ping[1].folders)
+
+
+@pytest.mark.parametrize("write_fails", [False, True])
+def test_heartbeats_cleared_during_flush(monkeypatch, redis_client, write_fails):
+    monkeypatch.setattr("inbox.heartbeat.config.PUBLISH_INTERVAL", 10)
+    monkeypatch.setattr("inbox.heartbeat.store._aggregator", None)
+    aggregator = get_heartbeat_aggregator()
+    proxy_for(1, 2).publish()
+    proxy_for(1, 3).publish()
+
+    # Clear a heartbeat while the flush is writing it.
+    real_pipeline = redis_client.pipeline
+
+    def pipeline(*args, **kwargs):
+        pipe = real_pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        def clear_and_execute():
+            monkeypatch.setattr(redis_client, "pipeline", real_pipeline)
+            clear_heartbeat_status(1, 2)
+            if write_fails:
+                raise Exception("Connection lost")
+            return execute()
+
+        pipe.execute = clear_and_execute
+        return pipe
+
+    monkeypatch.setattr(redis_client, "pipeline", pipeline)
+    if write_fails:
+        with pytest.raises(Exception):
+            aggregator.flush()
+        # Only the heartbeat that wasn't cleared is retried.
+        assert redis_client.zrange("1", 0, -1) == []
+        aggregator.flush()
+    else:
+        aggregator.flush()
+    aggregator._greenlet.kill()
+
+    assert [key.decode() for key in redis_client.zrange("1", 0, -1)] == ["3"]
+    assert aggregator._discarded == {}
+
+
+def test_clearing_device_keeps_pending_heartbeat(monkeypatch, redis_client):
+    monkeypatch.setattr("inbox.heartbeat.config.PUBLISH_INTERVAL", 10)
+    monkeypatch.setattr("inbox.heartbeat.store._aggregator", None)
+    aggregator = get_heartbeat_aggregator()
+    redis_client.hset("1:2", "2", "{}")
+    redis_client.hset("1:2", "3", "{}")
+    proxy_for(1, 2).publish()
+
+    # Another device still has the folder, so its heartbeat is written.
+    clear_heartbeat_status(1, 2, device_id=2)
+    aggregator.flush()
+    aggregator._greenlet.kill()
+    assert [key.decode() for key in redis_client.zrange("1", 0, -1)] == ["2"]
+
+    # Clearing the last device clears the folder.
+    proxy_for(1, 2).publish()
+    clear_heartbeat_status(1, 2, device_id=3)
+    aggregator.flush()
+    aggregator._greenlet.kill()
+    assert redis_client.zrange("1", 0, -1) == []
+
+
 def test_kill_device_multiple():
     # If we kill a device and the folder has multiple devices, don't clear
     # the heartbeat status
@@ -271,6 +271,45 @@ def test_body(generic_client, constants):
     ]
 
 
+def test_sizes(generic_client, constants):
+    expected_resp = (
+        "{seq} (RFC822.SIZE {size} UID {uid} MODSEQ ({modseq}))".format(**constants)
+    ).encode()
+    unsolicited_resp = b"1198 (UID 1731 MODSEQ (95244) FLAGS (\\Seen))"
+    patch_imap4(generic_client, [expected_resp, unsolicited_resp])
+    uid = constants["uid"]
+    assert generic_client.sizes([uid]) == {uid: constants["size"]}
+
+
+def test_batched_body_falls_back_to_single_uid_fetch(generic_client, constants):
+    uid = constants["uid"]
+    other_uid = uid + 1
+    body_resp = (
+        "{seq} (UID {uid} MODSEQ ({modseq}) "
+        'INTERNALDATE "{internaldate}" FLAGS {flags} '
+        "BODY[] {{{body_size}}}".format(**constants).encode(),
+        constants["body"],
+    )
+    # The batched FETCH only returns flags for the second UID, so it must be
+    # fetched again on its own.
+    incomplete_resp = "1232 (UID {} FLAGS (\\Seen))".format(other_uid).encode()
+    other_body_resp = (
+        "1232 (UID {} "
+        'INTERNALDATE "{internaldate}" FLAGS {flags} '
+        "BODY[] {{{body_size}}}".format(other_uid, **constants).encode(),
+        constants["body"],
+    )
+    generic_client.conn._imap._command_complete.return_value = ("OK", ["Success"])
+    generic_client.conn._imap._untagged_response.side_effect = [
+        ("OK", [body_resp, b")", incomplete_resp]),
+        ("OK", [other_body_resp, b")"]),
+    ]
+
+    raw_messages = generic_client.uids([uid, other_uid])
+    assert [m.uid for m in raw_messages] == [uid, other_uid]
+    assert all(m.body == constants["body"] for m in raw_messages)
+
+
 def test_internaldate(generic_client, constants):
     """ Test that our monkeypatched imaplib works through imapclient """
     dates_to_test = [
@@ -13,7 +13,8 @@ from sqlalchemy.orm.exc import ObjectDeletedError
 from inbox.crispin import GmailFlags
 from inbox.mailsync.backends.imap.common import remove_deleted_uids, update_metadata
 from inbox.mailsync.gc import DeleteHandler, LabelRenameHandler
-from inbox.models import Folder, Message, Transaction
+from inbox.models import Folder, Message, Thread, Transaction
+from inbox.models.backends.imap import ImapUid
 from inbox.models.label import Label
 from inbox.util.testutils import MockIMAPClient, mock_imapclient
 
@@ -84,6 +85,30 @@ def test_deleting_from_a_message_with_multiple_uids(
     assert len(message.imapuids) == 1, "The message should have only one imapuid."
 
 
+def test_deleting_uids_in_chunks(db, default_account, default_namespace, thread):
+    inbox_folder = Folder.find_or_create(db.session, default_account, "inbox", "inbox")
+    messages = []
+    for msg_uid in range(1, 8):
+        message = add_fake_message(db.session, default_namespace.id, thread)
+        add_fake_imapuid(db.session, default_account.id, message, inbox_folder, msg_uid)
+        messages.append(message)
+    draft = messages[-1]
+    draft.is_draft = True
+    db.session.commit()
+
+    remove_deleted_uids(
+        default_account.id, inbox_folder.id, list(range(1, 8)), chunk_size=3
+    )
+    db.session.expire_all()
+
+    for message in messages[:-1]:
+        assert message.deleted_at is not None
+        assert not message.imapuids
+    # Drafts are still deleted synchronously.
+    with pytest.raises(ObjectDeletedError):
+        draft.id
+
+
 def test_deletion_with_short_ttl(
     db, default_account, default_namespace, marked_deleted_message, thread, folder
 ):
@@ -239,8 +264,80 @@ def test_deletion_creates_revision(
     assert latest_thread_transaction.command == "update"
 
 
+def test_set_based_deletion(db, default_account, default_namespace, thread, folder):
+    handler = DeleteHandler(
+        account_id=default_account.id,
+        namespace_id=default_namespace.id,
+        provider_name=default_account.provider,
+        uid_accessor=lambda m: m.imapuids,
+        message_ttl=0,
+        uid_class=ImapUid,
+    )
+    deleted_at = datetime(2015, 2, 22, 22, 22, 22)
+    first = add_fake_message(
+        db.session,
+        default_namespace.id,
+        thread,
+        subject="First",
+        received_date=datetime(2015, 2, 1),
+    )
+    second = add_fake_message(
+        db.session,
+        default_namespace.id,
+        thread,
+        subject="Second",
+        snippet="second",
+        received_date=datetime(2015, 2, 2),
+    )
+    last = add_fake_message(
+        db.session,
+        default_namespace.id,
+        thread,
+        subject="Last",
+        snippet="last",
+        received_date=datetime(2015, 2, 3),
+    )
+    # Still has a uid, so it isn't actually dangling.
+    add_fake_imapuid(db.session, default_account.id, second, folder, 2222)
+    for message in (first, second, last):
+        message.deleted_at = deleted_at
+    db.session.commit()
+    first_id, last_id, thread_id = first.id, last.id, thread.id
+
+    assert handler.check_set_based(deleted_at + timedelta(seconds=1)) == 2
+    db.session.expire_all()
+    assert (
+        db.session.query(Message).filter(Message.id.in_([first_id, last_id])).all()
+        == []
+    )
+    assert second.deleted_at is None
+    thread = db.session.query(Thread).get(thread_id)
+    assert thread.subject == "Second"
+    assert thread.snippet == "second"
+    assert thread.recentdate == datetime(2015, 2, 2)
+    assert thread.deleted_at is None
+    latest_thread_transaction = (
+        db.session.query(Transaction)
+        .filter(
+            Transaction.record_id == thread_id, Transaction.object_type == "thread",
+        )
+        .order_by(desc(Transaction.id))
+        .first()
+    )
+    assert latest_thread_transaction.command == "update"
+
+    # Once the thread's last message is gone, it's marked for deletion.
+    second.deleted_at = deleted_at
+    db.session.query(ImapUid).filter(ImapUid.message_id == second.id).delete()
+    db.session.commit()
+    assert handler.check_set_based(deleted_at + timedelta(seconds=1)) == 1
+    db.session.expire_all()
+    assert db.session.query(Thread).get(thread_id).deleted_at is not None
+
+
+@pytest.mark.parametrize("set_based", [False, True])
 def test_deleted_labels_get_gced(
-    empty_db, default_account, thread, message, imapuid, folder
+    empty_db, default_account, thread, message, imapuid, folder, set_based
 ):
     # Check that only the labels without messages attached to them
     # get deleted.
@@ -275,7 +372,10 @@ def test_deleted_labels_get_gced(
         uid_accessor=lambda m: m.imapuids,
         message_ttl=0,
     )
-    handler.gc_deleted_categories()
+    if set_based:
+        handler.gc_deleted_categories_set_based()
+    else:
+        handler.gc_deleted_categories()
     empty_db.session.commit()
 
     # Check that the first label got gc'ed
@@ -1,10 +1,12 @@
 # flake8: noqa: F401, F811
 from hashlib import sha256
 
+import mock
 import pytest
 from gevent.lock import BoundedSemaphore
 from sqlalchemy.orm.exc import ObjectDeletedError
 
+from inbox.contacts.processing import ContactResolver
 from inbox.mailsync.backends.base import MailsyncDone
 from inbox.mailsync.backends.gmail import GmailFolderSyncEngine
 from inbox.mailsync.backends.imap.generic import (
@@ -77,6 +79,100 @@ def test_initial_sync(db, generic_account, inbox_folder, mock_imapclient):
     }
 
 
+def test_batched_initial_sync(
+    db, generic_account, inbox_folder, mock_imapclient, monkeypatch
+):
+    monkeypatch.setattr(
+        "inbox.mailsync.backends.imap.generic.BATCH_DOWNLOAD_ENABLED", True
+    )
+    uid_dict = uids.example()
+    mock_imapclient.add_folder_data(inbox_folder.name, uid_dict)
+
+    folder_sync_engine = FolderSyncEngine(
+        generic_account.id,
+        generic_account.namespace.id,
+        inbox_folder.name,
+        generic_account.email_address,
+        "custom",
+        BoundedSemaphore(1),
+    )
+    batches = []
+    download_and_commit_uids = folder_sync_engine.download_and_commit_uids
+
+    def record_batch(crispin_client, batch):
+        batches.append(batch)
+        return download_and_commit_uids(crispin_client, batch)
+
+    monkeypatch.setattr(folder_sync_engine, "download_and_commit_uids", record_batch)
+    folder_sync_engine.initial_sync()
+
+    saved_uids = db.session.query(ImapUid).filter(ImapUid.folder_id == inbox_folder.id)
+    assert {u.msg_uid for u in saved_uids} == set(uid_dict)
+    assert len(batches) < len(uid_dict)
+
+
+def test_uid_batches_stay_within_budgets(db, generic_account, inbox_folder):
+    folder_sync_engine = FolderSyncEngine(
+        generic_account.id,
+        generic_account.namespace.id,
+        inbox_folder.name,
+        generic_account.email_address,
+        "custom",
+        BoundedSemaphore(1),
+    )
+    sizes = {1: 40, 2: 40, 3: 40, 4: 200, 5: 10}
+    crispin_client = mock.Mock()
+    crispin_client.sizes = lambda uids: {uid: sizes[uid] for uid in uids}
+
+    # A message that would go over the byte budget starts the next batch, and
+    # one that is bigger than the budget gets a batch of its own.
+    batches = folder_sync_engine._uid_batches(crispin_client, sorted(sizes), 100, 10)
+    assert list(batches) == [[1, 2], [3], [4], [5]]
+
+    batches = folder_sync_engine._uid_batches(crispin_client, [1, 2, 3, 5], 1000, 2)
+    assert list(batches) == [[1, 2], [3, 5]]
+
+
+def test_pipelined_initial_sync(
+    db, generic_account, inbox_folder, mock_imapclient, monkeypatch
+):
+    monkeypatch.setattr(
+        "inbox.mailsync.backends.imap.generic.BATCH_DOWNLOAD_ENABLED", True
+    )
+    monkeypatch.setattr(
+        "inbox.mailsync.backends.imap.generic.INGEST_PIPELINE_ENABLED", True
+    )
+    uid_dict = uids.example()
+    mock_imapclient.add_folder_data(inbox_folder.name, uid_dict)
+
+    folder_sync_engine = FolderSyncEngine(
+        generic_account.id,
+        generic_account.namespace.id,
+        inbox_folder.name,
+        generic_account.email_address,
+        "custom",
+        BoundedSemaphore(1),
+    )
+    commits = []
+    commit_messages = folder_sync_engine.commit_messages
+
+    def record_commit(raw_messages, parsed_messages=None, **kwargs):
+        commits.append(set(parsed_messages))
+        return commit_messages(raw_messages, parsed_messages=parsed_messages, **kwargs)
+
+    monkeypatch.setattr(folder_sync_engine, "commit_messages", record_commit)
+    folder_sync_engine.initial_sync()
+
+    saved_uids = db.session.query(ImapUid).filter(ImapUid.folder_id == inbox_folder.id)
+    assert {u.msg_uid for u in saved_uids} == set(uid_dict)
+    # Every message was parsed ahead of its commit.
+    assert set().union(*commits) == set(uid_dict)
+    saved_message_hashes = {u.message.data_sha256 for u in saved_uids}
+    assert saved_message_hashes == {
+        sha256(v[b"BODY[]"]).hexdigest() for v in uid_dict.values()
+    }
+
+
 def test_new_uids_synced_when_polling(
     db, generic_account, inbox_folder, mock_imapclient
 ):
@@ -294,6 +390,43 @@ def test_gmail_initial_sync(db, default_account, all_mail_folder, mock_imapclien
     assert {u.msg_uid for u in saved_uids} == set(uid_dict)
 
 
+def test_gmail_resolves_contacts_per_batch(
+    db, default_account, all_mail_folder, mock_imapclient, monkeypatch
+):
+    uid_dict = uids.example()
+    mock_imapclient.add_folder_data(all_mail_folder.name, uid_dict)
+    mock_imapclient.list_folders = lambda: [
+        ((b"\\All", b"\\HasNoChildren",), b"/", u"[Gmail]/All Mail")
+    ]
+    resolved = []
+    resolve = ContactResolver.resolve
+
+    def record_resolve(self, db_session):
+        resolved.append(len(self._messages))
+        return resolve(self, db_session)
+
+    monkeypatch.setattr(ContactResolver, "resolve", record_resolve)
+
+    folder_sync_engine = GmailFolderSyncEngine(
+        default_account.id,
+        default_account.namespace.id,
+        all_mail_folder.name,
+        default_account.email_address,
+        "gmail",
+        BoundedSemaphore(1),
+    )
+    with folder_sync_engine.conn_pool.get() as crispin_client:
+        crispin_client.select_folder(all_mail_folder.name, lambda *args: True)
+        folder_sync_engine.download_and_commit_uids(crispin_client, sorted(uid_dict))
+
+    saved_uids = db.session.query(ImapUid).filter(
+        ImapUid.folder_id == all_mail_folder.id
+    )
+    assert {u.msg_uid for u in saved_uids} == set(uid_dict)
+    # All the messages are resolved together, in one batch.
+    assert len(resolved) == 1 and resolved[0] > 1
+
+
 @pytest.mark.skipif(True, reason="Need to investigate")
 def test_gmail_message_deduplication(
     db, default_account, all_mail_folder, trash_folder, mock_imapclient
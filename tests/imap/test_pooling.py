@@ -6,7 +6,7 @@ import gevent
 import mock
 import pytest
 
-from inbox.crispin import CrispinConnectionPool
+from inbox.crispin import AdaptiveCrispinConnectionPool, CrispinConnectionPool
 
 
 class TestableConnectionPool(CrispinConnectionPool):
@@ -62,3 +62,52 @@ def test_connection_retained_on_other_errors():
         raise ValueError
     assert conn in pool._queue
     assert not conn.logout.called
+
+
+class TestableAdaptivePool(AdaptiveCrispinConnectionPool):
+    def _set_account_info(self):
+        self.provider = "custom"
+        self.imap_host = "imap.example.com"
+
+    def _new_connection(self):
+        return mock.Mock(selected_folder_name=None)
+
+
+def test_adaptive_pool_prefers_selected_folder(monkeypatch):
+    monkeypatch.setattr("inbox.crispin.IMAP_POOL_PREWARM", 0)
+    pool = TestableAdaptivePool(1, num_connections=3, readonly=True)
+    with pool.get() as inbox_conn, pool.get() as sent_conn:
+        inbox_conn.selected_folder_name = "Inbox"
+        sent_conn.selected_folder_name = "Sent"
+    with pool.get("Inbox") as conn:
+        assert conn is inbox_conn
+    with pool.get("Sent") as conn:
+        assert conn is sent_conn
+    # Otherwise the most recently used connection is handed out.
+    with pool.get("Drafts") as conn:
+        assert conn is sent_conn
+    gevent.killall(pool._greenlets)
+
+
+def test_adaptive_pool_health_checks_and_reaps(monkeypatch):
+    monkeypatch.setattr("inbox.crispin.IMAP_POOL_PREWARM", 1)
+    monkeypatch.setattr("inbox.crispin.IMAP_POOL_NOOP_INTERVAL", 0)
+    pool = TestableAdaptivePool(1, num_connections=3, readonly=True)
+    gevent.sleep(0)
+    # The pool opened a connection ahead of time.
+    assert len(pool._idle) == 1
+    [(prewarmed, _)] = pool._idle
+
+    # Idle connections are checked with a NOOP, and broken ones discarded.
+    prewarmed.conn.noop.side_effect = socket.error
+    with pool.get() as conn:
+        assert conn is not prewarmed
+        assert prewarmed.conn.noop.called
+    assert not prewarmed.logout.called
+
+    # Connections that were idle for too long are logged out.
+    monkeypatch.setattr("inbox.crispin.IMAP_POOL_IDLE_TIMEOUT", 0)
+    pool._reap_expired()
+    assert pool._idle == []
+    assert conn.logout.called
+    gevent.killall(pool._greenlets)
@@ -0,0 +1,132 @@
+import pytest
+
+from inbox.models.action_log import ActionLog, schedule_action
+from inbox.transactions.actions import SyncbackService
+from inbox.transactions.syncback_scheduler import (
+    SyncbackStats,
+    WeightedRoundRobin,
+    pending_namespaces,
+)
+
+from tests.util.base import add_fake_category, default_account
+
+__all__ = ["default_account"]
+
+
+@pytest.fixture
+def scheduler_enabled(monkeypatch, redis_client):
+    monkeypatch.setattr(
+        "inbox.transactions.syncback_scheduler.SYNCBACK_SCHEDULER_ENABLED", True
+    )
+    monkeypatch.setattr("inbox.transactions.actions.SYNCBACK_SCHEDULER_ENABLED", True)
+    monkeypatch.setattr(pending_namespaces, "redis", redis_client)
+
+
+@pytest.fixture
+def purge_actions(db):
+    db.session.query(ActionLog).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def test_weighted_round_robin():
+    round_robin = WeightedRoundRobin()
+    weights = {"busy": 4, "a": 1, "b": 1, "c": 1, "d": 1}
+    selected = []
+    for _ in range(8):
+        selected.extend(round_robin.select(weights, 2))
+
+    # Busy accounts get more turns, but everyone gets some.
+    assert selected.count("busy") == 8
+    for key in "abcd":
+        assert 1 <= selected.count(key) <= 3
+
+    # Keys that are gone are forgotten.
+    assert round_robin.select({"a": 1}, 2) == ["a"]
+    assert round_robin.select({}, 2) == []
+
+
+def test_syncback_stats():
+    stats = SyncbackStats(samples=10)
+    stats.set_queue_depths(0, {1: 5, 2: 1})
+    stats.set_queue_depths(1, {3: 2})
+    stats.set_queue_depths(0, {1: 4})
+    for latency in range(20):
+        stats.record_latency(1, latency)
+
+    assert stats.queue_depths == {1: 4, 3: 2}
+    # Only the most recent samples are kept.
+    assert stats.latency_percentiles(1) == {"p50": 15, "p90": 19, "p99": 19}
+    assert stats.latency_percentiles(3) == {}
+    assert stats.summary()[3] == {"queue_depth": 2, "latency": {}}
+
+
+def test_scheduled_actions_are_pending(
+    db, default_account, scheduler_enabled, purge_actions
+):
+    namespace_id = default_account.namespace.id
+    category = add_fake_category(db.session, namespace_id, "folder")
+    shard_id = namespace_id >> 48
+
+    # Not until the action is committed.
+    schedule_action("create_folder", category, namespace_id, db.session)
+    db.session.flush()
+    assert pending_namespaces.get(shard_id) == set()
+    db.session.rollback()
+    assert pending_namespaces.get(shard_id) == set()
+
+    schedule_action("create_folder", category, namespace_id, db.session)
+    db.session.commit()
+    assert pending_namespaces.get(shard_id) == {namespace_id}
+
+
+def test_scheduler_processes_pending_namespaces(
+    db, default_account, scheduler_enabled, purge_actions
+):
+    namespace_id = default_account.namespace.id
+    shard_id = namespace_id >> 48
+    category = add_fake_category(db.session, namespace_id, "folder")
+    schedule_action("create_folder", category, namespace_id, db.session)
+    db.session.commit()
+
+    service = SyncbackService(
+        syncback_id=0, process_number=0, total_processes=1, num_workers=2
+    )
+    service.keys = [shard_id]
+    # Namespaces without pending actions are dropped.
+    pending_namespaces.add([namespace_id + 1])
+    service._process_pending_namespaces()
+
+    assert pending_namespaces.get(shard_id) == {namespace_id}
+    assert service.stats.queue_depths == {default_account.id: 1}
+    assert service.task_queue.qsize() == 1
+    assert service.task_queue.peek().account_id == default_account.id
+
+
+def test_scheduler_keeps_namespaces_scheduled_during_processing(
+    db, default_account, scheduler_enabled, purge_actions, monkeypatch
+):
+    namespace_id = default_account.namespace.id
+    shard_id = namespace_id >> 48
+    category = add_fake_category(db.session, namespace_id, "folder")
+    pending_namespaces.add([namespace_id])
+
+    service = SyncbackService(
+        syncback_id=0, process_number=0, total_processes=1, num_workers=2
+    )
+    service.keys = [shard_id]
+
+    # An action is scheduled after the namespace was found to have none, but
+    # before it is removed.
+    remove = pending_namespaces.remove
+
+    def schedule_and_remove(shard_id, namespace_ids):
+        monkeypatch.setattr(pending_namespaces, "remove", remove)
+        schedule_action("create_folder", category, namespace_id, db.session)
+        db.session.commit()
+        remove(shard_id, namespace_ids)
+
+    monkeypatch.setattr(pending_namespaces, "remove", schedule_and_remove)
+    service._process_pending_namespaces()
+
+    assert pending_namespaces.get(shard_id) == {namespace_id}
+    assert service.task_queue.qsize() == 1
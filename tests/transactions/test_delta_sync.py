@@ -3,8 +3,14 @@ import json
 import time
 from builtins import range
 
+import gevent
 from freezegun import freeze_time
 
+from inbox.ignition import redis_txn
+from inbox.models.transaction import TXN_REDIS_KEY
+from inbox.transactions import delta_sync
+from inbox.transactions.watcher import TransactionWatcher
+
 from tests.util.base import add_fake_message
 
 
@@ -235,3 +241,60 @@ def test_account_delta_for_different_namespace_id(db):
         namespace, 0, db.session, 10, exclude_account=False
     )
     assert txns
+
+
+def test_transaction_watcher_wakes_advanced_namespaces(default_namespace):
+    watcher = TransactionWatcher(poll_interval=0.01)
+    public_id = default_namespace.public_id
+    redis_txn.zadd(TXN_REDIS_KEY, **{public_id: 10})
+
+    # Nothing newer than what the waiter has already seen.
+    assert watcher.wait(public_id, 10, timeout=0.1) is None
+
+    waiter = gevent.spawn(watcher.wait, public_id, 10, 5)
+    gevent.sleep(0.05)
+    redis_txn.zadd(TXN_REDIS_KEY, **{public_id: 11})
+    assert waiter.get(timeout=1) == 11
+
+
+def test_delta_broadcaster_shares_encoded_deltas(
+    db, default_namespace, thread, monkeypatch
+):
+    calls = []
+    transaction_deltas_after_pointer = delta_sync._transaction_deltas_after_pointer
+
+    def counting_transaction_deltas_after_pointer(*args, **kwargs):
+        calls.append(args[1])
+        return transaction_deltas_after_pointer(*args, **kwargs)
+
+    monkeypatch.setattr(
+        delta_sync,
+        "_transaction_deltas_after_pointer",
+        counting_transaction_deltas_after_pointer,
+    )
+
+    with delta_sync.delta_broadcaster(
+        default_namespace, expand=False
+    ) as broadcaster, delta_sync.delta_broadcaster(
+        default_namespace, expand=False
+    ) as other_broadcaster:
+        assert broadcaster is other_broadcaster
+
+        broadcaster.deltas_after(0)
+        pointer = broadcaster.end
+        add_fake_message(db.session, default_namespace.id, thread)
+        del calls[:]
+
+        encoded_deltas, new_pointer = broadcaster.deltas_after(pointer)
+        assert encoded_deltas
+        assert new_pointer > pointer
+        # The second subscriber is served from the buffer.
+        assert other_broadcaster.deltas_after(pointer) == (encoded_deltas, new_pointer)
+        assert calls == [pointer]
+
+        # Nothing new according to Redis, so subscribers that are caught up
+        # don't query the transaction log.
+        assert broadcaster.deltas_after(new_pointer) == ([], new_pointer)
+        assert calls == [pointer]
+
+    assert not delta_sync._broadcasters
@@ -72,6 +72,23 @@ def empty_db(config):
     engine.session.close()
 
 
+@fixture(scope="function")
+def second_shard_db(db):
+    """
+    Like `db`, but for the second shard of the test config (synctest_1),
+    whose ids start at 1 << 48. For tests of queries that span shards.
+
+    """
+    from inbox.ignition import engine_manager
+    from inbox.models.session import new_session
+
+    engine = engine_manager.get_for_id(1 << 48)
+    engine.session = new_session(engine)
+    yield engine
+    delete_generic_imap_accounts(engine.session)
+    engine.session.close()
+
+
 @fixture
 def test_client(db):
     from inbox.api.srv import app